@@ -12,11 +12,19 @@ import pandas as pd
 from collections import defaultdict
 import time
 
+from outfits.processing import accelerated as accelerated_kernels
+from outfits.processing import retouch
+from outfits.processing.tiling import default_executor
+
 
 class AdvancedImagePreprocessor:
     """Preprocesador avanzado con 20+ opciones adicionales"""
     
-    def __init__(self):
+    def __init__(self, accelerated=True, tile_executor=None):
+        # Kernels Numba para retinex y reducción de arrugas, si están disponibles
+        self.accelerated = accelerated and accelerated_kernels.AVAILABLE
+        # Filtros de vecindario por teselas en paralelo (resultado idéntico)
+        self.tile_executor = tile_executor or default_executor()
         self.advanced_options = {
             # FILTROS AVANZADOS
             'gaussian_blur': {'enabled': False, 'kernel_size': 5, 'sigma': 1.0},
@@ -93,10 +101,17 @@ class AdvancedImagePreprocessor:
     
     def apply_non_local_means(self, image, h=10, template_window=7, search_window=21):
         """Denoising no local que preserva texturas"""
+        halo = template_window // 2 + search_window // 2
         if len(image.shape) == 3:
-            return cv2.fastNlMeansDenoisingColored(image, None, h, h, template_window, search_window)
+            return self.tile_executor.map(
+                lambda tile: cv2.fastNlMeansDenoisingColored(tile, None, h, h, template_window, search_window),
+                image, halo
+            )
         else:
-            return cv2.fastNlMeansDenoising(image, None, h, template_window, search_window)
+            return self.tile_executor.map(
+                lambda tile: cv2.fastNlMeansDenoising(tile, None, h, template_window, search_window),
+                image, halo
+            )
     
     def apply_adaptive_histogram_equalization(self, image, clip_limit=2.0, grid_size=(8, 8)):
         """CLAHE avanzado por canales"""
@@ -246,42 +261,11 @@ class AdvancedImagePreprocessor:
     
     def _single_scale_retinex(self, image, sigma=15):
         """Implementación de Single Scale Retinex"""
-        if len(image.shape) == 3:
-            result = np.zeros_like(image, dtype=np.float32)
-            for i in range(3):
-                channel = image[:,:,i].astype(np.float32) + 1.0
-                blurred = cv2.GaussianBlur(channel, (0, 0), sigma)
-                result[:,:,i] = np.log(channel) - np.log(blurred)
-        else:
-            image_float = image.astype(np.float32) + 1.0
-            blurred = cv2.GaussianBlur(image_float, (0, 0), sigma)
-            result = np.log(image_float) - np.log(blurred)
-        
-        # Normalizar a rango [0, 255]
-        result = (result - result.min()) / (result.max() - result.min()) * 255
-        return result.astype(np.uint8)
+        return retouch.single_scale_retinex(image, sigma, self.accelerated)
     
     def apply_wrinkle_reduction(self, image, smoothing_strength=0.8):
         """Reducción de arrugas usando suavizado selectivo"""
-        # Detectar regiones con alta variación (posibles arrugas)
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-        
-        # Crear máscara de áreas con mucha textura
-        texture_mask = np.abs(laplacian) > np.percentile(np.abs(laplacian), 70)
-        
-        # Aplicar suavizado solo en esas áreas
-        smoothed = cv2.bilateralFilter(image, 9, 80, 80)
-        
-        # Mezclar usando la máscara
-        result = image.copy().astype(np.float32)
-        for i in range(3):
-            result[:,:,i] = np.where(texture_mask, 
-                                   result[:,:,i] * (1 - smoothing_strength) + 
-                                   smoothed[:,:,i] * smoothing_strength,
-                                   result[:,:,i])
-        
-        return np.clip(result, 0, 255).astype(np.uint8)
+        return retouch.wrinkle_reduction(image, smoothing_strength, self.accelerated, self.tile_executor)
     
     def get_available_options(self):
         """Retorna todas las opciones disponibles con sus descripciones"""
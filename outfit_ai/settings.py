@@ -134,6 +134,10 @@ TEMPLATES[0]['DIRS'] = [os.path.join(BASE_DIR, 'templates')]
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
 
+# Image preprocessing: per-process stage cache (holds every request's images in memory)
+PREPROCESSING_STAGE_CACHE = False
+PREPROCESSING_STAGE_CACHE_MAX_BYTES = 268435456  # 256MB
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
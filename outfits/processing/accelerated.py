@@ -0,0 +1,316 @@
+"""
+Backend acelerado opcional (Numba) para las etapas escritas como cadenas de NumPy
+
+Cada kernel fusiona en un único bucle paralelo por filas lo que la versión
+NumPy hace con varios arrays temporales. Si Numba no está instalado,
+`AVAILABLE` es False y los llamadores usan su implementación NumPy.
+
+Equivalencia con la versión NumPy:
+
+los kernels reproducen los tipos y el orden de las operaciones NumPy
+(float32 donde NumPy opera en float32, float64 donde promociona) y dejan en
+NumPy las funciones trascendentes, así que el resultado es idéntico bit a
+bit. La media de white_balance_lab reproduce además la suma por parejas de
+NumPy; si una versión futura de NumPy la cambiara, la diferencia sería de
+una unidad de redondeo en la media.
+
+`check_parity` compara ambos backends con imágenes aleatorias.
+"""
+import cv2
+import numpy as np
+
+try:
+    from numba import njit, prange
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+
+if AVAILABLE:
+
+    @njit(parallel=True, cache=True)
+    def _saturation_scale(hsv, factor, out):
+        height, width = hsv.shape[0], hsv.shape[1]
+        for y in prange(height):
+            for x in range(width):
+                out[y, x, 0] = hsv[y, x, 0]
+                out[y, x, 2] = hsv[y, x, 2]
+                s = np.float32(hsv[y, x, 1]) * factor
+                if s > 255:
+                    s = np.float32(255)
+                out[y, x, 1] = np.uint8(s)
+
+    @njit(cache=True)
+    def _pairwise_sum(values, start, count, step):
+        # Misma suma por parejas (bloques de 8, corte en 128) que NumPy usa
+        # para reducir arrays float32 no contiguos
+        if count < 8:
+            total = np.float32(0)
+            for i in range(count):
+                total += np.float32(values[start + i * step])
+            return total
+        if count <= 128:
+            partial = np.empty(8, dtype=np.float32)
+            for j in range(8):
+                partial[j] = np.float32(values[start + j * step])
+            i = 8
+            while i < count - count % 8:
+                for j in range(8):
+                    partial[j] += np.float32(values[start + (i + j) * step])
+                i += 8
+            total = ((partial[0] + partial[1]) + (partial[2] + partial[3])) + \
+                    ((partial[4] + partial[5]) + (partial[6] + partial[7]))
+            while i < count:
+                total += np.float32(values[start + i * step])
+                i += 1
+            return total
+        half = count // 2
+        half -= half % 8
+        return (_pairwise_sum(values, start, half, step)
+                + _pairwise_sum(values, start + half * step, count - half, step))
+
+    @njit(parallel=True, cache=True)
+    def _white_balance_lab(lab, offset_a, offset_b, out):
+        height, width = lab.shape[0], lab.shape[1]
+        scale = np.float32(255.0)
+        gain = np.float32(1.1)
+        for y in prange(height):
+            for x in range(width):
+                lightness = np.float32(lab[y, x, 0])
+                weight = lightness / scale
+                out[y, x, 0] = lab[y, x, 0]
+                for channel, offset in ((1, offset_a), (2, offset_b)):
+                    value = np.float32(lab[y, x, channel]) - offset * weight * gain
+                    if value < 0:
+                        value = np.float32(0)
+                    elif value > 255:
+                        value = np.float32(255)
+                    out[y, x, channel] = np.uint8(value)
+
+    @njit(parallel=True, cache=True)
+    def _masked_blend(image, smoothed, mask, strength, out):
+        height, width, channels = image.shape
+        keep = np.float32(1 - strength)
+        for y in prange(height):
+            for x in range(width):
+                for c in range(channels):
+                    if mask[y, x]:
+                        # NumPy: float32 * float32 + float64 -> float64, guardado en float32
+                        value = np.float32(
+                            np.float64(np.float32(image[y, x, c]) * keep)
+                            + np.float64(smoothed[y, x, c]) * strength
+                        )
+                        if value < 0:
+                            value = np.float32(0)
+                        elif value > 255:
+                            value = np.float32(255)
+                        out[y, x, c] = np.uint8(value)
+                    else:
+                        out[y, x, c] = image[y, x, c]
+
+    @njit(parallel=True, cache=True)
+    def _log_difference(log_channel, log_blurred, out, channel, row_min, row_max):
+        height, width = log_channel.shape
+        for y in prange(height):
+            lo = np.float32(np.inf)
+            hi = np.float32(-np.inf)
+            for x in range(width):
+                value = log_channel[y, x] - log_blurred[y, x]
+                out[y, x, channel] = value
+                lo = min(lo, value)
+                hi = max(hi, value)
+            row_min[y] = lo
+            row_max[y] = hi
+
+    @njit(parallel=True, cache=True)
+    def _domain_transform_derivatives(image, ratio, horizontal, vertical):
+        # 1 + sigma_s/sigma_r * suma de |diferencias| entre canales vecinos
+        height, width, channels = image.shape
+        for y in prange(height):
+            for x in range(width):
+                if x < width - 1:
+                    total = np.float32(0)
+                    for c in range(channels):
+                        total += abs(image[y, x + 1, c] - image[y, x, c])
+                    horizontal[y, x] = np.float32(1) + ratio * total
+                if y < height - 1:
+                    total = np.float32(0)
+                    for c in range(channels):
+                        total += abs(image[y + 1, x, c] - image[y, x, c])
+                    vertical[y, x] = np.float32(1) + ratio * total
+
+    @njit(parallel=True, cache=True)
+    def _recursive_filter_rows(image, weights):
+        height, width, channels = image.shape
+        for y in prange(height):
+            for x in range(1, width):
+                v = weights[y, x - 1]
+                for c in range(channels):
+                    image[y, x, c] += (image[y, x - 1, c] - image[y, x, c]) * v
+            for x in range(width - 2, -1, -1):
+                v = weights[y, x]
+                for c in range(channels):
+                    image[y, x, c] += (image[y, x + 1, c] - image[y, x, c]) * v
+
+    @njit(parallel=True, cache=True)
+    def _recursive_filter_columns(image, weights):
+        # Bloques de columnas recorridos fila a fila: acceso contiguo sin transponer
+        height, width, channels = image.shape
+        block = 32
+        for b in prange((width + block - 1) // block):
+            x0 = b * block
+            x1 = min(x0 + block, width)
+            for y in range(1, height):
+                for x in range(x0, x1):
+                    v = weights[y - 1, x]
+                    for c in range(channels):
+                        image[y, x, c] += (image[y - 1, x, c] - image[y, x, c]) * v
+            for y in range(height - 2, -1, -1):
+                for x in range(x0, x1):
+                    v = weights[y, x]
+                    for c in range(channels):
+                        image[y, x, c] += (image[y + 1, x, c] - image[y, x, c]) * v
+
+    @njit(parallel=True, cache=True)
+    def _normalize_to_uint8(values, lo, hi, out):
+        height, width, channels = values.shape
+        span = hi - lo
+        for y in prange(height):
+            for x in range(width):
+                for c in range(channels):
+                    out[y, x, c] = np.uint8((values[y, x, c] - lo) / span * np.float32(255))
+
+
+def saturation_scale(hsv, factor, out=None):
+    """Multiplica el canal S de una imagen HSV uint8 por `factor` (float32, saturado a 255)"""
+    if out is None:
+        out = np.empty_like(hsv)
+    _saturation_scale(hsv, np.float32(factor), out)
+    return out
+
+
+def channel_mean(image, channel):
+    """Media float32 de un canal, idéntica a np.mean(image.astype(np.float32)[:, :, channel])
+
+    Evita convertir la imagen completa a float32 solo para calcular la media.
+    """
+    image = np.ascontiguousarray(image)
+    channels = image.shape[2]
+    count = image.shape[0] * image.shape[1]
+    total = _pairwise_sum(image.reshape(-1), channel, count, channels)
+    return np.float32(total) / np.float32(count)
+
+
+def white_balance_lab(lab, out=None, averages=None):
+    """Balance de blancos sobre una imagen LAB uint8
+
+    `averages` fija las medias (a, b) de referencia en lugar de medirlas en
+    `lab` (por ejemplo, al procesar la imagen por franjas).
+    """
+    if out is None:
+        out = np.empty_like(lab)
+    if averages is None:
+        avg_a = channel_mean(lab, 1)
+        avg_b = channel_mean(lab, 2)
+    else:
+        avg_a, avg_b = averages
+    _white_balance_lab(lab, np.float32(avg_a - 128), np.float32(avg_b - 128), out)
+    return out
+
+
+def masked_blend(image, smoothed, mask, strength, out=None):
+    """Mezcla `image` y `smoothed` con peso `strength` donde `mask` es verdadera"""
+    if out is None:
+        out = np.empty_like(image)
+    _masked_blend(image, smoothed, mask, float(strength), out)
+    return out
+
+
+def retinex_normalized(image, sigma):
+    """Single Scale Retinex de una imagen de tres canales, normalizado a uint8
+
+    El desenfoque y los logaritmos siguen en OpenCV/NumPy (vectorizados);
+    el kernel fusiona la diferencia, el mínimo/máximo y la normalización.
+    """
+    height, width, channels = image.shape
+    values = np.empty(image.shape, dtype=np.float32)
+    row_min = np.empty((channels, height), dtype=np.float32)
+    row_max = np.empty((channels, height), dtype=np.float32)
+    for c in range(channels):
+        channel = image[:, :, c].astype(np.float32) + 1.0
+        blurred = cv2.GaussianBlur(channel, (0, 0), sigma)
+        np.log(channel, out=channel)
+        np.log(blurred, out=blurred)
+        _log_difference(channel, blurred, values, c, row_min[c], row_max[c])
+
+    out = np.empty(image.shape, dtype=np.uint8)
+    _normalize_to_uint8(values, row_min.min(), row_max.max(), out)
+    return out
+
+
+def domain_transform(image, sigma_s, sigma_r, iterations=3):
+    """Filtro recursivo de transformada de dominio (Gastal y Oliveira), como edgePreservingFilter(flags=1)
+
+    Mismas fórmulas que la implementación de OpenCV en float32; el resultado
+    difiere como mucho en un nivel por el redondeo final.
+    """
+    values = image.astype(np.float32)
+    values *= np.float32(1 / 255)
+    height, width = image.shape[:2]
+    horizontal = np.empty((height, max(width - 1, 0)), dtype=np.float32)
+    vertical = np.empty((max(height - 1, 0), width), dtype=np.float32)
+    _domain_transform_derivatives(values, np.float32(sigma_s / sigma_r), horizontal, vertical)
+
+    for i in range(iterations):
+        sigma_h = sigma_s * np.sqrt(3) * 2 ** (iterations - (i + 1)) / np.sqrt(4 ** iterations - 1)
+        a = np.float32(np.exp(-np.sqrt(2) / sigma_h))
+        _recursive_filter_rows(values, np.power(a, horizontal))
+        _recursive_filter_columns(values, np.power(a, vertical))
+
+    values *= np.float32(255)
+    return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+
+
+def check_parity(samples=20, seed=0):
+    """Diferencia máxima entre el backend acelerado y NumPy en cada kernel
+
+    Devuelve un diccionario {kernel: diferencia máxima en niveles}. Requiere
+    que Numba esté instalado.
+    """
+    from .preprocessing import ImagePreprocessor
+    from .extended_preprocessing import ExtendedImagePreprocessor
+    from . import retouch
+
+    def preprocessor_pair(cls, method):
+        return (getattr(cls(accelerated=False), method), getattr(cls(accelerated=True), method))
+
+    rng = np.random.default_rng(seed)
+    pairs = {
+        'saturation': preprocessor_pair(ImagePreprocessor, '_enhance_saturation'),
+        'white_balance': preprocessor_pair(ImagePreprocessor, '_white_balance'),
+        'wrinkle_smoothing': preprocessor_pair(ExtendedImagePreprocessor, 'apply_wrinkle_smoothing'),
+        'wrinkle_reduction': (lambda image: retouch.wrinkle_reduction(image, accelerated=False),
+                              lambda image: retouch.wrinkle_reduction(image, accelerated=True)),
+        'retinex': (lambda image: retouch.single_scale_retinex(image, accelerated=False),
+                    lambda image: retouch.single_scale_retinex(image, accelerated=True)),
+    }
+
+    differences = dict.fromkeys(list(pairs) + ['domain_transform'], 0)
+    for _ in range(samples):
+        height, width = rng.integers(8, 320, size=2)
+        image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+        image = cv2.GaussianBlur(image, (0, 0), rng.uniform(0.5, 3))
+
+        for name, (reference, accelerated) in pairs.items():
+            expected = reference(image)
+            actual = accelerated(image)
+            diff = int(np.abs(expected.astype(np.int16) - actual.astype(np.int16)).max())
+            differences[name] = max(differences[name], diff)
+
+        # El filtro recursivo de OpenCV es la referencia del kernel de transformada de dominio
+        expected = cv2.edgePreservingFilter(image, flags=cv2.RECURS_FILTER, sigma_s=50, sigma_r=0.4)
+        actual = domain_transform(image, 50, 0.4)
+        diff = int(np.abs(expected.astype(np.int16) - actual.astype(np.int16)).max())
+        differences['domain_transform'] = max(differences['domain_transform'], diff)
+
+    return differences
@@ -6,16 +6,20 @@ import numpy as np
 from PIL import Image
 import colorsys
 
+from . import resources
+
 
 class FacialAnalyzer:
-    """Análisis facial y determinación de paleta de colores"""
+    """Análisis facial y determinación de paleta de colores
+
+    No guarda estado entre llamadas: una instancia puede atender peticiones
+    concurrentes.
+    """
     
-    def __init__(self):
-        # Cargar clasificador de rostros de OpenCV
-        try:
-            self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        except:
-            self.face_cascade = None
+    @property
+    def face_cascade(self):
+        # Clasificador de rostros de OpenCV, cargado una vez por hilo
+        return resources.face_cascade()
     
     def detect_face(self, image):
         """Detecta rostros en la imagen"""
@@ -0,0 +1,209 @@
+"""
+Procesamiento de varias imágenes a la vez: etapas sobre un tensor apilado y OpenCV en un pool de hilos
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from . import accelerated as accelerated_kernels
+from .lut import gamma_lut, minmax_lut
+
+
+def _stack_normalize(runner, stack, images, step, members):
+    """Normalización min/max: rangos de todas las imágenes con una reducción sobre el tensor"""
+    flat = stack.reshape(len(stack), -1)
+    lows, highs = flat.min(axis=1), flat.max(axis=1)
+    output = np.empty_like(stack)
+    for n, worker in enumerate(members):
+        lo, hi = worker._global_parameter('normalize', lambda n=n: (int(lows[n]), int(highs[n])))
+        cv2.LUT(images[n], minmax_lut(lo, hi), dst=output[n])
+    return output
+
+
+def _stack_gamma(runner, stack, images, step, members):
+    """Gamma de cada imagen (la elegida con su brillo o la del paso) aplicada con su LUT"""
+    gammas = runner.map(lambda n: members[n]._stage_gamma(images[n], step.params['gamma']), range(len(stack)))
+    output = np.empty_like(stack)
+    for n, gamma in enumerate(gammas):
+        cv2.LUT(images[n], gamma_lut(gamma), dst=output[n])
+    return output
+
+
+def _stack_saturation(runner, stack, images, step, members):
+    """Canal S de todo el tensor en una sola multiplicación float32 (como _enhance_saturation)"""
+    hsv = np.empty_like(stack)
+    runner.map(lambda n: cv2.cvtColor(images[n], cv2.COLOR_RGB2HSV, dst=hsv[n]), range(len(stack)))
+    saturation = np.multiply(hsv[..., 1], np.float32(step.params['gain']), dtype=np.float32)
+    np.clip(saturation, 0, 255, out=saturation)
+    np.copyto(hsv[..., 1], saturation, casting='unsafe')
+
+    output = np.empty_like(stack)
+    runner.map(lambda n: cv2.cvtColor(hsv[n], cv2.COLOR_HSV2RGB, dst=output[n]), range(len(stack)))
+    return output
+
+
+def _stack_white_balance(runner, stack, images, step, members):
+    """Balance de blancos: medias (a, b) de cada imagen y corrección de todo el tensor a la vez
+
+    Mismas operaciones float32 y en el mismo orden que _white_balance, con
+    las medias de cada imagen difundidas sobre su plano.
+    """
+    count = len(stack)
+    lab = np.empty_like(stack)
+    runner.map(lambda n: cv2.cvtColor(images[n], cv2.COLOR_RGB2LAB, dst=lab[n]), range(count))
+    result = lab.astype(np.float32)
+
+    def averages(n):
+        worker = members[n]
+        if worker.accelerated:
+            estimate = lambda: (accelerated_kernels.channel_mean(lab[n], 1), accelerated_kernels.channel_mean(lab[n], 2))
+        else:
+            estimate = lambda: (np.mean(result[n, :, :, 1]), np.mean(result[n, :, :, 2]))
+        return worker._global_parameter('white_balance', estimate)
+
+    means = np.array(runner.map(averages, range(count)), dtype=np.float32).reshape(count, 2, 1, 1)
+    correction = np.empty(stack.shape[:3], dtype=np.float32)
+    for channel in (1, 2):
+        np.divide(result[..., 0], 255.0, out=correction)
+        np.multiply(means[:, channel - 1] - 128, correction, out=correction)
+        np.multiply(correction, 1.1, out=correction)
+        np.subtract(result[..., channel], correction, out=result[..., channel])
+    np.clip(result, 0, 255, out=result)
+    np.copyto(lab, result, casting='unsafe')
+
+    output = np.empty_like(stack)
+    runner.map(lambda n: cv2.cvtColor(lab[n], cv2.COLOR_LAB2RGB, dst=output[n]), range(count))
+    return output
+
+
+# Operaciones que se aplican sobre el tensor (N, H, W, 3) de un grupo de
+# imágenes; el resto se reparte imagen a imagen en el pool de hilos
+STACK_STAGES = {
+    'normalize': _stack_normalize,
+    'adaptive_gamma': _stack_gamma,
+    'saturation': _stack_saturation,
+    'white_balance': _stack_white_balance,
+}
+
+
+class BatchRunner:
+    """Ejecuta el pipeline de un preprocesador sobre varias imágenes a la vez
+
+    Cada imagen tiene su propio preprocesador de trabajo (ver
+    ImagePreprocessor._batch_worker) con sus estadísticas, sus etapas y sus
+    parámetros globales; el del que se llama solo aporta la configuración.
+    Tras el redimensionado las imágenes de igual tamaño (todas, salvo con
+    content_region y proporciones distintas) se apilan en un tensor
+    (N, H, W, 3): las operaciones de STACK_STAGES trabajan sobre él y las de
+    OpenCV se reparten por imagen en un pool de `workers` hilos, como el
+    registro de cada etapa y sus estadísticas.
+
+    Las fusiones de etapas no se aplican: cada etapa se registra con su
+    imagen. Las reglas de omisión se evalúan imagen a imagen.
+    """
+
+    def __init__(self, preprocessor, workers=None):
+        self.preprocessor = preprocessor
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = None
+
+    def map(self, function, items):
+        """Aplica `function` a cada elemento en el pool y devuelve la lista de resultados"""
+        items = list(items)
+        if self._pool is None or len(items) == 1:
+            return [function(item) for item in items]
+        return list(self._pool.map(function, items))
+
+    def run(self, images):
+        """Procesa `images` (PIL o archivos subidos) y devuelve una lista de (imagen_final, resumen, estadísticas)"""
+        start = time.time()
+        preprocessor = self.preprocessor
+        steps = preprocessor.pipeline.steps
+        if [step.op.name for step in steps[:2]] != ['original', 'resize']:
+            raise ValueError("El procesamiento por lotes necesita un pipeline que empiece por original y resize")
+
+        members = [preprocessor._batch_worker() for _ in images]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch') as pool:
+            self._pool = pool
+            try:
+                sources = self.map(lambda n: members[n]._batch_source(images[n]), range(len(images)))
+
+                # Entrada y redimensionado, imagen a imagen
+                def prepare(n):
+                    worker, source = members[n], sources[n]
+                    worker._source_image = source
+                    current = worker._record_stage(steps[0].stage, worker._apply_step(steps[0], np.array(source)))
+                    resized = worker._apply_step(steps[1], current)
+                    worker._source_image = None
+                    return resized
+                resized = self.map(prepare, range(len(images)))
+
+                groups = {}
+                for n, image in enumerate(resized):
+                    groups.setdefault(image.shape, []).append(n)
+                finals = [None] * len(images)
+                for indices in groups.values():
+                    stack = np.stack([resized[n] for n in indices])
+                    outputs = self._run_group(stack, [members[n] for n in indices], steps[1:])
+                    for n, output in zip(indices, outputs):
+                        finals[n] = output
+            finally:
+                self._pool = None
+
+        results = []
+        elapsed = time.time() - start
+        for worker, final in zip(members, finals):
+            if worker._processes_content_region():
+                final = worker._compose_canvas(final)
+            summary = worker._processing_summary(start)
+            summary['batch'] = {'size': len(images), 'groups': len(groups), 'processing_time': elapsed}
+            results.append((Image.fromarray(final), summary, worker.processing_stats))
+        return results
+
+    def _run_group(self, stack, members, steps):
+        """Etapas desde el redimensionado sobre el tensor de un grupo; devuelve la salida de cada imagen"""
+        count = len(members)
+        # Vista de cada imagen en el tensor: la misma para sus estadísticas y
+        # para la etapa siguiente, que reutiliza las métricas y vistas derivadas
+        images = list(stack)
+        self.map(lambda n: members[n]._record_stage(steps[0].stage, images[n]), range(count))
+        i = 1
+        while i < len(steps):
+            step = steps[i]
+            skipped = self.map(lambda n: members[n]._gate_stage(step, images[n]), range(count))
+            for n, reason in enumerate(skipped):
+                if reason is not None:
+                    members[n].skipped_stages.append({'stage': step.stage, 'op': step.op.name, 'reason': reason})
+
+            if step.op.kind == 'linear' and not any(skipped):
+                # Cadena de etapas lineales (un solo plan salvo en modo 'exact'),
+                # hasta la primera etapa que alguna imagen deba omitir
+                run = [step]
+                while (i + len(run) < len(steps) and steps[i + len(run)].op.kind == 'linear'
+                        and not any(self.map(lambda n: members[n]._gate_stage(steps[i + len(run)], images[n]),
+                                             range(count)))):
+                    run.append(steps[i + len(run)])
+                # Cada imagen registra sus etapas; su salida es la entrada de la siguiente etapa
+                images = self.map(lambda n: members[n]._run_linear_steps(images[n], run), range(count))
+                stack = np.stack(images)
+                i += len(run)
+                continue
+
+            function = STACK_STAGES.get(step.op.name)
+            if function is not None and not any(skipped):
+                stack = function(self, stack, images, step, members)
+            else:
+                output = np.empty_like(stack)
+
+                def apply(n):
+                    output[n] = images[n] if skipped[n] is not None else members[n]._recompute_step(step, images[n])
+                self.map(apply, range(count))
+                stack = output
+            images = list(stack)
+            self.map(lambda n: members[n]._record_stage(step.stage, images[n]), range(count))
+            i += 1
+        return images
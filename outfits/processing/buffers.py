@@ -0,0 +1,67 @@
+"""
+Arena de buffers de trabajo reutilizables entre etapas y entre peticiones
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class BufferArena:
+    """Buffers temporales preasignados, indexados por nombre, forma y tipo
+
+    Solo debe usarse para resultados intermedios que no salen de la etapa que
+    los pide: las salidas de cada etapa se guardan por referencia en el
+    StageStore y tienen que ser arrays nuevos. El contenido de un buffer
+    devuelto por `get` es indefinido y puede sobrescribirse en la siguiente
+    llamada con la misma clave.
+
+    Cuando la memoria retenida supera `max_bytes` se descartan los buffers
+    usados hace más tiempo (por ejemplo, los de un tamaño de imagen que ya no
+    se procesa).
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._buffers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, shape, dtype=np.float32):
+        """Devuelve el buffer `name` con la forma y el tipo pedidos"""
+        key = (name, tuple(shape), np.dtype(dtype))
+        buffer = self._buffers.get(key)
+        if buffer is not None:
+            self._buffers.move_to_end(key)
+            self.hits += 1
+            return buffer
+
+        self.misses += 1
+        buffer = np.empty(shape, dtype=dtype)
+        self._buffers[key] = buffer
+        self._evict()
+        return buffer
+
+    @property
+    def nbytes(self):
+        """Memoria retenida por los buffers"""
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def clear(self):
+        """Libera todos los buffers"""
+        self._buffers.clear()
+
+    def _evict(self):
+        while len(self._buffers) > 1 and self.nbytes > self.max_bytes:
+            self._buffers.popitem(last=False)
+
+
+_thread_state = threading.local()
+
+
+def thread_arena():
+    """Arena propia del hilo actual (un worker), reutilizada entre peticiones"""
+    arena = getattr(_thread_state, 'arena', None)
+    if arena is None:
+        arena = _thread_state.arena = BufferArena()
+    return arena
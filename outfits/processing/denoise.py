@@ -0,0 +1,314 @@
+"""
+Reducción de ruido por niveles, elegidos según el ruido medido y el ISO de la cámara
+"""
+import cv2
+import numpy as np
+
+
+# Niveles ordenados de menor a mayor coste
+TIERS = ('none', 'bilateral', 'nlm_luma_half', 'nlm_reduced', 'nlm_full')
+
+
+def noise_map(gray, tile_size):
+    """Nivel de ruido de cada tesela, con la misma definición que noise_level
+
+    Desviación estándar del residuo respecto a un promedio local 3x3 dentro
+    de cada tesela de `tile_size` píxeles (las del borde pueden ser menores).
+    Las sumas por tesela salen de tablas de áreas sumadas (integral de la
+    imagen y de su cuadrado), así que el coste no depende del tamaño de tesela.
+    """
+    gray_f = gray.astype(np.float32)
+    residual = cv2.subtract(gray_f, cv2.blur(gray_f, (3, 3)))
+    sums, squares = cv2.integral2(residual, sdepth=cv2.CV_64F)
+
+    height, width = gray.shape[:2]
+    ys = np.append(np.arange(0, height, tile_size), height)
+    xs = np.append(np.arange(0, width, tile_size), width)
+
+    def tile_totals(table):
+        return (table[ys[1:], :][:, xs[1:]] - table[ys[:-1], :][:, xs[1:]]
+                - table[ys[1:], :][:, xs[:-1]] + table[ys[:-1], :][:, xs[:-1]])
+
+    counts = np.outer(np.diff(ys), np.diff(xs))
+    mean = tile_totals(sums) / counts
+    variance = np.maximum(tile_totals(squares) / counts - mean ** 2, 0)
+    return np.sqrt(variance)
+
+
+class DenoiseEngine:
+    """Reducción de ruido con varios niveles de coste
+
+    - 'none': la imagen sin cambios
+    - 'bilateral': filtro bilateral (unos 30 ms a 512x512)
+    - 'nlm_luma_half': NLM solo de la luminancia a media resolución; el detalle
+      fino de la luminancia se recupera de la imagen completa con un umbral
+      suave y la crominancia se suaviza a media resolución y se reescala
+    - 'nlm_reduced': NLM en color con ventana de búsqueda reducida
+    - 'nlm_full': NLM en color con los parámetros configurados (el original)
+
+    `select_tier` elige el nivel a partir del noise_level de la imagen de
+    entrada y, si se conoce, del ISO EXIF de la foto.
+    """
+
+    # Calibrado con la entrada real de la etapa (tras CLAHE) en fotos con
+    # ruido gaussiano añadido de sigma 0 a 20. En imágenes suaves noise_level
+    # vale ~1.7 sin ruido, ~3.8 con sigma 2 y ~8 con sigma 5; en fotos con
+    # textura el propio contenido aporta entre 8 y 13. Frente a la imagen sin
+    # ruido, 'nlm_luma_half' y 'nlm_reduced' quedan a la par o por encima de
+    # 'nlm_full' hasta sigma 8, con un 10 % y un 35 % de su tiempo.
+    NOISE_THRESHOLDS = (
+        (3.0, 'none'),
+        (6.0, 'bilateral'),
+        (10.0, 'nlm_luma_half'),
+        (16.0, 'nlm_reduced'),
+    )
+
+    # Con ISO bajo el sensor apenas aporta ruido y un noise_level alto se debe
+    # a textura; con ISO alto el ruido es de grano grueso y necesita NLM
+    LOW_ISO = 200
+    LOW_ISO_MAX_TIER = 'nlm_luma_half'
+    ISO_MIN_TIERS = ((3200, 'nlm_full'), (1600, 'nlm_reduced'))
+
+    REDUCED_SEARCH_WINDOW = 11
+
+    # Ruido por tesela a partir del cual apply_regional usa el nivel caro
+    REGIONAL_THRESHOLD = 6.0
+
+    def __init__(self, h=10, h_color=10, template_window_size=7, search_window_size=21,
+                 bilateral_diameter=9, bilateral_sigma=75):
+        self.h = h
+        self.h_color = h_color
+        self.template_window_size = template_window_size
+        self.search_window_size = search_window_size
+        self.bilateral_diameter = bilateral_diameter
+        self.bilateral_sigma = bilateral_sigma
+
+    def select_tier(self, noise_level, iso=None, max_tier='nlm_full'):
+        """Nivel de reducción de ruido para una imagen, limitado a `max_tier`"""
+        if max_tier not in TIERS:
+            raise ValueError(f"Nivel de reducción de ruido no soportado: {max_tier}")
+
+        tier = TIERS[-1]
+        for threshold, candidate in self.NOISE_THRESHOLDS:
+            if noise_level < threshold:
+                tier = candidate
+                break
+
+        if iso is not None:
+            if iso <= self.LOW_ISO:
+                tier = self._lower(tier, self.LOW_ISO_MAX_TIER)
+            for min_iso, min_tier in self.ISO_MIN_TIERS:
+                if iso >= min_iso:
+                    tier = self._higher(tier, min_tier)
+                    break
+
+        return self._lower(tier, max_tier)
+
+    def apply(self, image, tier, bgr=False, executor=None):
+        """Aplica el nivel `tier` a una imagen de tres canales RGB (o BGR si `bgr`)
+
+        Con un TileExecutor el filtro se aplica por teselas en paralelo.
+        """
+        if tier not in TIERS:
+            raise ValueError(f"Nivel de reducción de ruido no soportado: {tier}")
+        if executor is not None and tier != 'none':
+            # La reducción 2x2 de 'nlm_luma_half' necesita teselas con origen par
+            align = 2 if tier == 'nlm_luma_half' else 1
+            return executor.map(lambda tile: self.apply(tile, tier, bgr), image, self.halo(tier), align)
+
+        if tier == 'none':
+            return image.copy()
+        if tier == 'bilateral':
+            return cv2.bilateralFilter(image, self.bilateral_diameter, self.bilateral_sigma, self.bilateral_sigma)
+        if tier == 'nlm_luma_half':
+            return self._nlm_luma_half(image, bgr)
+
+        search_window_size = self.search_window_size
+        if tier == 'nlm_reduced':
+            search_window_size = min(search_window_size, self.REDUCED_SEARCH_WINDOW)
+        return cv2.fastNlMeansDenoisingColored(
+            image, None, h=self.h, hColor=self.h_color,
+            templateWindowSize=self.template_window_size, searchWindowSize=search_window_size
+        )
+
+    def halo(self, tier):
+        """Radio de vecindario que lee un nivel alrededor de cada píxel"""
+        nlm_radius = self.template_window_size // 2 + self.search_window_size // 2
+        if tier == 'bilateral':
+            return self.bilateral_diameter // 2
+        if tier == 'nlm_luma_half':
+            # NLM a media resolución más la interpolación al reescalar
+            return 2 * nlm_radius + 2
+        if tier == 'nlm_reduced':
+            return self.template_window_size // 2 + min(self.search_window_size, self.REDUCED_SEARCH_WINDOW) // 2
+        if tier == 'nlm_full':
+            return nlm_radius
+        return 0
+
+    def apply_regional(self, image, tier, tile_size=32, blend=8, bgr=False, executor=None):
+        """Reducción de ruido por teselas: `tier` solo donde el ruido local lo justifica
+
+        El ruido de cada tesela (`noise_map`) decide entre no filtrar
+        (por debajo del umbral de 'none' de NOISE_THRESHOLDS), el filtro
+        bilateral (por debajo de REGIONAL_THRESHOLD) o `tier`. El fondo liso,
+        incluido el margen uniforme que añade el redimensionado, no pasa por
+        NLM. Cada nivel se aplica sobre rectángulos de teselas contiguas
+        ampliados con su halo (ver `_tile_rectangles`), así que el interior
+        coincide con el filtrado de la imagen completa.
+
+        Costuras: la transición hacia un nivel más caro es una rampa de
+        `blend` píxeles dentro de sus propias teselas, de modo que cada nivel
+        solo se calcula en las teselas que lo eligieron.
+
+        Con un TileExecutor cada rectángulo grande se filtra por teselas en
+        paralelo. Devuelve la imagen y el número de teselas de cada nivel.
+        """
+        height, width = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if bgr else cv2.COLOR_RGB2GRAY)
+        levels = noise_map(gray, tile_size)
+
+        ladder = ['none', 'bilateral', tier][:min(TIERS.index(tier), 2) + 1]
+        thresholds = [self.NOISE_THRESHOLDS[0][0], self.REGIONAL_THRESHOLD][:len(ladder) - 1]
+        tiles = np.searchsorted(thresholds, levels, side='right')
+        counts = {ladder[index]: int((tiles == index).sum()) for index in np.unique(tiles)}
+        if len(counts) == 1:
+            return self.apply(image, ladder[int(tiles[0, 0])], bgr, executor), counts
+
+        tile_rows = np.minimum(np.arange(height) // tile_size, tiles.shape[0] - 1)
+        tile_cols = np.minimum(np.arange(width) // tile_size, tiles.shape[1] - 1)
+        pixel_levels = tiles[tile_rows][:, tile_cols]
+        starts_y, starts_x = np.arange(0, height, tile_size), np.arange(0, width, tile_size)
+
+        # Peso acumulado de los niveles >= k: máscara erosionada y suavizada,
+        # nula fuera de las teselas de esos niveles; el peso del nivel k es la
+        # diferencia con el acumulado del nivel siguiente
+        ramp = np.ones((2 * blend + 1, 2 * blend + 1), dtype=np.uint8)
+        cumulative = [np.ones((height, width), dtype=np.float32)]
+        for index in range(1, len(ladder)):
+            mask = (pixel_levels >= index).astype(np.float32)
+            if blend > 0:
+                mask = cv2.blur(cv2.erode(mask, ramp), ramp.shape, borderType=cv2.BORDER_REPLICATE)
+            cumulative.append(mask)
+        cumulative.append(np.zeros((height, width), dtype=np.float32))
+
+        result = np.zeros(image.shape, dtype=np.float32)
+        for index, level in enumerate(ladder):
+            weight = cumulative[index] - cumulative[index + 1]
+            # Teselas con peso apreciable (descarta restos de redondeo de la rampa)
+            needed = np.maximum.reduceat(np.maximum.reduceat(weight, starts_y, axis=0), starts_x, axis=1) > 1e-6
+            filtered = np.zeros(image.shape, dtype=np.uint8)
+            for y0, y1, x0, x1 in self._tile_rectangles(needed, tile_size, self.halo(level), height, width):
+                filtered[y0:y1, x0:x1] = self._apply_crop(image, level, y0, y1, x0, x1, bgr, executor)
+            result += filtered * weight[:, :, np.newaxis]
+
+        return np.clip(np.rint(result), 0, 255).astype(np.uint8), counts
+
+    def _apply_crop(self, image, tier, y0, y1, x0, x1, bgr, executor=None):
+        """Aplica un nivel a un rectángulo leyendo también su halo de la imagen"""
+        if tier == 'none':
+            return image[y0:y1, x0:x1]
+
+        halo = self.halo(tier)
+        height, width = image.shape[:2]
+        top, left = max(y0 - halo, 0), max(x0 - halo, 0)
+        if tier == 'nlm_luma_half':
+            # Origen par para que la reducción 2x2 coincida con la de la imagen completa
+            top, left = top - top % 2, left - left % 2
+        bottom, right = min(y1 + halo, height), min(x1 + halo, width)
+
+        filtered = self.apply(image[top:bottom, left:right], tier, bgr, executor)
+        return filtered[y0 - top:y1 - top, x0 - left:x1 - left]
+
+    @staticmethod
+    def _tile_rectangles(mask, tile_size, halo, height, width):
+        """Rectángulos en píxeles que cubren las teselas marcadas en `mask`
+
+        Cada rectángulo se filtra con `halo` píxeles extra por lado, así que
+        agrupar teselas ahorra trabajo aunque el grupo incluya alguna tesela
+        no marcada: los tramos de una fila se unen si el hueco es menor que
+        dos halos, y cada tramo se une al rectángulo abierto de la fila
+        anterior con el que se solapa si el área filtrada total no crece. Si
+        aun así el rectángulo que envuelve todas las teselas sale más barato
+        (teselas dispersas), se usa solo ese.
+        """
+        def area(y0, y1, x0, x1):
+            return ((min(y1 + halo, height) - max(y0 - halo, 0))
+                    * (min(x1 + halo, width) - max(x0 - halo, 0)))
+
+        rectangles = []
+        open_rectangles = []
+        for row in range(mask.shape[0]):
+            y0, y1 = row * tile_size, min((row + 1) * tile_size, height)
+
+            runs = []
+            for col in np.flatnonzero(mask[row]):
+                x0, x1 = col * tile_size, min((col + 1) * tile_size, width)
+                if runs and x0 - runs[-1][1] <= 2 * halo:
+                    runs[-1][1] = x1
+                else:
+                    runs.append([x0, x1])
+
+            continuing = []
+            for x0, x1 in runs:
+                previous = next((r for r in open_rectangles if r[2] < x1 and x0 < r[3]), None)
+                if previous is not None:
+                    merged = [previous[0], y1, min(previous[2], x0), max(previous[3], x1)]
+                    if area(*merged) <= area(*previous) + area(y0, y1, x0, x1):
+                        open_rectangles.remove(previous)
+                        continuing.append(merged)
+                        continue
+                continuing.append([y0, y1, x0, x1])
+
+            rectangles.extend(open_rectangles)
+            open_rectangles = continuing
+
+        rectangles.extend(open_rectangles)
+        if not rectangles:
+            return []
+
+        bounding = (min(r[0] for r in rectangles), max(r[1] for r in rectangles),
+                    min(r[2] for r in rectangles), max(r[3] for r in rectangles))
+        if area(*bounding) <= sum(area(*rectangle) for rectangle in rectangles):
+            return [bounding]
+        return [tuple(rectangle) for rectangle in rectangles]
+
+    def _nlm_luma_half(self, image, bgr):
+        to_lab, from_lab = (cv2.COLOR_BGR2LAB, cv2.COLOR_LAB2BGR) if bgr else (cv2.COLOR_RGB2LAB, cv2.COLOR_LAB2RGB)
+        lab = cv2.cvtColor(image, to_lab)
+        original_height, original_width = image.shape[:2]
+
+        # Dimensiones pares (reflejando una fila o columna) para que cada píxel
+        # de media resolución promedie exactamente un bloque 2x2
+        lab = cv2.copyMakeBorder(lab, 0, original_height % 2, 0, original_width % 2, cv2.BORDER_REFLECT_101)
+        height, width = lab.shape[:2]
+        half_size = (width // 2, height // 2)
+        small = cv2.resize(lab, half_size, interpolation=cv2.INTER_AREA)
+
+        # Promediar 2x2 píxeles divide entre dos la desviación del ruido,
+        # así que a media resolución basta con la mitad de fuerza
+        strength = self.h / 2
+        luma = cv2.fastNlMeansDenoising(
+            np.ascontiguousarray(small[:, :, 0]), None, h=strength,
+            templateWindowSize=self.template_window_size, searchWindowSize=self.search_window_size
+        )
+
+        # Detalle que la media resolución pierde, sin la parte de amplitud de ruido
+        full_luma = lab[:, :, 0].astype(np.float32)
+        detail = full_luma - cv2.resize(small[:, :, 0], (width, height), interpolation=cv2.INTER_LINEAR)
+        detail = np.sign(detail) * np.maximum(np.abs(detail) - strength, 0)
+        luma = cv2.resize(luma, (width, height), interpolation=cv2.INTER_LINEAR).astype(np.float32) + detail
+
+        # El ojo apenas distingue detalle de color: basta la crominancia a media resolución
+        chroma = cv2.GaussianBlur(small[:, :, 1:], (5, 5), 0)
+        chroma = cv2.resize(chroma, (width, height), interpolation=cv2.INTER_LINEAR)
+
+        lab = np.dstack([np.clip(luma, 0, 255).astype(np.uint8), chroma])
+        return cv2.cvtColor(lab[:original_height, :original_width], from_lab)
+
+    @staticmethod
+    def _lower(tier, other):
+        return TIERS[min(TIERS.index(tier), TIERS.index(other))]
+
+    @staticmethod
+    def _higher(tier, other):
+        return TIERS[max(TIERS.index(tier), TIERS.index(other))]
@@ -0,0 +1,96 @@
+"""
+Vistas derivadas (gris, HSV, LAB, gradientes) compartidas entre etapas y estadísticas
+"""
+from collections import deque
+
+import cv2
+
+
+class DerivedViews:
+    """Conversiones de una versión de imagen RGB, calculadas una sola vez y bajo demanda
+
+    Las vistas se devuelven como arrays de solo lectura: quien necesite
+    modificarlas debe trabajar sobre una copia. Si se construye con `factory`
+    en lugar de `image`, la propia imagen se materializa al pedirla por primera
+    vez (etapas fusionadas cuya salida intermedia no se calculó).
+    """
+
+    def __init__(self, image=None, factory=None):
+        self._image = image
+        self._factory = factory
+        self._views = {}
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = self._factory()
+            self._image.flags.writeable = False
+            self._factory = None
+        return self._image
+
+    def _get(self, name, factory):
+        view = self._views.get(name)
+        if view is None:
+            view = factory()
+            view.flags.writeable = False
+            self._views[name] = view
+        return view
+
+    @property
+    def gray(self):
+        return self._get('gray', lambda: cv2.cvtColor(self.image, cv2.COLOR_RGB2GRAY))
+
+    @property
+    def hsv(self):
+        return self._get('hsv', lambda: cv2.cvtColor(self.image, cv2.COLOR_RGB2HSV))
+
+    @property
+    def lab(self):
+        return self._get('lab', lambda: cv2.cvtColor(self.image, cv2.COLOR_RGB2LAB))
+
+    @property
+    def sobel_x(self):
+        return self._get('sobel_x', lambda: cv2.Sobel(self.gray, cv2.CV_64F, 1, 0, ksize=3))
+
+    @property
+    def sobel_y(self):
+        return self._get('sobel_y', lambda: cv2.Sobel(self.gray, cv2.CV_64F, 0, 1, ksize=3))
+
+    @property
+    def laplacian(self):
+        return self._get('laplacian', lambda: cv2.Laplacian(self.gray, cv2.CV_64F))
+
+    def cached_views(self):
+        """Nombres de las vistas ya calculadas"""
+        return list(self._views)
+
+
+class DerivedViewCache:
+    """Conserva las vistas de las versiones de imagen más recientes
+
+    Las entradas se identifican por la identidad del array, por lo que solo se
+    reutilizan para arrays de solo lectura (como las salidas registradas en el
+    StageStore). Cuando una etapa produce una versión nueva, la más antigua se
+    descarta.
+    """
+
+    def __init__(self, capacity=2):
+        self._entries = deque(maxlen=capacity)
+
+    def get(self, image):
+        """Devuelve las vistas de `image`, reutilizándolas si ya existen"""
+        if image.flags.writeable:
+            # Un array modificable podría cambiar después de cachear sus vistas
+            return DerivedViews(image)
+
+        for views in self._entries:
+            if views._image is image:
+                return views
+
+        views = DerivedViews(image)
+        self._entries.append(views)
+        return views
+
+    def clear(self):
+        """Invalida todas las vistas almacenadas"""
+        self._entries.clear()
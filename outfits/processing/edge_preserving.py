@@ -0,0 +1,88 @@
+"""
+Backends intercambiables del filtro preservador de bordes (cv2.edgePreservingFilter)
+"""
+import cv2
+import numpy as np
+
+from . import accelerated as accelerated_kernels
+
+
+def opencv_filter(image, flags, sigma_s, sigma_r, accelerated=True):
+    """Implementación de referencia de OpenCV"""
+    return cv2.edgePreservingFilter(image, flags=flags, sigma_s=sigma_s, sigma_r=sigma_r)
+
+
+def domain_transform_filter(image, flags, sigma_s, sigma_r, accelerated=True):
+    """Filtro recursivo de transformada de dominio con los kernels Numba
+
+    Es el mismo algoritmo que edgePreservingFilter con flags=1 (±1 nivel) a
+    la mitad de tiempo en un núcleo, y reparte las filas entre núcleos. Con
+    flags=2 (convolución normalizada) aplica igualmente el filtro recursivo.
+    Sin Numba usa la implementación de OpenCV del filtro recursivo.
+    """
+    if not (accelerated and accelerated_kernels.AVAILABLE):
+        return cv2.edgePreservingFilter(image, flags=cv2.RECURS_FILTER, sigma_s=sigma_s, sigma_r=sigma_r)
+    return accelerated_kernels.domain_transform(image, sigma_s, sigma_r)
+
+
+def guided_filter(image, flags, sigma_s, sigma_r, accelerated=True):
+    """Filtro guiado (He et al.) con la luminancia como guía, a base de boxFilter
+
+    El coste por píxel no depende del radio. Radio y regularización se
+    derivan de sigma_s y sigma_r: con las fotos de prueba, el radio que más
+    se parece al filtro recursivo crece con sigma_s·sigma_r (el filtro
+    recursivo acorta su alcance en los bordes) y eps con sigma_r².
+    """
+    radius = max(int(round(sigma_s * sigma_r / 2.5)), 1)
+    eps = (sigma_r / 4) ** 2
+    ksize = (2 * radius + 1, 2 * radius + 1)
+
+    def box(values):
+        return cv2.boxFilter(values, -1, ksize, borderType=cv2.BORDER_REFLECT)
+
+    values = image.astype(np.float32) / 255
+    guide = cv2.cvtColor(values, cv2.COLOR_RGB2GRAY)
+    guide_mean = box(guide)
+    guide_var = box(guide * guide) - guide_mean * guide_mean
+
+    result = np.empty_like(values)
+    for c in range(values.shape[2]):
+        channel = values[:, :, c]
+        channel_mean = box(channel)
+        a = (box(guide * channel) - guide_mean * channel_mean) / (guide_var + eps)
+        b = channel_mean - a * guide_mean
+        result[:, :, c] = box(a) * guide + box(b)
+
+    return np.clip(np.rint(result * 255), 0, 255).astype(np.uint8)
+
+
+def auto_filter(image, flags, sigma_s, sigma_r, accelerated=True):
+    """El backend más rápido disponible: transformada de dominio con Numba y filtro guiado sin él
+
+    Sin los kernels Numba, domain_transform ejecuta el mismo filtro recursivo
+    de OpenCV que 'opencv' y no ahorra nada; el filtro guiado solo necesita
+    OpenCV. Es el backend de los presets balanced y fast.
+    """
+    if accelerated and accelerated_kernels.AVAILABLE:
+        return accelerated_kernels.domain_transform(image, sigma_s, sigma_r)
+    return guided_filter(image, flags, sigma_s, sigma_r, accelerated)
+
+
+EDGE_PRESERVING_BACKENDS = {
+    'opencv': opencv_filter,
+    'domain_transform': domain_transform_filter,
+    'guided': guided_filter,
+    'auto': auto_filter,
+}
+
+
+def register_backend(name, function):
+    """Registra un backend: función (image, flags, sigma_s, sigma_r, accelerated) -> imagen"""
+    EDGE_PRESERVING_BACKENDS[name] = function
+
+
+def edge_preserving_filter(image, flags=1, sigma_s=50, sigma_r=0.4, backend='opencv', accelerated=True):
+    """Filtro preservador de bordes con el backend indicado"""
+    if backend not in EDGE_PRESERVING_BACKENDS:
+        raise ValueError(f"Backend de filtro preservador de bordes no soportado: {backend}")
+    return EDGE_PRESERVING_BACKENDS[backend](image, flags, sigma_s, sigma_r, accelerated)
@@ -0,0 +1,96 @@
+"""
+Motor de procesamiento sin estado, compartido por las peticiones concurrentes de un proceso
+"""
+import threading
+
+from .analysis import FacialAnalyzer, ColorAnalyzer
+from .preprocessing import ImagePreprocessor
+from .recommendation import OutfitRecommender
+from .render import RenderEngine
+from .stage_cache import StageCache
+
+
+class ProcessingContext:
+    """Resultado de una petición
+
+    `preprocessor` es el ImagePreprocessor que la procesó, con sus imágenes
+    de etapa, estadísticas y parámetros usados (y los métodos que generan
+    tablas, gráficos e informes a partir de ellos); `image` es la imagen
+    final y `summary` el resumen del procesamiento.
+    """
+
+    def __init__(self, preprocessor, image=None, summary=None):
+        self.preprocessor = preprocessor
+        self.image = image
+        self.summary = summary
+
+
+class ProcessingEngine:
+    """Configuración y analizadores compartidos por todas las peticiones
+
+    ImagePreprocessor guarda en la instancia los resultados de su último
+    procesamiento, así que no puede atender dos peticiones a la vez. El motor
+    no guarda nada de ninguna petición: cada una obtiene un preprocesador
+    nuevo con las opciones del motor (más las suyas) dentro de un
+    ProcessingContext, y comparte los analizadores, que no tienen estado.
+
+    Lo costoso de crear vive en el proceso y se reutiliza entre peticiones:
+    el clasificador de rostros y los objetos CLAHE por hilo (ver resources),
+    los kernels de las etapas lineales y las LUTs de gamma, el modelo
+    express, la caché de etapas (si se activa), el ejecutor de teselas y las arenas de
+    buffers por hilo. La configuración de matplotlib se aplica una vez.
+    """
+
+    def __init__(self, **options):
+        self.options = dict(options)
+        # Valida las opciones al crear el motor y no en la primera petición
+        ImagePreprocessor(**self.options)
+
+        self.facial_analyzer = FacialAnalyzer()
+        self.color_analyzer = ColorAnalyzer()
+        self.recommender = OutfitRecommender()
+        self.render_engine = RenderEngine()
+
+    def preprocessor(self, **overrides):
+        """Preprocesador nuevo para una petición, con las opciones del motor y `overrides`"""
+        return ImagePreprocessor(**{**self.options, **overrides})
+
+    def process(self, uploaded_file, **overrides):
+        """Procesa una imagen subida y devuelve su ProcessingContext
+
+        `overrides` sustituye opciones del motor solo para esta petición (por
+        ejemplo pipeline o stage_retention).
+        """
+        preprocessor = self.preprocessor(**overrides)
+        image, summary = preprocessor.process_upload_complete(uploaded_file)
+        return ProcessingContext(preprocessor, image, summary)
+
+
+_default_engine = None
+_default_lock = threading.Lock()
+
+
+def default_engine():
+    """Motor compartido por el proceso, con estadísticas perezosas
+
+    La caché de etapas retiene en memoria las imágenes de todas las
+    peticiones, así que solo se activa con PREPROCESSING_STAGE_CACHE = True
+    en los settings de Django, acotada a PREPROCESSING_STAGE_CACHE_MAX_BYTES
+    (256 MB por defecto). Fuera de Django no hay caché.
+    """
+    global _default_engine
+    with _default_lock:
+        if _default_engine is None:
+            _default_engine = ProcessingEngine(stats_mode='lazy', stage_cache=_settings_stage_cache())
+        return _default_engine
+
+
+def _settings_stage_cache():
+    """StageCache configurada en los settings de Django, o None si está desactivada"""
+    try:
+        from django.conf import settings
+    except ImportError:
+        return None
+    if not settings.configured or not getattr(settings, 'PREPROCESSING_STAGE_CACHE', False):
+        return None
+    return StageCache(max_bytes=getattr(settings, 'PREPROCESSING_STAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
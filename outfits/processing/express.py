@@ -0,0 +1,437 @@
+"""
+Aproximación exprés del pipeline completo: LUT de color 3D ajustada offline y un filtro separable de nitidez
+"""
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import time
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+from .lut import ColorLUT3D
+
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(__file__), 'data', 'express_full.npz')
+
+# Extensiones de imagen que se leen del corpus local
+CORPUS_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+
+
+class ExpressModel:
+    """Aproximación aprendida del resto del pipeline en dos pasadas
+
+    Sustituye las etapas posteriores a `input_op` (por defecto 'clahe'): las
+    anteriores (redimensionado, normalización, gamma adaptativa y CLAHE) se
+    ejecutan tal cual en el preset 'express', porque dependen de la imagen y
+    cuestan poco; CLAHE es además la mayor parte del contraste local, que una
+    LUT sola no puede reproducir. Sobre su salida se aplica una LUT de color
+    3D, elegida según la gamma de la imagen (oscura, normal o clara; la común
+    si no hubo ejemplos suficientes de ese tipo), y un filtro separable de
+    nitidez, sin redondear entre ambos.
+
+    `tables` es {gamma o None: tabla (size * size, size, 3)} y `report` las
+    métricas del ajuste (ver fit_express_model).
+    """
+
+    def __init__(self, tables, kernel_x, kernel_y, pipeline='full', input_op='clahe', report=None):
+        self.luts = {gamma: ColorLUT3D.from_table(table) for gamma, table in tables.items()}
+        self.kernel_x = np.asarray(kernel_x, dtype=np.float32)
+        self.kernel_y = np.asarray(kernel_y, dtype=np.float32)
+        self.pipeline = pipeline
+        self.input_op = input_op
+        self.report = report or {}
+
+    @property
+    def lut_size(self):
+        return next(iter(self.luts.values())).size
+
+    @property
+    def radius(self):
+        return len(self.kernel_x) // 2
+
+    @property
+    def fingerprint(self):
+        """Huella de las tablas y los kernels (identifica el modelo en las claves de caché)"""
+        digest = hashlib.blake2b(digest_size=16)
+        for gamma in sorted(self.luts, key=repr):
+            digest.update(repr(gamma).encode())
+            digest.update(np.ascontiguousarray(self.luts[gamma].table).tobytes())
+        digest.update(self.kernel_x.tobytes())
+        digest.update(self.kernel_y.tobytes())
+        return digest.hexdigest()
+
+    def lut_for(self, gamma):
+        """Tabla 3D de un tipo de imagen, o la común si no se ajustó"""
+        return self.luts.get(gamma, self.luts[None])
+
+    def apply(self, image, gamma=None):
+        """Aplica el modelo a la salida uint8 de `input_op` de una imagen con esa gamma"""
+        values = self.lut_for(gamma).interpolate(image)
+        sharpened = cv2.sepFilter2D(values, -1, self.kernel_x, self.kernel_y, borderType=cv2.BORDER_REFLECT)
+        return np.clip(np.rint(sharpened), 0, 255).astype(np.uint8)
+
+    def save(self, path):
+        """Guarda el modelo en un archivo .npz (tablas, kernels y metadatos en JSON)"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        gammas = list(self.luts)
+        metadata = {
+            'pipeline': self.pipeline,
+            'input_op': self.input_op,
+            'gammas': gammas,
+            'report': self.report,
+        }
+        with open(path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                tables=np.stack([self.luts[gamma].table for gamma in gammas]),
+                kernel_x=self.kernel_x,
+                kernel_y=self.kernel_y,
+                metadata=np.array(json.dumps(metadata)),
+            )
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            tables = dict(zip(metadata['gammas'], data['tables']))
+            return cls(tables, data['kernel_x'], data['kernel_y'], metadata['pipeline'], metadata['input_op'],
+                       metadata['report'])
+
+
+@lru_cache(maxsize=8)
+def load_express_model(path=None):
+    """Modelo exprés desde `path` (por defecto, el incluido en data/), cargado una vez por ruta"""
+    path = path or DEFAULT_MODEL_PATH
+    if not os.path.exists(path):
+        raise ValueError(f"No existe el modelo exprés {path}: genéralo con python -m outfits.processing.express fit")
+    return ExpressModel.load(path)
+
+
+# ==================== CORPUS ====================
+
+def corpus_images(directory=None):
+    """Imágenes PIL RGB del corpus de ajuste
+
+    Con `directory`, las imágenes de esa carpeta (recursivamente). Sin ella,
+    las fotos de ejemplo de scikit-image que vienen con la librería, con
+    variantes oscuras, claras, con dominante de color y recortadas para
+    cubrir los tres tipos de gamma y distintas proporciones; no usa la red.
+    """
+    if directory is not None:
+        paths = sorted(
+            path for path in glob.glob(os.path.join(directory, '**', '*'), recursive=True)
+            if path.lower().endswith(CORPUS_EXTENSIONS)
+        )
+        if not paths:
+            raise ValueError(f"No hay imágenes en el corpus {directory}")
+        return [Image.open(path).convert('RGB') for path in paths]
+
+    from skimage import data
+
+    images = []
+    for name in ('astronaut', 'chelsea', 'coffee', 'rocket', 'immunohistochemistry', 'retina'):
+        try:
+            photo = getattr(data, name)()
+        except Exception:
+            continue
+        values = photo.astype(np.float64) / 255
+        height, width = photo.shape[:2]
+        variants = (
+            values,
+            values ** 2.2,
+            values ** 0.45,
+            np.clip(values * (1.1, 1.0, 0.85), 0, 1),
+            np.clip(values * (0.85, 0.95, 1.1), 0, 1),
+            values[:, :max(width * 3 // 5, 1)],
+            values[:max(height * 3 // 5, 1)],
+        )
+        images.extend(Image.fromarray(np.rint(variant * 255).astype(np.uint8)) for variant in variants)
+    return images
+
+
+def _as_upload(image):
+    """Imagen PIL como archivo en memoria, para process_upload_complete_extended"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
+
+
+def _stage_output(preprocessor, op):
+    """Salida registrada de la primera etapa de la operación `op` en el último procesamiento"""
+    stage = next(step.stage for step in preprocessor.pipeline.steps if step.op.name == op)
+    return np.asarray(preprocessor.stage_images[stage])
+
+
+def _pipeline_pair(preprocessor, image, input_op):
+    """Entrada del modelo (salida de `input_op`), salida del pipeline y gamma elegida"""
+    final, _ = preprocessor.process_upload_complete_extended(_as_upload(image))
+    return _stage_output(preprocessor, input_op), np.asarray(final), preprocessor.estimated_parameters['gamma']
+
+
+# ==================== AJUSTE ====================
+
+def _trilinear(lut, pixels):
+    """Índices de los 8 nodos vecinos y pesos trilineales de cada píxel (los de ColorLUT3D)"""
+    size = lut.size
+    cells, fractions = [], []
+    for channel in range(3):
+        position = lut.positions(pixels[:, channel]).astype(np.float64)
+        cell = np.minimum(np.floor(position), size - 2).astype(np.int64)
+        cells.append(cell)
+        fractions.append(position - cell)
+
+    indices, weights = [], []
+    for dr in (0, 1):
+        for dg in (0, 1):
+            for db in (0, 1):
+                indices.append(((cells[0] + dr) * size + cells[1] + dg) * size + cells[2] + db)
+                weights.append(
+                    (fractions[0] if dr else 1 - fractions[0])
+                    * (fractions[1] if dg else 1 - fractions[1])
+                    * (fractions[2] if db else 1 - fractions[2])
+                )
+    return np.stack(indices, axis=1), np.stack(weights, axis=1)
+
+
+def _smoothness(size):
+    """Suma de diferencias primeras al cuadrado entre nodos vecinos de la rejilla (matriz)"""
+    nodes = np.arange(size ** 3).reshape(size, size, size)
+    operators = []
+    for axis in range(3):
+        first = np.take(nodes, range(size - 1), axis=axis).ravel()
+        second = np.take(nodes, range(1, size), axis=axis).ravel()
+        count = len(first)
+        rows = np.concatenate([np.arange(count), np.arange(count)])
+        operators.append(sparse.csr_matrix(
+            (np.concatenate([-np.ones(count), np.ones(count)]), (rows, np.concatenate([first, second]))),
+            shape=(count, size ** 3)
+        ))
+    difference = sparse.vstack(operators)
+    return (difference.T @ difference).tocsr()
+
+
+def _fit_table(samples, size, smoothness):
+    """Tabla 3D por mínimos cuadrados regularizados con los pares (índices, pesos, destino)"""
+    nodes = size ** 3
+    normal = sparse.csr_matrix((nodes, nodes))
+    rhs = np.zeros((nodes, 3))
+    for indices, weights, target in samples:
+        rows = np.repeat(indices, 8, axis=1).ravel()
+        cols = np.tile(indices, (1, 8)).ravel()
+        products = (weights[:, :, None] * weights[:, None, :]).ravel()
+        normal = normal + sparse.csr_matrix((products, (rows, cols)), shape=(nodes, nodes))
+        for channel in range(3):
+            rhs[:, channel] += np.bincount(indices.ravel(), (weights * target[:, channel:channel + 1]).ravel(),
+                                           minlength=nodes)
+
+    # La regularización rellena los colores sin ejemplos y suaviza la tabla
+    scale = normal.diagonal().mean()
+    system = (normal + smoothness * scale * _smoothness(size)).tocsc()
+    table = np.column_stack([spsolve(system, rhs[:, channel]) for channel in range(3)])
+    return np.clip(table, 0, 255).reshape(size * size, size, 3).astype(np.float32)
+
+
+def _fit_kernel(pairs, radius, samples_per_image, rng, iterations=10):
+    """Kernel separable (x, y) que mejor lleva la salida de la LUT a la del pipeline
+
+    Los realces del pipeline no son separables, así que la aproximación de
+    rango 1 del kernel 2D óptimo puede quedar lejos; se parte de ella y se
+    ajustan por mínimos cuadrados alternos el kernel horizontal y el vertical.
+    """
+    width = 2 * radius + 1
+    patches, targets = [], []
+    for values, target in pairs:
+        padded = cv2.copyMakeBorder(values, radius, radius, radius, radius, cv2.BORDER_REFLECT)
+        height, image_width = values.shape[:2]
+        ys = rng.integers(0, height, samples_per_image)
+        xs = rng.integers(0, image_width, samples_per_image)
+        channels = rng.integers(0, 3, samples_per_image)
+        patches.append(np.stack([
+            np.stack([padded[ys + dy, xs + dx, channels] for dx in range(width)], axis=1)
+            for dy in range(width)
+        ], axis=1))
+        targets.append(target[ys, xs, channels].astype(np.float64))
+    patches = np.concatenate(patches).astype(np.float64)
+    targets = np.concatenate(targets)
+
+    kernel, *_ = np.linalg.lstsq(patches.reshape(len(patches), -1), targets, rcond=None)
+    u, s, vt = np.linalg.svd(kernel.reshape(width, width))
+    kernel_y, kernel_x = u[:, 0] * np.sqrt(s[0]), vt[0] * np.sqrt(s[0])
+    for _ in range(iterations):
+        kernel_x, *_ = np.linalg.lstsq(np.einsum('nyx,y->nx', patches, kernel_y), targets, rcond=None)
+        kernel_y, *_ = np.linalg.lstsq(np.einsum('nyx,x->ny', patches, kernel_x), targets, rcond=None)
+
+    # Misma ganancia en las dos direcciones
+    gain = np.sqrt(abs(kernel_x.sum() * kernel_y.sum()))
+    return kernel_x * gain / kernel_x.sum(), kernel_y * gain / kernel_y.sum()
+
+
+def fit_express_model(images, pipeline='full', lut_size=17, radius=2, smoothness=0.05, input_op='clahe',
+                      samples_per_image=40000, min_samples=100000, seed=0, preprocessor_kwargs=None):
+    """Ajusta un ExpressModel que aproxima el pipeline sobre `images` (PIL RGB)
+
+    Cada imagen pasa por el pipeline completo; la LUT 3D se ajusta con una
+    muestra de `samples_per_image` píxeles por imagen (una tabla por gamma
+    con al menos `min_samples` muestras, más la común) y el kernel con la
+    salida de la LUT sobre las mismas imágenes. Todo se ejecuta en CPU.
+    """
+    from .preprocessing import ImagePreprocessor
+
+    rng = np.random.default_rng(seed)
+    preprocessor = ImagePreprocessor(stats_mode='lazy', pipeline=pipeline, **(preprocessor_kwargs or {}))
+    grid = ColorLUT3D.from_table(np.zeros((lut_size * lut_size, lut_size, 3), dtype=np.float32))
+
+    examples = []
+    samples = {}
+    for image in images:
+        source, final, gamma = _pipeline_pair(preprocessor, image, input_op)
+        examples.append((source, final, gamma))
+        pixels = source.reshape(-1, 3)
+        chosen = rng.choice(len(pixels), min(samples_per_image, len(pixels)), replace=False)
+        indices, weights = _trilinear(grid, pixels[chosen])
+        samples.setdefault(gamma, []).append((indices, weights, final.reshape(-1, 3)[chosen].astype(np.float64)))
+
+    tables = {None: _fit_table([entry for group in samples.values() for entry in group], lut_size, smoothness)}
+    for gamma, group in samples.items():
+        if sum(len(entry[0]) for entry in group) >= min_samples:
+            tables[gamma] = _fit_table(group, lut_size, smoothness)
+
+    model = ExpressModel(tables, [1], [1], pipeline, input_op)
+    pairs = [(model.lut_for(gamma).interpolate(source), final) for source, final, gamma in examples]
+    model.kernel_x, model.kernel_y = (
+        kernel.astype(np.float32) for kernel in _fit_kernel(pairs, radius, samples_per_image, rng)
+    )
+    return model
+
+
+# ==================== EVALUACIÓN ====================
+
+def evaluate_express_model(model, images, preprocessor_kwargs=None, repeats=1):
+    """Fidelidad y velocidad del modo exprés frente al pipeline que aproxima
+
+    Procesa cada imagen con process_upload_complete_extended en los presets
+    del modelo y 'express' (estadísticas perezosas, solo la imagen final) y
+    devuelve PSNR y SSIM (media y peor imagen), el tiempo medio de cada uno,
+    el de la etapa exprés y la aceleración de extremo a extremo.
+    """
+    from .preprocessing import ImagePreprocessor
+    from .quality import psnr, ssim
+
+    kwargs = {'stats_mode': 'lazy', **(preprocessor_kwargs or {})}
+    full = ImagePreprocessor(pipeline=model.pipeline, stage_retention='final', **kwargs)
+    express = ImagePreprocessor(pipeline='express', express_model=model, **kwargs)
+
+    # Primera llamada fuera de la medida (compilación de kernels y cachés)
+    full.process_upload_complete_extended(_as_upload(images[0]))
+    express.process_upload_complete_extended(_as_upload(images[0]))
+
+    psnrs, ssims = [], []
+    full_time = express_time = stage_time = 0.0
+    for image in images:
+        # La codificación de la subida queda fuera de la medida
+        upload = _as_upload(image).getvalue()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            reference, _ = full.process_upload_complete_extended(io.BytesIO(upload))
+            full_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            output, _ = express.process_upload_complete_extended(io.BytesIO(upload))
+            express_time += time.perf_counter() - start
+
+            # Solo la etapa aprendida, sobre la misma entrada
+            source = _stage_output(express, model.input_op)
+            start = time.perf_counter()
+            model.apply(source, express.estimated_parameters['gamma'])
+            stage_time += time.perf_counter() - start
+        reference, output = np.asarray(reference), np.asarray(output)
+        psnrs.append(psnr(reference, output))
+        ssims.append(ssim(reference, output))
+
+    runs = len(images) * repeats
+    return {
+        'images': len(images),
+        'psnr_mean': float(np.mean(psnrs)),
+        'psnr_min': float(np.min(psnrs)),
+        'ssim_mean': float(np.mean(ssims)),
+        'ssim_min': float(np.min(ssims)),
+        'full_ms': full_time / runs * 1000,
+        'express_ms': express_time / runs * 1000,
+        'express_stage_ms': stage_time / runs * 1000,
+        'speedup': full_time / express_time if express_time > 0 else float('inf'),
+    }
+
+
+def _split(images, holdout):
+    """Separa una imagen de cada `holdout` para evaluar con imágenes no vistas en el ajuste"""
+    if holdout <= 1:
+        return images, images
+    train = [image for i, image in enumerate(images) if i % holdout != holdout - 1]
+    test = [image for i, image in enumerate(images) if i % holdout == holdout - 1]
+    return train, test or train
+
+
+def _print_report(report):
+    for split, metrics in report.items():
+        print(f"{split:8s} {metrics['images']:3d} imágenes  PSNR {metrics['psnr_mean']:6.2f} dB "
+              f"(mín {metrics['psnr_min']:6.2f})  SSIM {metrics['ssim_mean']:.4f} (mín {metrics['ssim_min']:.4f})  "
+              f"{metrics['full_ms']:7.1f} ms -> {metrics['express_ms']:6.1f} ms "
+              f"(etapa {metrics['express_stage_ms']:.1f} ms)  x{metrics['speedup']:.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ajusta y evalúa la aproximación exprés del pipeline")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fit = commands.add_parser('fit', help="ajusta el modelo con un corpus local y lo guarda")
+    fit.add_argument('--corpus', help="carpeta con imágenes (por defecto, las de ejemplo de scikit-image)")
+    fit.add_argument('--output', default=DEFAULT_MODEL_PATH)
+    fit.add_argument('--pipeline', default='full')
+    fit.add_argument('--lut-size', type=int, default=17)
+    fit.add_argument('--radius', type=int, default=2)
+    fit.add_argument('--smoothness', type=float, default=0.05)
+    fit.add_argument('--input-op', default='clahe', help="última etapa exacta antes de la aproximación")
+    fit.add_argument('--holdout', type=int, default=4, help="evalúa con una de cada N imágenes, fuera del ajuste")
+
+    report = commands.add_parser('report', help="evalúa un modelo guardado con un corpus")
+    report.add_argument('--corpus')
+    report.add_argument('--model', default=DEFAULT_MODEL_PATH)
+
+    args = parser.parse_args(argv)
+    images = corpus_images(args.corpus)
+
+    if args.command == 'fit':
+        train, test = _split(images, args.holdout)
+        model = fit_express_model(train, args.pipeline, args.lut_size, args.radius, args.smoothness, args.input_op)
+        model.report = {
+            'corpus': args.corpus or 'scikit-image',
+            'lut_size': args.lut_size,
+            'radius': args.radius,
+            'smoothness': args.smoothness,
+            'input_op': args.input_op,
+            'train': evaluate_express_model(model, train),
+            'holdout': evaluate_express_model(model, test),
+        }
+        model.save(args.output)
+        _print_report({'train': model.report['train'], 'holdout': model.report['holdout']})
+        print(f"Modelo guardado en {args.output}")
+    else:
+        model = ExpressModel.load(args.model)
+        metrics = evaluate_express_model(model, images)
+        _print_report({'corpus': metrics})
+
+
+if __name__ == "__main__":
+    main()
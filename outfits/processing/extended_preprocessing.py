@@ -12,10 +12,13 @@ sys.path.append('/workspaces/outfit-ai')
 # Importar la clase base si existe, o crear una versión simplificada
 try:
     from outfits.processing.preprocessing import ImagePreprocessor
+    from outfits.processing import accelerated as accelerated_kernels
+    from outfits.processing.edge_preserving import edge_preserving_filter
 except ImportError:
     class ImagePreprocessor:
-        def __init__(self):
+        def __init__(self, accelerated=False):
             self.processing_stats = {}
+            self.accelerated = False
         
         def calculate_image_statistics(self, image, stage_name):
             return {}
@@ -24,8 +27,8 @@ except ImportError:
 class ExtendedImagePreprocessor(ImagePreprocessor):
     """Extiende el preprocesador básico con opciones avanzadas"""
     
-    def __init__(self):
-        super().__init__()
+    def __init__(self, accelerated=True):
+        super().__init__(accelerated=accelerated)
         self.advanced_options = {
             # Opciones que se pueden agregar al pipeline
             'edge_preserving_filter': False,
@@ -38,10 +41,20 @@ class ExtendedImagePreprocessor(ImagePreprocessor):
             'noise_reduction_advanced': False
         }
     
-    def apply_edge_preserving_filter(self, image):
+    def _tiled(self, function, image, halo):
+        """Aplica un filtro de vecindario por teselas si el ejecutor está disponible"""
+        executor = getattr(self, 'tile_executor', None)
+        if executor is None:
+            return function(image)
+        return executor.map(function, image, halo)
+    
+    def apply_edge_preserving_filter(self, image, backend='opencv'):
         """Filtro que preserva bordes mientras suaviza áreas uniformes"""
         # Normalizado de filtro edge-preserving
-        result = cv2.edgePreservingFilter(image, flags=2, sigma_s=50, sigma_r=0.4)
+        if backend == 'opencv':
+            result = cv2.edgePreservingFilter(image, flags=2, sigma_s=50, sigma_r=0.4)
+        else:
+            result = edge_preserving_filter(image, 2, 50, 0.4, backend, self.accelerated)
         
         # Estadísticas para esta etapa
         self.calculate_image_statistics(
@@ -53,7 +66,7 @@ class ExtendedImagePreprocessor(ImagePreprocessor):
     
     def apply_non_local_means_denoising(self, image):
         """Denoising avanzado que preserva texturas finas"""
-        result = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
+        result = self._tiled(lambda tile: cv2.fastNlMeansDenoisingColored(tile, None, 10, 10, 7, 21), image, 3 + 10)
         
         self.calculate_image_statistics(
             Image.fromarray(cv2.cvtColor(result, cv2.COLOR_BGR2RGB)), 
@@ -127,19 +140,30 @@ class ExtendedImagePreprocessor(ImagePreprocessor):
         texture_mask = laplacian_abs > threshold
         
         # Aplicar suavizado bilateral solo en áreas texturizadas
-        smoothed = cv2.bilateralFilter(image, 15, 80, 80)
+        smoothed = self._tiled(lambda tile: cv2.bilateralFilter(tile, 15, 80, 80), image, 7)
         
-        # Mezclar usando la máscara
-        result = image.copy().astype(np.float32)
+        # Mezclar usando la máscara, en buffers reutilizables y para los tres
+        # canales a la vez
         smoothing_strength = 0.6
-        
-        for i in range(3):  # Para cada canal RGB
-            result[:,:,i] = np.where(texture_mask, 
-                                   result[:,:,i] * (1 - smoothing_strength) + 
-                                   smoothed[:,:,i] * smoothing_strength,
-                                   result[:,:,i])
-        
-        result = np.clip(result, 0, 255).astype(np.uint8)
+        if self.accelerated:
+            result = accelerated_kernels.masked_blend(image, smoothed, texture_mask, smoothing_strength)
+            self.calculate_image_statistics(
+                Image.fromarray(cv2.cvtColor(result, cv2.COLOR_BGR2RGB)), 
+                'wrinkle_smoothed'
+            )
+            return result
+        
+        weighted = self.buffers.get('wrinkle_weighted', image.shape, np.float32)
+        blended = self.buffers.get('wrinkle_blended', image.shape, np.float64)
+        np.multiply(image, np.float32(1 - smoothing_strength), out=weighted, dtype=np.float32)
+        np.multiply(smoothed, smoothing_strength, out=blended)
+        np.add(weighted, blended, out=blended)
+        
+        result = self.buffers.get('wrinkle_result', image.shape, np.float32)
+        np.copyto(result, image)
+        np.copyto(result, blended, casting='same_kind', where=texture_mask[:, :, None])
+        
+        result = np.clip(result, 0, 255, out=result).astype(np.uint8)
         
         self.calculate_image_statistics(
             Image.fromarray(cv2.cvtColor(result, cv2.COLOR_BGR2RGB)), 
@@ -0,0 +1,54 @@
+"""
+Omisión de etapas cuyo efecto previsto es despreciable, a partir de métricas baratas
+"""
+
+
+class StageGate:
+    """Regla de omisión para una operación del pipeline
+
+    La etapa se omite cuando la métrica `metric` de la imagen de entrada
+    (una de las que calcula calculate_image_statistics) queda por debajo de
+    `threshold`. `reason` es el texto que se devuelve en el resumen.
+    """
+
+    def __init__(self, op, metric, threshold, reason):
+        self.op = op
+        self.metric = metric
+        self.threshold = threshold
+        self.reason = reason
+
+    def should_skip(self, stats):
+        return stats[self.metric] < self.threshold
+
+
+# Umbrales calibrados con la entrada real de cada etapa en el preset 'full'
+# (muestras 800x600 suavizadas con ruido gaussiano añadido de sigma 0 a 15):
+# - Con noise_level < 3 (sigma <= 1.5) NLM cambia la imagen en unos 3 niveles
+#   de media, casi todo textura fina; con sigma 5 ya son 6 niveles.
+# - Tras el filtro preservador de bordes, el unsharp mask cambia menos de
+#   0.3 niveles de media mientras blur_metric < 40.
+# - Multiplicar la saturación por 1.15 mueve el canal S menos de 1.2 niveles
+#   con saturation_avg < 8 (imágenes casi grises).
+DEFAULT_GATES = (
+    StageGate('nlm_denoise', 'noise_level', 3.0, 'Ruido bajo: la reducción de ruido no tendría efecto apreciable'),
+    StageGate('bilateral_denoise', 'noise_level', 3.0, 'Ruido bajo: la reducción de ruido no tendría efecto apreciable'),
+    StageGate('unsharp_mask', 'blur_metric', 40.0, 'Sin detalle que realzar: el enfoque no tendría efecto apreciable'),
+    StageGate('saturation', 'saturation_avg', 8.0, 'Imagen casi gris: aumentar la saturación no tendría efecto'),
+)
+
+
+class StageGating:
+    """Conjunto de reglas de omisión, como máximo una por operación"""
+
+    def __init__(self, gates=DEFAULT_GATES):
+        self.gates = {gate.op: gate for gate in gates}
+
+    def applies_to(self, op_name):
+        return op_name in self.gates
+
+    def check(self, op_name, stats):
+        """Motivo de la omisión si la etapa debe saltarse, o None si debe ejecutarse"""
+        gate = self.gates.get(op_name)
+        if gate is not None and gate.should_skip(stats):
+            return gate.reason
+        return None
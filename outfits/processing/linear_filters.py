@@ -0,0 +1,186 @@
+"""
+Composición de etapas lineales (convolución + mezcla) en un único filtro
+"""
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from scipy.signal import convolve2d
+
+
+def _constant(array):
+    """Array compartido entre etapas y peticiones: de solo lectura"""
+    array.flags.writeable = False
+    return array
+
+
+# Kernels 3x3 de las etapas de textura y de realce, creados una sola vez
+TEXTURE_KERNEL = _constant(np.array([[-0.5, -1, -0.5],
+                                     [-1, 7, -1],
+                                     [-0.5, -1, -0.5]]))
+SHARPEN_KERNEL = _constant(np.array([[-1, -1, -1],
+                                     [-1, 9, -1],
+                                     [-1, -1, -1]], dtype=np.float64))
+
+
+def identity_kernel(size):
+    """Kernel delta de tamaño impar"""
+    kernel = np.zeros((size, size), dtype=np.float64)
+    kernel[size // 2, size // 2] = 1.0
+    return kernel
+
+
+@lru_cache(maxsize=32)
+def gaussian_kernel(ksize, sigma):
+    """Kernel gaussiano 2D equivalente al de cv2.GaussianBlur (compartido, de solo lectura)"""
+    if ksize <= 0:
+        # Misma regla que OpenCV para imágenes uint8 cuando ksize=(0, 0)
+        ksize = int(round(sigma * 3 * 2 + 1)) | 1
+    g = cv2.getGaussianKernel(ksize, sigma)
+    return _constant(g @ g.T)
+
+
+def pad_kernel(kernel, size):
+    """Centra un kernel en una matriz cuadrada de lado `size`"""
+    pad = (size - kernel.shape[0]) // 2
+    return np.pad(kernel, pad)
+
+
+def compose_kernels(*kernels):
+    """Kernel único equivalente a aplicar los filtros (correlaciones) en orden"""
+    composed = np.ones((1, 1), dtype=np.float64)
+    for kernel in kernels:
+        composed = convolve2d(composed, kernel, mode='full')
+    return composed
+
+
+# Coste fijo de una pasada completa sobre la imagen, en taps equivalentes
+# (lectura y escritura del buffer), para el modelo de coste de composición
+PASS_OVERHEAD = 4
+
+
+class LinearStage:
+    """Etapa lineal: filtro 2D mezclado con su entrada, out = a·img + b·filtro(img)
+
+    `native_taps` y `native_passes` describen el coste de la forma original de
+    la etapa; `native` es la función que la aplica de esa forma. Si el filtro
+    tiene pesos negativos su salida intermedia puede saturar en uint8
+    (`saturates_intermediate`), y entonces la versión compuesta no es
+    equivalente a la original.
+    """
+
+    def __init__(self, name, kernel, image_weight, filter_weight, native_taps, native_passes, native=None):
+        self.name = name
+        size = kernel.shape[0]
+        self.kernel = image_weight * identity_kernel(size) + filter_weight * kernel
+        self.native_cost = native_taps + PASS_OVERHEAD * native_passes
+        self.native = native
+        self.saturates_intermediate = bool((kernel < 0).any())
+
+
+def unsharp_mask_stage(sigma=2.0, amount=0.5, native=None):
+    """sharpen_image: GaussianBlur separable + addWeighted"""
+    blur = gaussian_kernel(0, sigma)
+    return LinearStage('unsharp_mask', blur, 1 + amount, -amount, 2 * blur.shape[0] + 2, 3, native)
+
+
+def texture_stage(weight=0.25, native=None):
+    """_enhance_texture: filter2D 3x3 + addWeighted"""
+    return LinearStage('texture', TEXTURE_KERNEL, 1 - weight, weight, 9 + 2, 2, native)
+
+
+def smoothing_stage(weight=0.2, sigma=0.5, native=None):
+    """_final_optimization: GaussianBlur 3x3 + addWeighted"""
+    return LinearStage('smoothing', gaussian_kernel(3, sigma), 1 - weight, weight, 6 + 2, 3, native)
+
+
+def sharpen_blend_stage(weight=0.3, native=None):
+    """enhance_image_advanced: filter2D de realce 3x3 + addWeighted"""
+    return LinearStage('sharpen_blend', SHARPEN_KERNEL, 1 - weight, weight, 9 + 2, 2, native)
+
+
+class ComposedFilter:
+    """Aplica una secuencia de etapas lineales adyacentes con una sola pasada de filtro
+
+    Si el kernel compuesto resulta más caro que las formas originales (por
+    ejemplo, un desenfoque gaussiano ancho deja de ser separable al sumarle la
+    identidad), las etapas se aplican por separado con su función `native`.
+
+    Tolerancia: la cadena original redondea y satura a uint8 después de cada
+    filtro y de cada mezcla; el filtro compuesto solo redondea al final. Si
+    ningún filtro intermedio puede saturar, la diferencia es de ±1 nivel por
+    redondeo. Con `tolerant=True` también se componen filtros de realce cuya
+    salida intermedia satura: en bordes muy contrastados la salida compuesta
+    conserva el valor lineal sin recortar y puede diferir en decenas de
+    niveles. En los bordes de la imagen el reflejo se aplica una sola vez en
+    lugar de en cada etapa.
+    """
+
+    def __init__(self, stages, tolerant=False):
+        self.stages = list(stages)
+        self.tolerant = tolerant
+        self.kernel = compose_kernels(*(stage.kernel for stage in self.stages))
+        self._separable = self._separable_factors(self.kernel)
+
+    @property
+    def composed_cost(self):
+        """Coste de la pasada única con el kernel compuesto"""
+        if self._separable is not None:
+            return 2 * self.kernel.shape[0] + 2 * PASS_OVERHEAD
+        return self.kernel.size + PASS_OVERHEAD
+
+    @property
+    def native_cost(self):
+        """Coste de aplicar cada etapa con su forma original"""
+        return sum(stage.native_cost for stage in self.stages)
+
+    @property
+    def uses_composed_kernel(self):
+        natives_available = all(stage.native is not None for stage in self.stages)
+        if not natives_available:
+            return True
+        if not self.tolerant and any(stage.saturates_intermediate for stage in self.stages):
+            return False
+        return self.composed_cost <= self.native_cost
+
+    @property
+    def cost(self):
+        return self.composed_cost if self.uses_composed_kernel else self.native_cost
+
+    def apply(self, image):
+        """Aplica el grupo con la forma más barata"""
+        if not self.uses_composed_kernel:
+            for stage in self.stages:
+                image = stage.native(image)
+            return image
+
+        if self._separable is not None:
+            kx, ky = self._separable
+            return cv2.sepFilter2D(image, -1, kx, ky)
+        return cv2.filter2D(image, -1, self.kernel)
+
+    @staticmethod
+    def _separable_factors(kernel, tolerance=1e-6):
+        u, s, vt = np.linalg.svd(kernel)
+        if len(s) > 1 and s[1] > tolerance * s[0]:
+            return None
+        scale = np.sqrt(s[0])
+        return vt[0] * scale, u[:, 0] * scale
+
+
+def plan_linear_chain(stages, tolerant=False):
+    """Agrupa etapas lineales adyacentes solo cuando componerlas reduce el coste
+
+    Devuelve una lista de ComposedFilter que, aplicados en orden, equivalen a
+    la cadena (dentro de la tolerancia documentada en ComposedFilter).
+    """
+    groups = []
+    for stage in stages:
+        single = ComposedFilter([stage], tolerant)
+        if groups:
+            merged = ComposedFilter(groups[-1].stages + [stage], tolerant)
+            if merged.uses_composed_kernel and merged.cost <= groups[-1].cost + single.cost:
+                groups[-1] = merged
+                continue
+        groups.append(single)
+    return groups
@@ -0,0 +1,124 @@
+"""
+Tablas de consulta (LUT) para fusionar etapas puntuales del preprocesamiento
+"""
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+
+# Coeficientes de luminancia que usa cv2.COLOR_RGB2GRAY
+GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+@lru_cache(maxsize=64)
+def gamma_lut(gamma):
+    """LUT de corrección gamma (256 entradas), construida una sola vez por valor de gamma"""
+    lut = (((np.arange(256) / 255.0) ** gamma) * 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def minmax_lut(lo, hi):
+    """LUT equivalente a cv2.normalize(..., 0, 255, cv2.NORM_MINMAX) para una imagen con rango [lo, hi]
+
+    Los valores dentro del rango se obtienen normalizando con OpenCV la rampa
+    lo..hi, de modo que el redondeo coincide con el de la etapa original.
+    """
+    lut = np.zeros(256, dtype=np.uint8)
+    ramp = np.arange(lo, hi + 1, dtype=np.uint8).reshape(-1, 1)
+    lut[lo:hi + 1] = cv2.normalize(ramp, None, 0, 255, cv2.NORM_MINMAX).ravel()
+    lut[hi + 1:] = lut[hi]
+    return lut
+
+
+def compose_luts(*luts):
+    """Compone LUTs 1D en orden de aplicación: compose_luts(a, b)[v] == b[a[v]]"""
+    composed = np.arange(256, dtype=np.uint8)
+    for lut in luts:
+        composed = lut[composed]
+    return composed
+
+
+def histogram_range(histogram):
+    """Mínimo y máximo ocupados de un histograma de 256 niveles"""
+    occupied = np.flatnonzero(histogram)
+    return int(occupied[0]), int(occupied[-1])
+
+
+def mapped_gray_mean(histograms, lut):
+    """Media de gris estimada tras aplicar `lut` a una imagen con estos histogramas por canal
+
+    cv2.cvtColor redondea cada píxel, así que la estimación puede diferir de la
+    media exacta en menos de medio nivel.
+    """
+    n = histograms[0].sum()
+    means = histograms @ lut.astype(np.float64) / n
+    return float(np.dot(GRAY_WEIGHTS, means))
+
+
+class ColorLUT3D:
+    """LUT de color 3D con interpolación trilineal para transformaciones entre canales
+
+    La tabla se evalúa en una rejilla de `size`³ colores enteros (0..255) y se
+    aplica con dos pasadas de cv2.remap (interpolación bilineal en G y B)
+    mezcladas según la fracción de R.
+    """
+
+    def __init__(self, transform, size=33):
+        self.size = size
+
+        # Puntos de la rejilla redondeados a enteros para poder evaluar etapas uint8
+        self.grid_points = np.rint(np.linspace(0, 255, size)).astype(np.uint8)
+
+        r, g, b = np.meshgrid(self.grid_points, self.grid_points, self.grid_points, indexing='ij')
+        grid = np.stack([r, g, b], axis=-1).reshape(size * size, size, 3)
+
+        # Filas: índice R * size + índice G; columnas: índice B
+        self.table = transform(np.ascontiguousarray(grid)).astype(np.float32)
+
+        # Posición continua en la rejilla de cada valor 0..255
+        levels = np.arange(256, dtype=np.float64)
+        cell = np.clip(np.searchsorted(self.grid_points, levels, side='right') - 1, 0, size - 2)
+        lower = self.grid_points[cell].astype(np.float64)
+        upper = self.grid_points[cell + 1].astype(np.float64)
+        fraction = (levels - lower) / (upper - lower)
+
+        self._position = (cell + fraction).astype(np.float32)
+        self._r_cell = (np.floor(cell + fraction).clip(0, size - 1) * size).astype(np.float32)
+        self._r_fraction = (cell + fraction - np.floor(cell + fraction)).astype(np.float32)
+
+    @classmethod
+    def from_table(cls, table):
+        """LUT a partir de una tabla ya evaluada de forma (size * size, size, 3)"""
+        table = np.asarray(table, dtype=np.float32)
+        return cls(lambda grid: table, size=table.shape[1])
+
+    def positions(self, values):
+        """Posición continua en la rejilla de cada valor uint8 (la que usa la interpolación)"""
+        return self._position[values]
+
+    def interpolate(self, image, input_lut=None):
+        """Valores interpolados (float32) para una imagen uint8 de tres canales
+
+        `input_lut` es una LUT 1D uint8 que se aplica antes a cada canal; se
+        compone con las tablas de posición, así que no añade pasadas.
+        """
+        position, r_cell, r_fraction = self._position, self._r_cell, self._r_fraction
+        if input_lut is not None:
+            position, r_cell, r_fraction = position[input_lut], r_cell[input_lut], r_fraction[input_lut]
+        r, g, b = cv2.split(image)
+
+        map_x = cv2.LUT(b, position)
+        map_y0 = cv2.add(cv2.LUT(r, r_cell), cv2.LUT(g, position))
+        map_y1 = cv2.add(map_y0, float(self.size))
+        r_fraction = cv2.LUT(r, r_fraction)
+
+        low = cv2.remap(self.table, map_x, map_y0, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        high = cv2.remap(self.table, map_x, map_y1, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+        return low + (high - low) * r_fraction[:, :, None]
+
+    def apply(self, image, input_lut=None):
+        """Aplica la LUT a una imagen uint8 de tres canales"""
+        return np.clip(np.rint(self.interpolate(image, input_lut)), 0, 255).astype(np.uint8)
@@ -0,0 +1,87 @@
+"""
+Registro congelado de los parámetros globales de un procesamiento (estimación y aplicación por separado)
+"""
+from collections.abc import Mapping
+
+import numpy as np
+
+
+# Parámetros que las etapas calculan a partir de todos los píxeles de su entrada
+PARAMETERS = {
+    'border_color': 'color de relleno del lienzo: media de los píxeles del borde (BGR)',
+    'normalize': 'rango (mín, máx) de la normalización de color',
+    'gamma': 'gamma elegida según el brillo medio',
+    'color_correction': 'rango (mín, máx) del canal L en la corrección de color',
+    'white_balance': 'medias (a, b) en LAB del balance de blancos',
+    'issue_brightness': 'brillo medio en detect_and_correct_issues',
+    'issue_contrast': 'desviación típica en detect_and_correct_issues',
+    'issue_blur': 'varianza del laplaciano en detect_and_correct_issues',
+    'issue_saturation': 'saturación media en detect_and_correct_issues',
+}
+
+# Parámetros que apenas cambian con la resolución: los rangos mín/máx se
+# estrechan al reducir la imagen y la varianza del laplaciano crece
+SCALE_INVARIANT = ('border_color', 'gamma', 'white_balance', 'issue_brightness', 'issue_saturation')
+
+
+def _freeze(value):
+    """Convierte escalares y arrays NumPy en tipos de Python inmutables"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class GlobalParameters(Mapping):
+    """Parámetros globales estimados una vez y fijados para las ejecuciones posteriores
+
+    Se obtiene con ImagePreprocessor.estimate_global_parameters (el pipeline
+    sobre un nivel reducido de la imagen) y se pasa a
+    process_upload_complete_extended para aplicar las etapas a resolución
+    completa sin volver a recorrer la imagen en cada etapa global. El mismo
+    registro sirve para reprocesar recortes o resoluciones mayores con las
+    mismas decisiones. Las claves son las de PARAMETERS; `source_size` es
+    el tamaño de la imagen leída para estimarlos y `estimation_size` el
+    tamaño objetivo de ese nivel.
+    """
+
+    def __init__(self, values, source_size=None, estimation_size=None):
+        unknown = set(values) - set(PARAMETERS)
+        if unknown:
+            raise ValueError(f"Parámetros globales no soportados: {sorted(unknown)}")
+        self._values = {name: _freeze(value) for name, value in values.items()}
+        self.source_size = _freeze(source_size)
+        self.estimation_size = _freeze(estimation_size)
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"GlobalParameters({self._values!r})"
+
+    def subset(self, names):
+        """Registro con solo los parámetros de `names` que estén presentes"""
+        values = {name: value for name, value in self._values.items() if name in names}
+        return GlobalParameters(values, self.source_size, self.estimation_size)
+
+    def to_dict(self):
+        return {
+            'parameters': {
+                name: list(value) if isinstance(value, tuple) else value
+                for name, value in self._values.items()
+            },
+            'source_size': list(self.source_size) if self.source_size else None,
+            'estimation_size': list(self.estimation_size) if self.estimation_size else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Crea el registro a partir de to_dict() (por ejemplo, JSON ya leído)"""
+        return cls(data['parameters'], data.get('source_size'), data.get('estimation_size'))
@@ -0,0 +1,300 @@
+"""
+Especificación declarativa del pipeline de preprocesamiento: registro de etapas y presets
+"""
+import json
+import os
+
+
+# Tipos de operación, usados para decidir fusiones y procesamiento por regiones:
+# - 'source': registra la imagen de entrada
+# - 'geometric': cambia el tamaño de la imagen
+# - 'pointwise': cada píxel depende solo de sí mismo (fusionable en LUTs)
+# - 'linear': convolución + mezcla (componible en un único kernel)
+# - 'local': depende de un vecindario de radio `halo`
+# - 'global': depende de estadísticas de toda la imagen
+STAGE_KINDS = ('source', 'geometric', 'pointwise', 'linear', 'local', 'global')
+
+# Formas de ejecutar una etapa por teselas (TileExecutor):
+# - 'map': el método se aplica a cada tesela ampliada con el halo
+# - 'executor': el método recibe el ejecutor en `executor` y decide qué
+#   parte tesela (por ejemplo, cuando elige parámetros con la imagen completa)
+TILING_MODES = ('map', 'executor')
+
+# Operaciones cuya salida invierte el orden de los canales de su entrada: la
+# corrección de color reinterpreta BGR como RGB y el modelo exprés aproxima el
+# pipeline completo, corrección incluida
+CHANNEL_SWAP_OPS = ('color_correction', 'express')
+
+
+class StageOp:
+    """Operación registrada del pipeline
+
+    `method` es el método de ImagePreprocessor que la aplica y recibe la
+    imagen y los parámetros. `halo` es el radio en píxeles que lee alrededor
+    de cada píxel; puede ser un número o una función de los parámetros.
+    `tiling` indica si la etapa admite ejecución por teselas y de qué forma
+    (uno de TILING_MODES, o None).
+    """
+
+    def __init__(self, name, method, kind, halo=0, tiling=None, **defaults):
+        if kind not in STAGE_KINDS:
+            raise ValueError(f"Tipo de etapa no soportado: {kind}")
+        if tiling is not None and tiling not in TILING_MODES:
+            raise ValueError(f"Modo de teselado no soportado: {tiling}")
+
+        self.name = name
+        self.method = method
+        self.kind = kind
+        self._halo = halo
+        self.tiling = tiling
+        self.defaults = defaults
+
+    def resolve_params(self, params):
+        """Parámetros por defecto combinados con los de la especificación"""
+        unknown = set(params) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Parámetros no soportados para '{self.name}': {sorted(unknown)}")
+        return {**self.defaults, **params}
+
+    def halo(self, params=None):
+        """Radio de vecindario para unos parámetros concretos"""
+        if callable(self._halo):
+            return self._halo(self.resolve_params(params or {}))
+        return self._halo
+
+
+STAGE_REGISTRY = {}
+
+
+def register_stage(name, method, kind, halo=0, tiling=None, **defaults):
+    """Registra una operación para poder usarla en especificaciones de pipeline"""
+    STAGE_REGISTRY[name] = StageOp(name, method, kind, halo, tiling, **defaults)
+    return STAGE_REGISTRY[name]
+
+
+register_stage('original', '_stage_original', 'source')
+register_stage('resize', '_stage_resize', 'geometric')
+register_stage('normalize', '_normalize_colors', 'global')
+register_stage('adaptive_gamma', '_apply_adaptive_gamma', 'global', gamma=None)
+register_stage('clahe', 'apply_clahe_enhancement', 'global', clip_limit=2.0, tile_grid_size=8)
+register_stage('nlm_denoise', 'denoise_image', 'local',
+               halo=lambda p: p['template_window_size'] // 2 + p['search_window_size'] // 2, tiling='map',
+               h=10, h_color=10, template_window_size=7, search_window_size=21)
+register_stage('adaptive_denoise', '_adaptive_denoise', 'local',
+               # 'nlm_luma_half' trabaja a media resolución: el mismo vecindario cubre el doble
+               halo=lambda p: 2 * (p['template_window_size'] // 2 + p['search_window_size'] // 2), tiling='executor',
+               tier='auto', max_tier='nlm_full', h=10, h_color=10, template_window_size=7, search_window_size=21,
+               regional=False, tile_size=32)
+register_stage('bilateral_denoise', '_bilateral_denoise', 'local',
+               halo=lambda p: p['diameter'] // 2, tiling='map',
+               diameter=9, sigma_color=75, sigma_space=75)
+register_stage('edge_preserving', '_apply_edge_preserving', 'global',
+               flags=1, sigma_s=50, sigma_r=0.4, scale=1, backend='opencv')
+register_stage('edge_enhance', '_enhance_edges', 'local', halo=1)
+register_stage('unsharp_mask', 'apply_linear_chain', 'linear', halo=6)
+register_stage('color_correction', '_stage_color_correction', 'global')
+register_stage('saturation', '_enhance_saturation', 'pointwise', gain=1.15)
+register_stage('white_balance', '_white_balance', 'global')
+register_stage('texture', 'apply_linear_chain', 'linear', halo=1)
+register_stage('final_contrast', '_final_contrast_adjustment', 'global', clip_limit=1.5, tile_grid_size=8)
+register_stage('smoothing', 'apply_linear_chain', 'linear', halo=1)
+register_stage('express', '_express_approximation', 'local', halo=2, model=None)
+
+
+class PipelineStep:
+    """Paso de una especificación: operación registrada, nombre de la etapa y parámetros
+
+    Con `tiled` la etapa se ejecuta por teselas en paralelo (solo para
+    operaciones registradas con `tiling`).
+    """
+
+    def __init__(self, op, stage, params=None, tiled=False):
+        if op not in STAGE_REGISTRY:
+            raise ValueError(f"Operación de pipeline no registrada: {op}")
+
+        self.op = STAGE_REGISTRY[op]
+        self.stage = stage
+        self.params = self.op.resolve_params(params or {})
+        if tiled and self.op.tiling is None:
+            raise ValueError(f"La operación '{op}' no admite ejecución por teselas")
+        self.tiled = bool(tiled)
+
+    def to_dict(self):
+        return {'op': self.op.name, 'stage': self.stage, 'params': dict(self.params), 'tiled': self.tiled}
+
+
+class PipelineSpec:
+    """Lista ordenada de pasos más opciones de ejecución
+
+    Opciones reconocidas (las que no se indiquen usan el valor del
+    preprocesador): 'fuse_pointwise', 'filter_mode', 'gating' y
+    'content_region'.
+    """
+
+    OPTIONS = ('fuse_pointwise', 'filter_mode', 'gating', 'content_region')
+
+    def __init__(self, name, steps, options=None):
+        options = dict(options or {})
+        unknown = set(options) - set(self.OPTIONS)
+        if unknown:
+            raise ValueError(f"Opciones de pipeline no soportadas: {sorted(unknown)}")
+
+        stages = [step.stage for step in steps]
+        if len(set(stages)) != len(stages):
+            raise ValueError("Los nombres de etapa del pipeline deben ser únicos")
+
+        self.name = name
+        self.steps = list(steps)
+        self.options = options
+
+    @classmethod
+    def from_dict(cls, data):
+        """Crea la especificación a partir de un diccionario (por ejemplo, JSON ya leído)"""
+        steps = [
+            PipelineStep(step['op'], step['stage'], step.get('params'), step.get('tiled', False))
+            for step in data['steps']
+        ]
+        return cls(data.get('name', 'custom'), steps, data.get('options'))
+
+    @classmethod
+    def from_json(cls, source):
+        """Crea la especificación desde un texto JSON o la ruta de un archivo JSON"""
+        if os.path.exists(source):
+            with open(source, 'r', encoding='utf-8') as f:
+                return cls.from_dict(json.load(f))
+        return cls.from_dict(json.loads(source))
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'options': dict(self.options),
+            'steps': [step.to_dict() for step in self.steps]
+        }
+
+    def swaps_channels(self, stage=None):
+        """Indica si la salida de `stage` (o la final) tiene los canales invertidos respecto al redimensionado"""
+        swapped = False
+        for step in self.steps:
+            swapped ^= step.op.name in CHANNEL_SWAP_OPS
+            if step.stage == stage:
+                break
+        return swapped
+
+    def __len__(self):
+        return len(self.steps)
+
+
+def _steps(*entries):
+    # Cada entrada es (op, etapa, parámetros) o (op, etapa, parámetros, tiled)
+    return [
+        {'op': entry[0], 'stage': entry[1], 'params': entry[2], 'tiled': entry[3] if len(entry) > 3 else False}
+        for entry in entries
+    ]
+
+
+# 'full' reproduce el pipeline original de 15 etapas. La reducción de ruido
+# va por teselas en todos los presets: el resultado es idéntico y con varios
+# núcleos se reparte entre ellos
+PRESETS = {
+    'full': {
+        'name': 'full',
+        'options': {},
+        'steps': _steps(
+            ('original', 'step01_original', {}),
+            ('resize', 'step02_resized', {}),
+            ('normalize', 'step03_normalized', {}),
+            ('adaptive_gamma', 'step04_gamma_corrected', {}),
+            ('clahe', 'step05_clahe_enhanced', {}),
+            ('nlm_denoise', 'step06_denoised', {}, True),
+            ('edge_preserving', 'step07_edge_preserved', {}),
+            ('edge_enhance', 'step08_edges_enhanced', {}),
+            ('unsharp_mask', 'step09_sharpened', {}),
+            ('color_correction', 'step10_color_corrected', {}),
+            ('saturation', 'step11_saturation_enhanced', {}),
+            ('white_balance', 'step12_white_balanced', {}),
+            ('texture', 'step13_texture_enhanced', {}),
+            ('final_contrast', 'step14_final_contrast', {}),
+            ('smoothing', 'step15_final', {}),
+        ),
+    },
+    # Reducción de ruido con el nivel adecuado al ruido medido (ver
+    # DenoiseEngine) aplicada solo a las teselas con ruido local, filtro
+    # preservador de bordes con los kernels de transformada de dominio (±1
+    # nivel respecto a OpenCV; sin Numba, el filtro guiado), etapas puntuales
+    # y lineales fusionadas y omisión de etapas sin efecto apreciable. Tras el
+    # redimensionado solo se procesa el contenido, sin el relleno del lienzo
+    # de 512x512
+    'balanced': {
+        'name': 'balanced',
+        'options': {'fuse_pointwise': True, 'filter_mode': 'composed', 'gating': True, 'content_region': True},
+        'steps': _steps(
+            ('original', 'step01_original', {}),
+            ('resize', 'step02_resized', {}),
+            ('normalize', 'step03_normalized', {}),
+            ('adaptive_gamma', 'step04_gamma_corrected', {}),
+            ('clahe', 'step05_clahe_enhanced', {}),
+            ('adaptive_denoise', 'step06_denoised', {'regional': True}, True),
+            ('edge_preserving', 'step07_edge_preserved', {'backend': 'auto'}),
+            ('edge_enhance', 'step08_edges_enhanced', {}),
+            ('unsharp_mask', 'step09_sharpened', {}),
+            ('color_correction', 'step10_color_corrected', {}),
+            ('saturation', 'step11_saturation_enhanced', {}),
+            ('white_balance', 'step12_white_balanced', {}),
+            ('texture', 'step13_texture_enhanced', {}),
+            ('final_contrast', 'step14_final_contrast', {}),
+            ('smoothing', 'step15_final', {}),
+        ),
+    },
+    # Sin NLM: como mucho bilateral según el ruido medido, filtro preservador
+    # de bordes a media resolución, el resto de etapas fusionadas y solo el
+    # contenido, sin el relleno del lienzo
+    'fast': {
+        'name': 'fast',
+        'options': {'fuse_pointwise': True, 'filter_mode': 'composed', 'gating': True, 'content_region': True},
+        'steps': _steps(
+            ('original', 'step01_original', {}),
+            ('resize', 'step02_resized', {}),
+            ('normalize', 'step03_normalized', {}),
+            ('adaptive_gamma', 'step04_gamma_corrected', {}),
+            ('clahe', 'step05_clahe_enhanced', {}),
+            ('adaptive_denoise', 'step06_denoised', {'max_tier': 'bilateral'}, True),
+            ('edge_preserving', 'step07_edge_preserved', {'scale': 2, 'backend': 'auto'}),
+            ('edge_enhance', 'step08_edges_enhanced', {}),
+            ('unsharp_mask', 'step09_sharpened', {}),
+            ('color_correction', 'step10_color_corrected', {}),
+            ('saturation', 'step11_saturation_enhanced', {}),
+            ('white_balance', 'step12_white_balanced', {}),
+            ('texture', 'step13_texture_enhanced', {}),
+            ('final_contrast', 'step14_final_contrast', {}),
+            ('smoothing', 'step15_final', {}),
+        ),
+    },
+    # Aproximación aprendida de 'full' para alto volumen: las etapas hasta
+    # CLAHE tal cual (normalización y gamma en una LUT) y el resto sustituido
+    # por una LUT de color 3D según el tipo de imagen y un filtro separable de
+    # nitidez (ver express.py; el modelo se ajusta offline con
+    # python -m outfits.processing.express fit)
+    'express': {
+        'name': 'express',
+        'options': {'fuse_pointwise': True},
+        'steps': _steps(
+            ('original', 'step01_original', {}),
+            ('resize', 'step02_resized', {}),
+            ('normalize', 'step03_normalized', {}),
+            ('adaptive_gamma', 'step04_gamma_corrected', {}),
+            ('clahe', 'step05_clahe_enhanced', {}),
+            ('express', 'step15_final', {}),
+        ),
+    },
+}
+
+
+def get_pipeline(pipeline):
+    """Devuelve una PipelineSpec a partir de un nombre de preset o de una especificación"""
+    if isinstance(pipeline, PipelineSpec):
+        return pipeline
+    if isinstance(pipeline, dict):
+        return PipelineSpec.from_dict(pipeline)
+    if pipeline not in PRESETS:
+        raise ValueError(f"Preset de pipeline no soportado: {pipeline}")
+    return PipelineSpec.from_dict(PRESETS[pipeline])
@@ -12,20 +12,188 @@ from skimage import exposure, filters, morphology, restoration
 import pandas as pd
 from collections import defaultdict
 import time
+import threading
+
+from .statistics import StatisticsEngine, LazyImageStatistics, SampledStatisticsEngine
+from .stage_store import StageStore
+from .derived_views import DerivedViews, DerivedViewCache
+from .lut import gamma_lut, minmax_lut, compose_luts, histogram_range, mapped_gray_mean
+from .buffers import thread_arena
+from . import accelerated as accelerated_kernels
+from . import resources
+from .pipeline import get_pipeline
+from .gating import StageGating
+from .denoise import DenoiseEngine
+from .tiling import default_executor
+from .edge_preserving import edge_preserving_filter
+from .streaming import StripePipeline
+from .parameters import GlobalParameters, SCALE_INVARIANT, _freeze
+from .express import load_express_model
+from .quality import ReducedView, SIMILARITY_METRICS, stage_similarity
+from .sweep import ParameterSweep
+from .batch import BatchRunner
+from .stage_cache import StageCache, default_stage_cache, code_version, content_hash, chain_key
+from .linear_filters import (
+    unsharp_mask_stage, texture_stage, smoothing_stage, sharpen_blend_stage, plan_linear_chain,
+    TEXTURE_KERNEL, SHARPEN_KERNEL
+)
+
+
+_plots_configured = False
+_plots_lock = threading.Lock()
+
+
+def _configure_plots():
+    """Estilo de matplotlib y paleta de seaborn de los gráficos, una sola vez por proceso"""
+    # Es estado global de matplotlib: cambiarlo en cada petición es lento y, con
+    # varios hilos, altera el gráfico que otro hilo está dibujando
+    global _plots_configured
+    with _plots_lock:
+        if not _plots_configured:
+            plt.style.use('seaborn-v0_8')
+            sns.set_palette("husl")
+            _plots_configured = True
 
 
 class ImagePreprocessor:
     """Clase avanzada para el preprocesamiento de imágenes con análisis estadístico completo"""
     
-    def __init__(self):
-        self.target_size = (512, 512)
+    # Modos de cálculo de estadísticas: 'eager' calcula todo en cada etapa,
+    # 'lazy' calcula cada métrica solo cuando se consulta y 'sampled' aproxima
+    # las métricas con una muestra de píxeles e intervalos de confianza
+    STATS_MODES = ('eager', 'lazy', 'sampled')
+    
+    # Umbrales de brillo de la corrección gamma adaptativa
+    GAMMA_DARK_THRESHOLD = 85
+    GAMMA_BRIGHT_THRESHOLD = 170
+    
+    # Modos de filtrado lineal: 'exact' reproduce cada convolución y mezcla por
+    # separado; 'composed' las agrupa en un único kernel cuando sale más barato
+    # y el resultado difiere como mucho en ±1; 'tolerant' compone también los
+    # realces cuya saturación intermedia se pierde (ver ComposedFilter)
+    FILTER_MODES = ('exact', 'composed', 'tolerant')
+    
+    # Lado máximo del tamaño objetivo del redimensionado
+    MAX_TARGET_SIZE = 4096
+    
+    # Lado del primer nivel del procesamiento progresivo (vista previa)
+    PROGRESSIVE_PREVIEW = 192
+    
+    # Lado del nivel reducido sobre el que se estiman los parámetros globales
+    PARAMETER_ESTIMATION_SIZE = 128
+    
+    # Lado de las versiones reducidas sobre las que se compara cada etapa con
+    # la anterior y con el original (SSIM/PSNR de quality.stage_similarity)
+    SIMILARITY_SIZE = 128
+    
+    def __init__(self, stats_mode='eager', stage_retention='all', fuse_pointwise=None, filter_mode=None,
+                 buffer_arena=None, accelerated=True, pipeline='full', gating=None, tile_executor=None,
+                 content_region=None, stats_include_padding=False, target_size=(512, 512), memory_limit_mb=None,
+                 parameter_estimation=False, express_model=None, stage_cache=None):
+        if stats_mode not in self.STATS_MODES:
+            raise ValueError(f"Modo de estadísticas no soportado: {stats_mode}")
+        if stage_retention not in StageStore.RETENTION_POLICIES:
+            raise ValueError(f"Política de retención no soportada: {stage_retention}")
+        
+        # Preset o especificación de etapas; sus opciones se usan salvo que se
+        # indiquen explícitamente fuse_pointwise, filter_mode, gating o content_region
+        self.pipeline = get_pipeline(pipeline)
+        if gating is None:
+            gating = self.pipeline.options.get('gating', False)
+        if fuse_pointwise is None:
+            fuse_pointwise = self.pipeline.options.get('fuse_pointwise', False)
+        if filter_mode is None:
+            filter_mode = self.pipeline.options.get('filter_mode', 'exact')
+        if content_region is None:
+            content_region = self.pipeline.options.get('content_region', False)
+        if filter_mode not in self.FILTER_MODES:
+            raise ValueError(f"Modo de filtrado no soportado: {filter_mode}")
+        if len(target_size) != 2 or not all(0 < side <= self.MAX_TARGET_SIZE for side in target_size):
+            raise ValueError(f"Tamaño objetivo no soportado: {target_size} (lado máximo {self.MAX_TARGET_SIZE})")
+        
+        self.target_size = tuple(int(side) for side in target_size)
+        # Con un límite de memoria el pipeline se ejecuta por franjas (ver
+        # StripePipeline): solo se conservan miniaturas de las etapas y la
+        # memoria de trabajo no depende de la resolución. Por el contexto del
+        # filtro preservador de bordes, a 512 px el límite solo se respeta
+        # desde unos 35 MB más la imagen de entrada; por debajo, esa pasada se
+        # aplica a la imagen completa y lo supera
+        self.memory_limit_mb = memory_limit_mb
+        # Con parameter_estimation los parámetros globales se estiman antes en
+        # un nivel reducido (True usa PARAMETER_ESTIMATION_SIZE; un número,
+        # ese lado) y se aplican fijos a resolución completa: por franjas, las
+        # etapas con parámetros fijos no necesitan recorrer su entrada antes
+        self.parameter_estimation = parameter_estimation
+        # Modelo de la etapa 'express' (ExpressModel o ruta; None usa el incluido en data/)
+        self.express_model = express_model
+        # Caché de salidas de etapas entre procesamientos (StageCache; True usa
+        # la compartida por el proceso): se retoma desde el prefijo más largo
+        # de etapas guardadas con la misma entrada, código y parámetros
+        if stage_cache is True:
+            stage_cache = default_stage_cache()
+        self.stage_cache = stage_cache if isinstance(stage_cache, StageCache) else None
+        self.cached_stages = []
+        self._stage_keys = None
+        self._pipeline_input = None
         self.processing_stats = defaultdict(dict)
         self.processing_history = []
         self.enable_statistics = True
+        self.stats_mode = stats_mode
+        self.stage_retention = stage_retention
+        self.fuse_pointwise = fuse_pointwise
+        self.filter_mode = filter_mode
+        # Reglas para omitir etapas sin efecto apreciable (True usa las reglas por defecto)
+        self.gating = StageGating() if gating is True else (gating or None)
+        # Con content_region las etapas posteriores al redimensionado procesan
+        # solo el rectángulo con contenido y el relleno se añade al componer la
+        # imagen final; stats_include_padding calcula las estadísticas sobre el
+        # lienzo completo, como en el pipeline original
+        self.content_region = content_region
+        self.stats_include_padding = stats_include_padding
+        self.content_rect = None
+        self._canvas = None
+        self.skipped_stages = []
+        self._current_stats = (None, None)
+        self._stage_annotations = {}
+        # Versiones reducidas de la etapa anterior y del original en la geometría actual
+        self._similarity_views = (None, None)
+        # Parámetros globales de las etapas (ver parameters.PARAMETERS): los
+        # usados en el último procesamiento y, si se fijan, los que sustituyen
+        # a la estimación (un GlobalParameters o un diccionario)
+        self.estimated_parameters = {}
+        self._frozen_parameters = {}
+        self._source_iso = None
+        self._buffer_arena = buffer_arena
+        self._tile_executor = tile_executor
+        # Kernels Numba para las etapas NumPy, solo si el backend está instalado
+        self.accelerated = accelerated and accelerated_kernels.AVAILABLE
+        self.linear_stages = {
+            'unsharp_mask': unsharp_mask_stage(native=self.sharpen_image),
+            'texture': texture_stage(native=self._enhance_texture),
+            'smoothing': smoothing_stage(native=self._final_optimization),
+            'sharpen_blend': sharpen_blend_stage(native=self._sharpen_blend),
+        }
+        self._linear_plans = {}
+        self.stage_images = StageStore(stage_retention, on_release=self._release_stage_stats)
+        self.view_cache = DerivedViewCache()
+        self.stats_engine = SampledStatisticsEngine() if stats_mode == 'sampled' else StatisticsEngine()
         
         # Configuración de matplotlib para mejor visualización
-        plt.style.use('seaborn-v0_8')
-        sns.set_palette("husl")
+        _configure_plots()
+    
+    @property
+    def buffers(self):
+        """Arena de buffers de trabajo (la del hilo actual si no se indicó otra)"""
+        if self._buffer_arena is not None:
+            return self._buffer_arena
+        return thread_arena()
+    
+    @property
+    def tile_executor(self):
+        """Ejecutor por teselas de las etapas marcadas como `tiled` (el compartido si no se indicó otro)"""
+        if self._tile_executor is not None:
+            return self._tile_executor
+        return default_executor()
     
     def calculate_image_statistics(self, image, stage_name):
         """Calcula estadísticas completas de la imagen"""
@@ -43,78 +211,25 @@ class ImagePreprocessor:
             if img_array.dtype != np.uint8:
                 img_array = (img_array * 255).astype(np.uint8)
         
-        stats = {
-            'timestamp': time.time(),
-            'stage': stage_name,
-            'dimensions': img_array.shape,
-            'size_mb': img_array.nbytes / (1024 * 1024),
-            'dtype': str(img_array.dtype),
-            
-            # Estadísticas de canales de color
-            'mean_rgb': [],
-            'std_rgb': [],
-            'min_rgb': [],
-            'max_rgb': [],
-            'median_rgb': [],
-            
-            # Estadísticas globales
-            'brightness': 0,
-            'contrast': 0,
-            'sharpness': 0,
-            
-            # Histogramas
-            'histograms': {},
-            
-            # Información de calidad
-            'blur_metric': 0,
-            'noise_level': 0,
-            'saturation_avg': 0,
-        }
-        
-        # Calcular estadísticas por canal
-        if len(img_array.shape) == 3:
-            for i, channel in enumerate(['R', 'G', 'B']):
-                channel_data = img_array[:, :, i]
-                stats['mean_rgb'].append(float(np.mean(channel_data)))
-                stats['std_rgb'].append(float(np.std(channel_data)))
-                stats['min_rgb'].append(int(np.min(channel_data)))
-                stats['max_rgb'].append(int(np.max(channel_data)))
-                stats['median_rgb'].append(float(np.median(channel_data)))
-                
-                # Histograma
-                hist, bins = np.histogram(channel_data.flatten(), bins=256, range=(0, 256))
-                stats['histograms'][channel] = hist.tolist()
-        
-        # Estadísticas globales
-        if len(img_array.shape) == 3:
-            # Brillo promedio
-            stats['brightness'] = float(np.mean(img_array))
-            
-            # Contraste (desviación estándar)
-            stats['contrast'] = float(np.std(img_array))
-            
-            # Convertir a escala de grises para métricas adicionales
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-            
-            # Métrica de desenfoque (varianza del Laplaciano)
-            stats['blur_metric'] = float(cv2.Laplacian(gray, cv2.CV_64F).var())
-            
-            # Nivel de ruido (usando desviación estándar local)
-            noise_kernel = np.ones((3, 3)) / 9
-            smoothed = cv2.filter2D(gray.astype(np.float32), -1, noise_kernel)
-            noise_diff = gray.astype(np.float32) - smoothed
-            stats['noise_level'] = float(np.std(noise_diff))
-            
-            # Saturación promedio
-            hsv = cv2.cvtColor(img_array, cv2.COLOR_RGB2HSV)
-            saturation_channel = hsv[:, :, 1]
-            stats['saturation_avg'] = float(np.mean(saturation_channel))
+        views = self._views(img_array)
+        if self.stats_mode == 'lazy':
+            stats = LazyImageStatistics(self.stats_engine, img_array, stage_name, views)
+        else:
+            stats = self.stats_engine.compute(img_array, stage_name, views)
         
         # Guardar estadísticas
         self.processing_stats[stage_name] = stats
         
         return stats
     
+    def _views(self, image):
+        """Vistas derivadas (gris, HSV, LAB, gradientes) compartidas para esta versión de imagen"""
+        return self.view_cache.get(image)
+    
+    def get_statistics(self):
+        """Devuelve las estadísticas de todas las etapas como diccionarios ya calculados"""
+        return {stage_name: dict(stats) for stage_name, stats in self.processing_stats.items()}
+    
     def resize_image_advanced(self, image, target_size=None, interpolation='lanczos'):
         """Redimensionamiento avanzado con múltiples algoritmos"""
         if target_size is None:
@@ -157,14 +272,15 @@ class ImagePreprocessor:
         # Calcular color de fondo promedio de los bordes
         # Asegurar que image sea un array numpy
         if len(image.shape) == 3:
-            border_pixels = np.vstack([
-                image[0, :].reshape(-1, 3),  # Top
-                image[-1, :].reshape(-1, 3), # Bottom
-                image[:, 0].reshape(-1, 3),  # Left
-                image[:, -1].reshape(-1, 3)  # Right
-            ])
-            border_mean = np.mean(border_pixels, axis=0)
-            bg_color = border_mean.astype(np.uint8)
+            def border_mean():
+                border_pixels = np.vstack([
+                    image[0, :].reshape(-1, 3),  # Top
+                    image[-1, :].reshape(-1, 3), # Bottom
+                    image[:, 0].reshape(-1, 3),  # Left
+                    image[:, -1].reshape(-1, 3)  # Right
+                ])
+                return np.mean(border_pixels, axis=0).astype(np.uint8)
+            bg_color = np.asarray(self._global_parameter('border_color', border_mean), dtype=np.uint8)
         else:
             # Usar color gris por defecto si hay problemas
             bg_color = np.array([128, 128, 128], dtype=np.uint8)
@@ -176,48 +292,56 @@ class ImagePreprocessor:
         x_offset = (target_w - new_w) // 2
         canvas[y_offset:y_offset+new_h, x_offset:x_offset+new_w] = resized
         
-        # Calcular estadísticas después del resize
-        result_pil = Image.fromarray(cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB))
-        self.calculate_image_statistics(result_pil, 'resized')
+        # Rectángulo con contenido (y0, y1, x0, x1) y relleno, para componer el lienzo
+        self.content_rect = (y_offset, y_offset + new_h, x_offset, x_offset + new_w)
+        self._canvas = (target_h, target_w, bg_color)
+        
+        # Calcular estadísticas después del resize (sin el relleno si solo se procesa el contenido)
+        measured = resized if self.content_region and not self.stats_include_padding else canvas
+        self.calculate_image_statistics(cv2.cvtColor(measured, cv2.COLOR_BGR2RGB), 'resized')
         
         return canvas
     
-    def enhance_image_advanced(self, image):
+    def enhance_image_advanced(self, image, denoise_tier=None):
         """Mejora avanzada de la imagen con múltiples técnicas"""
+        # Con denoise_tier=None la reducción de ruido encadena bilateral y NLM completo;
+        # con un nivel de DenoiseEngine (o 'auto', según el ruido tras CLAHE) aplica solo ese
         
         # 1. Corrección de iluminación adaptativa
         lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
         l_channel = lab[:, :, 0]
         
         # CLAHE (Contrast Limited Adaptive Histogram Equalization)
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+        clahe = resources.clahe(3.0, 8)
         enhanced_l = clahe.apply(l_channel)
         lab[:, :, 0] = enhanced_l
         enhanced = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
         
-        self.calculate_image_statistics(Image.fromarray(cv2.cvtColor(enhanced, cv2.COLOR_BGR2RGB)), 'clahe_enhanced')
+        clahe_stats = self.calculate_image_statistics(cv2.cvtColor(enhanced, cv2.COLOR_BGR2RGB), 'clahe_enhanced')
         
         # 2. Reducción de ruido avanzada
-        # Filtro bilateral para preservar bordes
-        denoised = cv2.bilateralFilter(enhanced, 9, 75, 75)
-        
-        # Reducción de ruido cromático
-        denoised = cv2.fastNlMeansDenoisingColored(denoised, None, 10, 10, 7, 21)
+        if denoise_tier is None:
+            # Filtro bilateral para preservar bordes
+            denoised = cv2.bilateralFilter(enhanced, 9, 75, 75)
+            
+            # Reducción de ruido cromático
+            denoised = cv2.fastNlMeansDenoisingColored(denoised, None, 10, 10, 7, 21)
+        else:
+            engine = DenoiseEngine()
+            if denoise_tier == 'auto':
+                noise_level = clahe_stats['noise_level'] if clahe_stats else \
+                    self.stats_engine.noise_level(cv2.cvtColor(enhanced, cv2.COLOR_BGR2GRAY))
+                denoise_tier = engine.select_tier(noise_level, self._source_iso)
+            denoised = engine.apply(enhanced, denoise_tier, bgr=True)
         
-        self.calculate_image_statistics(Image.fromarray(cv2.cvtColor(denoised, cv2.COLOR_BGR2RGB)), 'denoised')
+        denoised_stats = self.calculate_image_statistics(cv2.cvtColor(denoised, cv2.COLOR_BGR2RGB), 'denoised')
+        if denoise_tier is not None:
+            self._annotate_stats(denoised_stats, {'denoise_tier': denoise_tier})
         
         # 3. Mejora de sharpness
-        # Crear kernel de sharpening
-        sharpening_kernel = np.array([[-1, -1, -1],
-                                    [-1,  9, -1],
-                                    [-1, -1, -1]])
+        enhanced_final = self.apply_linear_chain(denoised, 'sharpen_blend')
         
-        sharpened = cv2.filter2D(denoised, -1, sharpening_kernel)
-        
-        # Mezclar imagen original con sharpened (50-50)
-        enhanced_final = cv2.addWeighted(denoised, 0.7, sharpened, 0.3, 0)
-        
-        self.calculate_image_statistics(Image.fromarray(cv2.cvtColor(enhanced_final, cv2.COLOR_BGR2RGB)), 'sharpened')
+        self.calculate_image_statistics(cv2.cvtColor(enhanced_final, cv2.COLOR_BGR2RGB), 'sharpened')
         
         # 4. Corrección de color y saturación
         hsv = cv2.cvtColor(enhanced_final, cv2.COLOR_BGR2HSV).astype(np.float32)
@@ -233,7 +357,7 @@ class ImagePreprocessor:
         
         final_result = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
         
-        self.calculate_image_statistics(Image.fromarray(cv2.cvtColor(final_result, cv2.COLOR_BGR2RGB)), 'color_corrected')
+        self.calculate_image_statistics(cv2.cvtColor(final_result, cv2.COLOR_BGR2RGB), 'color_corrected')
         
         return final_result
     
@@ -252,7 +376,7 @@ class ImagePreprocessor:
         img_array = np.array(pil_image)
         
         # 1. Detectar imagen muy oscura
-        avg_brightness = np.mean(img_array)
+        avg_brightness = self._global_parameter('issue_brightness', lambda: np.mean(img_array))
         if avg_brightness < 80:
             corrections_applied.append("Corrección de brillo bajo")
             result = cv2.convertScaleAbs(result, alpha=1.3, beta=30)
@@ -263,27 +387,25 @@ class ImagePreprocessor:
             result = cv2.convertScaleAbs(result, alpha=0.8, beta=-20)
         
         # 3. Detectar bajo contraste
-        contrast = np.std(img_array)
+        contrast = self._global_parameter('issue_contrast', lambda: np.std(img_array))
         if contrast < 40:
             corrections_applied.append("Mejora de contraste")
             lab = cv2.cvtColor(result, cv2.COLOR_BGR2LAB)
             l_channel = lab[:, :, 0]
-            clahe = cv2.createCLAHE(clipLimit=4.0, tileGridSize=(8, 8))
+            clahe = resources.clahe(4.0, 8)
             lab[:, :, 0] = clahe.apply(l_channel)
             result = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
         
         # 4. Detectar imagen desenfocada
-        gray = cv2.cvtColor(result, cv2.COLOR_BGR2GRAY)
-        blur_metric = cv2.Laplacian(gray, cv2.CV_64F).var()
+        blur_metric = self._global_parameter(
+            'issue_blur', lambda: cv2.Laplacian(cv2.cvtColor(result, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var())
         if blur_metric < 100:
             corrections_applied.append("Mejora de nitidez")
-            kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
-            result = cv2.filter2D(result, -1, kernel)
+            result = cv2.filter2D(result, -1, SHARPEN_KERNEL)
         
         # 5. Detectar colores desaturados
         hsv = cv2.cvtColor(result, cv2.COLOR_BGR2HSV)
-        saturation_channel = hsv[:, :, 1]
-        avg_saturation = np.mean(saturation_channel)
+        avg_saturation = self._global_parameter('issue_saturation', lambda: np.mean(hsv[:, :, 1]))
         if avg_saturation < 60:
             corrections_applied.append("Mejora de saturación")
             hsv[:, :, 1] = cv2.multiply(hsv[:, :, 1], 1.2)
@@ -291,131 +413,569 @@ class ImagePreprocessor:
         
         return result, corrections_applied
     
-    def process_upload_complete_extended(self, uploaded_file):
+    def process_upload_complete_extended(self, uploaded_file, output_path=None, parameters=None):
         """Procesamiento completo con 15 etapas de análisis estadístico"""
+        # Con memory_limit_mb se procesa por franjas y la imagen final puede escribirse
+        # en `output_path` (PPM); `parameters` (GlobalParameters) fija los parámetros
+        # globales en lugar de medirlos
+        if output_path is not None and self.memory_limit_mb is None:
+            raise ValueError("output_path solo se admite en el procesamiento por franjas (memory_limit_mb)")
         try:
             start_time = time.time()
             
-            # Leer la imagen original
-            image = Image.open(uploaded_file)
-            
-            # Corregir orientación EXIF (importante para fotos de cámara)
-            image = ImageOps.exif_transpose(image)
-            
-            # Convertir a RGB si es necesario
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            # Las fotos JPEG se decodifican a la menor escala que sigue cubriendo el tamaño objetivo
+            draft_size = max(self.target_size) if self.memory_limit_mb is not None else None
+            image = self._load_upload(uploaded_file, draft_size)
             
-            # Convertir a numpy array para procesamiento
-            current_image = np.array(image)
+            if parameters is None and self.parameter_estimation:
+                side = self.PARAMETER_ESTIMATION_SIZE if self.parameter_estimation is True else self.parameter_estimation
+                parameters = self.estimate_global_parameters(image, side)
             
-            # Lista para guardar todas las etapas con sus imágenes
-            self.stage_images = {}
-            
-            # ETAPA 1: ORIGINAL
-            self.calculate_image_statistics(image, 'step01_original')
-            self.stage_images['step01_original'] = current_image.copy()
-            
-            # ETAPA 2: REDIMENSIONAMIENTO
-            resized = self.resize_image_advanced(image)
-            resized_array = np.array(resized)
-            self.calculate_image_statistics(resized, 'step02_resized')
-            self.stage_images['step02_resized'] = resized_array.copy()
-            current_image = resized_array
-            
-            # ETAPA 3: NORMALIZACIÓN DE COLOR
-            normalized = self._normalize_colors(current_image)
-            self.calculate_image_statistics(Image.fromarray(normalized), 'step03_normalized')
-            self.stage_images['step03_normalized'] = normalized.copy()
-            current_image = normalized
-            
-            # ETAPA 4: CORRECCIÓN GAMMA ADAPTATIVA
-            gamma_corrected = self._apply_adaptive_gamma(current_image)
-            self.calculate_image_statistics(Image.fromarray(gamma_corrected), 'step04_gamma_corrected')
-            self.stage_images['step04_gamma_corrected'] = gamma_corrected.copy()
-            current_image = gamma_corrected
-            
-            # ETAPA 5: MEJORA CLAHE
-            clahe_image = self.apply_clahe_enhancement(current_image)
-            self.calculate_image_statistics(Image.fromarray(clahe_image), 'step05_clahe_enhanced')
-            self.stage_images['step05_clahe_enhanced'] = clahe_image.copy()
-            current_image = clahe_image
-            
-            # ETAPA 6: REDUCCIÓN DE RUIDO BILATERAL
-            denoised = self.denoise_image(current_image)
-            self.calculate_image_statistics(Image.fromarray(denoised), 'step06_denoised')
-            self.stage_images['step06_denoised'] = denoised.copy()
-            current_image = denoised
-            
-            # ETAPA 7: FILTRO PRESERVADOR DE BORDES
-            edge_preserved = self._apply_edge_preserving(current_image)
-            self.calculate_image_statistics(Image.fromarray(edge_preserved), 'step07_edge_preserved')
-            self.stage_images['step07_edge_preserved'] = edge_preserved.copy()
-            current_image = edge_preserved
-            
-            # ETAPA 8: DETECCIÓN Y MEJORA DE BORDES
-            edges_enhanced = self._enhance_edges(current_image)
-            self.calculate_image_statistics(Image.fromarray(edges_enhanced), 'step08_edges_enhanced')
-            self.stage_images['step08_edges_enhanced'] = edges_enhanced.copy()
-            current_image = edges_enhanced
-            
-            # ETAPA 9: SHARPENING ADAPTATIVO
-            sharpened = self.sharpen_image(current_image)
-            self.calculate_image_statistics(Image.fromarray(sharpened), 'step09_sharpened')
-            self.stage_images['step09_sharpened'] = sharpened.copy()
-            current_image = sharpened
-            
-            # ETAPA 10: CORRECCIÓN DE COLOR HSV
-            color_corrected = self.correct_colors(current_image)
-            color_corrected = cv2.cvtColor(color_corrected, cv2.COLOR_BGR2RGB)
-            self.calculate_image_statistics(Image.fromarray(color_corrected), 'step10_color_corrected')
-            self.stage_images['step10_color_corrected'] = color_corrected.copy()
-            current_image = color_corrected
-            
-            # ETAPA 11: MEJORA DE SATURACIÓN
-            saturated = self._enhance_saturation(current_image)
-            self.calculate_image_statistics(Image.fromarray(saturated), 'step11_saturation_enhanced')
-            self.stage_images['step11_saturation_enhanced'] = saturated.copy()
-            current_image = saturated
-            
-            # ETAPA 12: BALANCE DE BLANCOS
-            white_balanced = self._white_balance(current_image)
-            self.calculate_image_statistics(Image.fromarray(white_balanced), 'step12_white_balanced')
-            self.stage_images['step12_white_balanced'] = white_balanced.copy()
-            current_image = white_balanced
-            
-            # ETAPA 13: MEJORA DE TEXTURA
-            texture_enhanced = self._enhance_texture(current_image)
-            self.calculate_image_statistics(Image.fromarray(texture_enhanced), 'step13_texture_enhanced')
-            self.stage_images['step13_texture_enhanced'] = texture_enhanced.copy()
-            current_image = texture_enhanced
-            
-            # ETAPA 14: AJUSTE FINAL DE CONTRASTE
-            final_contrast = self._final_contrast_adjustment(current_image)
-            self.calculate_image_statistics(Image.fromarray(final_contrast), 'step14_final_contrast')
-            self.stage_images['step14_final_contrast'] = final_contrast.copy()
-            current_image = final_contrast
+            return self._process_loaded(image, start_time, output_path, parameters)
+        
+        except Exception as e:
+            raise ValueError(f"Error en procesamiento completo: {str(e)}")
+    
+    def progressive_levels(self, levels=None):
+        """Lados de los niveles progresivos, validados (por defecto PROGRESSIVE_PREVIEW y el tamaño objetivo)"""
+        if levels is None:
+            levels = (self.PROGRESSIVE_PREVIEW, max(self.target_size))
+        levels = [int(side) for side in levels]
+        increasing = all(a < b for a, b in zip(levels, levels[1:]))
+        if not levels or not increasing or not all(0 < side <= self.MAX_TARGET_SIZE for side in levels):
+            raise ValueError(f"Niveles progresivos no soportados: {levels} "
+                             f"(lados crecientes entre 1 y {self.MAX_TARGET_SIZE})")
+        return levels
+    
+    def process_progressive(self, uploaded_file, levels=None, reuse_parameters=True):
+        """Generador de (imagen_final, resumen) para cada lado de `levels`, de menor a mayor"""
+        levels = self.progressive_levels(levels)
+        
+        # Los datos de la subida se leen una vez y cada nivel abre su copia en memoria
+        if hasattr(uploaded_file, 'read'):
+            uploaded_file.seek(0)
+            data = uploaded_file.read()
+            open_source = lambda: io.BytesIO(data)
+        else:
+            open_source = lambda: uploaded_file
+        
+        # Solo JPEG se decodifica a escala reducida; el resto se lee una vez para todos los niveles
+        with Image.open(open_source()) as probe:
+            scalable = probe.format == 'JPEG'
+        
+        # Mientras el generador está detenido en un nivel, stage_images y
+        # processing_stats son los de ese nivel
+        target_size = self.target_size
+        frozen_parameters = self._frozen_parameters
+        decoded = None
+        try:
+            for index, side in enumerate(levels):
+                start_time = time.time()
+                last = index == len(levels) - 1
+                self.target_size = self._level_target_size(side, target_size)
+                
+                try:
+                    if not scalable and self.memory_limit_mb is None:
+                        # Por franjas la fuente se cierra tras la primera pasada y se vuelve a leer
+                        if decoded is None:
+                            decoded = self._load_upload(open_source())
+                        image = decoded
+                    elif last:
+                        draft_size = side if self.memory_limit_mb is not None else None
+                        image = self._load_upload(open_source(), draft_size)
+                    else:
+                        image = self._load_upload(open_source(), side)
+                    # Los niveles previos se leen y reducen a escala menor: con 'fast' y
+                    # 'balanced' el primer resultado llega en decenas de milisegundos
+                    if not last:
+                        image = self._reduce_for_level(image)
+                    final_image, summary = self._process_loaded(image, start_time)
+                except Exception as e:
+                    raise ValueError(f"Error en procesamiento progresivo (nivel {side}): {str(e)}")
+                
+                summary['level'] = {
+                    'index': index,
+                    'size': side,
+                    'target_size': list(self.target_size),
+                    'final': last,
+                    'reused_parameters': sorted(self._frozen_parameters),
+                }
+                # Los niveles siguientes reutilizan los parámetros que no dependen de la
+                # resolución: la vista previa y el resultado final toman las mismas decisiones
+                if index == 0 and reuse_parameters:
+                    coarse = GlobalParameters(self.estimated_parameters).subset(SCALE_INVARIANT)
+                    self._frozen_parameters = {**frozen_parameters, **coarse}
+                yield final_image, summary
+        finally:
+            self.target_size = target_size
+            self._frozen_parameters = frozen_parameters
+    
+    def sweep(self, uploaded_file, grid, thumbnail_size=192):
+        """Variantes de parámetros de una o dos etapas sobre una imagen subida; devuelve (hoja de contactos, resumen)"""
+        # Siempre en memoria, aunque haya memory_limit_mb (ver sweep.ParameterSweep)
+        sweep = ParameterSweep(self, grid)
+        return sweep.run(self._load_upload(uploaded_file), thumbnail_size)
+    
+    def process_batch(self, images, workers=None):
+        """Procesa varias imágenes (subidas o PIL) y devuelve una lista de (imagen_final, resumen, estadísticas)"""
+        # Cada imagen usa un preprocesador de trabajo con esta configuración (ver
+        # batch.BatchRunner): el resultado es el de procesarla sola, en memoria y sin stage_cache
+        try:
+            return BatchRunner(self, workers).run(list(images))
+        except Exception as e:
+            raise ValueError(f"Error en procesamiento por lotes: {str(e)}")
+    
+    def _batch_worker(self):
+        """Preprocesador con la misma configuración para una imagen de un lote"""
+        worker = ImagePreprocessor(
+            stats_mode=self.stats_mode, stage_retention=self.stage_retention, fuse_pointwise=self.fuse_pointwise,
+            filter_mode=self.filter_mode, accelerated=self.accelerated, pipeline=self.pipeline,
+            gating=self.gating or False, tile_executor=self._tile_executor, content_region=self.content_region,
+            stats_include_padding=self.stats_include_padding, target_size=self.target_size,
+            express_model=self.express_model)
+        worker._frozen_parameters = self._frozen_parameters
+        worker.enable_statistics = self.enable_statistics
+        return worker
+    
+    def _batch_source(self, image):
+        """Imagen PIL RGB de un elemento del lote (una imagen ya abierta o un archivo subido)"""
+        if not isinstance(image, Image.Image):
+            return self._load_upload(image)
+        self._source_iso = self._read_exif_iso(image)
+        return image if image.mode == 'RGB' else image.convert('RGB')
+    
+    def estimate_global_parameters(self, uploaded_file, side=None):
+        """Fase de estimación: parámetros globales del pipeline (GlobalParameters) medidos en un nivel reducido"""
+        # Dependen de las etapas anteriores, así que se miden con el pipeline completo
+        # (en memoria) y no sobre la entrada; stage_images y processing_stats quedan
+        # los de este nivel hasta el siguiente procesamiento
+        side = side or self.PARAMETER_ESTIMATION_SIZE
+        if not isinstance(uploaded_file, Image.Image):
+            uploaded_file = self._load_upload(uploaded_file, side)
+        
+        target_size, memory_limit_mb = self.target_size, self.memory_limit_mb
+        self.target_size = self._level_target_size(side)
+        self.memory_limit_mb = None
+        try:
+            reduced = self._reduce_for_level(uploaded_file)
+            self._process_loaded(reduced, time.time())
+            # Métricas de detect_and_correct_issues sobre la imagen de entrada reducida
+            self.detect_and_correct_issues(reduced)
+            return GlobalParameters(self.estimated_parameters, uploaded_file.size, self.target_size)
+        finally:
+            self.target_size, self.memory_limit_mb = target_size, memory_limit_mb
+    
+    def _level_target_size(self, side, target_size=None):
+        """target_size escalado para que su lado mayor mida `side`"""
+        target_size = target_size or self.target_size
+        scale = side / max(target_size)
+        return tuple(max(1, int(round(length * scale))) for length in target_size)
+    
+    def _load_upload(self, uploaded_file, draft_size=None):
+        """Abre la imagen subida orientada según EXIF y en RGB (los JPEG, a escala reducida si hay `draft_size`)"""
+        # Leer la imagen original
+        image = Image.open(uploaded_file)
+        
+        # ISO de la cámara, si la foto lo incluye (orienta la reducción de ruido)
+        self._source_iso = self._read_exif_iso(image)
+        
+        if draft_size is not None:
+            image.draft('RGB', (draft_size,) * 2)
+        
+        # Corregir orientación EXIF (importante para fotos de cámara)
+        image = ImageOps.exif_transpose(image)
+        
+        # Convertir a RGB si es necesario
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return image
+    
+    def _process_loaded(self, image, start_time, output_path=None, parameters=None):
+        """Ejecuta el pipeline sobre la imagen ya abierta y devuelve (imagen_final, resumen)"""
+        # Referencias de solo lectura a la salida de cada etapa (sin copias)
+        self.stage_images = StageStore(self.stage_retention, on_release=self._release_stage_stats)
+        self.content_rect = None
+        self.skipped_stages = []
+        self.cached_stages = []
+        self.estimated_parameters = {}
+        self._similarity_views = (None, None)
+        streaming = None
+        
+        # `parameters` se añade a los parámetros fijados solo durante esta ejecución
+        frozen_parameters = self._frozen_parameters
+        if parameters:
+            self._frozen_parameters = {**frozen_parameters, **parameters}
+        try:
+            if self.memory_limit_mb is not None:
+                # Por franjas: las etapas se registran como miniaturas
+                final_image, streaming = StripePipeline(self, self.memory_limit_mb).run(image, output_path)
+            else:
+                # Convertir a numpy array para procesamiento
+                current_image = np.array(image)
+                
+                # Etapas definidas por la especificación del pipeline
+                self._source_image = image
+                if self.stage_cache is not None:
+                    self._stage_keys = self._stage_cache_keys(current_image)
+                try:
+                    final_image = Image.fromarray(self._run_pipeline(current_image))
+                finally:
+                    self._source_image = None
+                    self._pipeline_input = None
+                    self._stage_keys = None
+            fixed = sorted(name for name in self.estimated_parameters if name in self._frozen_parameters)
+        finally:
+            self._frozen_parameters = frozen_parameters
+        
+        return final_image, self._processing_summary(start_time, streaming, fixed)
+    
+    def _processing_summary(self, start_time, streaming=None, fixed=()):
+        """Resumen del último procesamiento de este preprocesador"""
+        processing_time = time.time() - start_time
+        
+        return {
+            'processing_time': processing_time,
+            'stages_completed': list(self.processing_stats.keys()),
+            'total_stages': len(self.pipeline),
+            'pipeline': self.pipeline.name,
+            'skipped_stages': list(self.skipped_stages),
+            'cached_stages': list(self.cached_stages),
+            'content_rect': list(self.content_rect) if self._processes_content_region() else None,
+            'streaming': streaming,
+            'global_parameters': dict(self.estimated_parameters),
+            'fixed_parameters': list(fixed),
+            'quality_improvement': self._calculate_quality_improvement(),
+            'file_size_change': self._calculate_size_change()
+        }
+    
+    def _reduce_for_level(self, image):
+        """Reduce la fuente de un nivel previo a no menos del doble de su tamaño objetivo"""
+        # Por bloques: mucho más barato que el Lanczos sobre la imagen completa y apenas cambia el resultado
+        ratio = min(self.target_size[0] / image.width, self.target_size[1] / image.height)
+        factor = int(1 / (2 * ratio)) if ratio < 0.5 else 1
+        return image.reduce(factor) if factor > 1 else image
+    
+    def _global_parameter(self, name, estimate):
+        """Valor de un parámetro global (el fijado o el de `estimate()`), anotado en estimated_parameters"""
+        if name in self._frozen_parameters:
+            value = self._frozen_parameters[name]
+        else:
+            value = estimate()
+        self.estimated_parameters[name] = value
+        return value
+    
+    def _run_pipeline(self, image):
+        """Ejecuta los pasos de self.pipeline y devuelve la imagen final"""
+        steps = self.pipeline.steps
+        self.skipped_stages = []
+        i = 0
+        self._pipeline_input = image
+        # Con stage_cache se continúa tras el prefijo de etapas ya guardado
+        if self._stage_keys is not None:
+            i, image = self._resume_from_cache(image)
+        while i < len(steps):
+            step = steps[i]
+            following = steps[i + 1] if i + 1 < len(steps) else None
             
-            # ETAPA 15: OPTIMIZACIÓN FINAL
-            final_result = self._final_optimization(current_image)
-            self.calculate_image_statistics(Image.fromarray(final_result), 'step15_final')
-            self.stage_images['step15_final'] = final_result.copy()
+            # Una etapa de efecto previsto despreciable se registra con su entrada sin cambios
+            reason = self._gate_stage(step, image)
+            if reason is not None:
+                self.skipped_stages.append({'stage': step.stage, 'op': step.op.name, 'reason': reason})
+                image = self._record_stage(step.stage, image)
+                i += 1
+                continue
             
-            # Resumen del procesamiento
-            processing_time = time.time() - start_time
+            # normalize + adaptive_gamma en una sola LUT; la etapa normalizada queda diferida
+            if (self.fuse_pointwise and step.op.name == 'normalize'
+                    and following is not None and following.op.name == 'adaptive_gamma'):
+                normalized_views, gamma_corrected = self._fused_normalize_gamma(image, following.params['gamma'])
+                self._record_deferred_stage(step.stage, normalized_views, image)
+                image = self._record_stage(following.stage, gamma_corrected)
+                i += 2
+                continue
             
-            processing_summary = {
-                'processing_time': processing_time,
-                'stages_completed': list(self.processing_stats.keys()),
-                'total_stages': 15,
-                'quality_improvement': self._calculate_quality_improvement(),
-                'file_size_change': self._calculate_size_change()
-            }
+            # Etapas lineales consecutivas con un único plan de filtros si filter_mode no es 'exact'
+            if step.op.kind == 'linear':
+                run = [step]
+                while (i + len(run) < len(steps) and steps[i + len(run)].op.kind == 'linear'
+                        and self._gate_stage(steps[i + len(run)], image) is None):
+                    run.append(steps[i + len(run)])
+                image = self._run_linear_steps(image, run)
+                i += len(run)
+                continue
             
-            return Image.fromarray(final_result), processing_summary
+            output = self._apply_step(step, image)
+            image = self._record_stage(step.stage, output)
+            i += 1
+        
+        # Con content_region las etapas solo han procesado el rectángulo con contenido
+        if self._processes_content_region():
+            return self._compose_canvas(image)
+        return image
+    
+    def _apply_step(self, step, image):
+        """Aplica un paso de la especificación, por teselas si el paso lo pide"""
+        method = getattr(self, step.op.method)
+        if not step.tiled:
+            return method(image, **step.params)
+        if step.op.tiling == 'executor':
+            return method(image, executor=self.tile_executor, **step.params)
+        return self.tile_executor.map(lambda tile: method(tile, **step.params), image, step.op.halo(step.params))
+    
+    def _gate_stage(self, step, image):
+        """Motivo para omitir `step` sobre `image`, o None si debe ejecutarse"""
+        if self.gating is None or not self.gating.applies_to(step.op.name):
+            return None
         
-        except Exception as e:
-            raise ValueError(f"Error en procesamiento completo: {str(e)}")
+        # Las métricas de la etapa anterior ya describen esta imagen; en modo
+        # 'lazy' solo se calcula la métrica que consulta la regla
+        return self.gating.check(step.op.name, self._input_stats(image))
+    
+    def _run_linear_steps(self, image, run):
+        """Aplica una secuencia de etapas lineales, en un solo plan si el modo lo permite"""
+        names = [step.op.name for step in run]
+        if self.filter_mode == 'exact' or len(run) == 1:
+            for step in run:
+                image = self._record_stage(step.stage, self.apply_linear_chain(image, step.op.name))
+            return image
+        
+        source = image
+        for k, step in enumerate(run[:-1]):
+            prefix = tuple(names[:k + 1])
+            views = DerivedViews(factory=lambda prefix=prefix: self.apply_linear_chain(source, *prefix))
+            self._record_deferred_stage(step.stage, views, source)
+        return self._record_stage(run[-1].stage, self.apply_linear_chain(source, *names))
+    
+    def _stage_original(self, image):
+        """Etapa inicial: la imagen de entrada tal cual"""
+        return image
+    
+    def _stage_resize(self, image):
+        """Redimensionamiento a partir de la imagen PIL de entrada (solo el contenido con content_region)"""
+        canvas = self.resize_image_advanced(self._source_image)
+        if not self.content_region:
+            return canvas
+        y0, y1, x0, x1 = self.content_rect
+        return canvas[y0:y1, x0:x1].copy()
+    
+    def _processes_content_region(self):
+        """Indica si las etapas trabajan sobre el rectángulo con contenido de la imagen actual"""
+        return self.content_region and self.content_rect is not None
+    
+    def _compose_canvas(self, content, stage_name=None):
+        """Coloca la salida de `stage_name` (o la final) sobre un lienzo nuevo con el color de relleno"""
+        height, width, background = self._canvas
+        # El relleno está en el orden BGR del redimensionado: sigue al contenido
+        # cuando una etapa anterior ha invertido los canales
+        if self.pipeline.swaps_channels(stage_name):
+            background = background[::-1]
+        y0, y1, x0, x1 = self.content_rect
+        canvas = np.empty((height, width) + content.shape[2:], dtype=content.dtype)
+        canvas[:] = background
+        canvas[y0:y1, x0:x1] = content
+        return canvas
+    
+    def _stats_on_canvas(self):
+        """Indica si las estadísticas de las etapas deben incluir el relleno"""
+        return self.stats_include_padding and self._processes_content_region()
+    
+    def _stage_color_correction(self, image):
+        """Corrección de color; el resultado se reinterpreta como RGB igual que en el pipeline original"""
+        return cv2.cvtColor(self.correct_colors(image), cv2.COLOR_BGR2RGB)
+    
+    def _record_stage(self, stage_name, image):
+        """Registra la salida de una etapa: instantánea de solo lectura y estadísticas"""
+        # Al quedar como solo lectura, sus vistas derivadas pueden compartirse con la etapa siguiente
+        image = self.stage_images.add(stage_name, image)
+        stats_image = self._compose_canvas(image, stage_name) if self._stats_on_canvas() else image
+        stats = self.calculate_image_statistics(stats_image, stage_name)
+        annotations = self._stage_annotations
+        if annotations:
+            self._annotate_stats(stats, annotations)
+            self._stage_annotations = {}
+        self._annotate_similarity(stats, image, image.shape)
+        self._current_stats = (image, stats)
+        self._release_stats_views(stats)
+        if self._stage_keys is not None:
+            skipped = self.skipped_stages[-1]['reason'] if (
+                self.skipped_stages and self.skipped_stages[-1]['stage'] == stage_name) else None
+            source = image is self._pipeline_input
+            self.stage_cache.put(self._stage_keys[stage_name], None if source else image, self._cache_state(),
+                                 skipped, annotations, source)
+        return image
+    
+    @staticmethod
+    def _annotate_stats(stats, values):
+        """Añade a las estadísticas de una etapa valores decididos por la propia etapa"""
+        if isinstance(stats, LazyImageStatistics):
+            stats.annotate(**values)
+        elif isinstance(stats, dict):
+            stats.update(values)
+    
+    def apply_linear_chain(self, image, *stage_names):
+        """Aplica etapas lineales consecutivas según el modo de filtrado"""
+        # En modo 'composed' las adyacentes se agrupan en un kernel si el modelo de coste
+        # lo considera más barato; el plan se calcula una vez por secuencia de etapas
+        if self.filter_mode == 'exact':
+            for name in stage_names:
+                image = self.linear_stages[name].native(image)
+            return image
+
+        plan = self._linear_plans.get(stage_names)
+        if plan is None:
+            plan = plan_linear_chain(
+                [self.linear_stages[name] for name in stage_names],
+                tolerant=self.filter_mode == 'tolerant'
+            )
+            self._linear_plans[stage_names] = plan
+        for group in plan:
+            image = group.apply(image)
+        return image
+    
+    def _release_stage_stats(self, stage_name):
+        """Calcula las estadísticas perezosas pendientes de una etapa que el StageStore deja de conservar"""
+        # Después ya no habría imagen de la que calcularlas, y mientras estén
+        # pendientes retienen la imagen completa de la etapa. Lo mismo con las
+        # de 'original' y 'resized' que registra el redimensionado fuera del store
+        stages = {step.stage for step in self.pipeline.steps}
+        for name, stats in self.processing_stats.items():
+            if ((name == stage_name or name not in stages) and isinstance(stats, LazyImageStatistics)
+                    and not stats.is_materialized):
+                stats.materialize()
+    
+    def _release_stats_views(self, current):
+        """Suelta las vistas derivadas de las estadísticas perezosas de las etapas anteriores a `current`"""
+        # Las reglas de omisión solo leen las métricas de la etapa actual: en las
+        # anteriores, las vistas (gradientes float64 incluidos) se recalculan si
+        # alguien consulta sus métricas
+        for stats in self.processing_stats.values():
+            if stats is not current and isinstance(stats, LazyImageStatistics):
+                stats.release_views()
+    
+    def _record_deferred_stage(self, stage_name, views, like):
+        """Registra una etapa fusionada cuya imagen (y estadísticas) se reconstruyen bajo demanda"""
+        self.stage_images.add_deferred(stage_name, lambda: views.image)
+        if self._stage_keys is not None:
+            self.stage_cache.put(self._stage_keys[stage_name], None)
+        if self.enable_statistics:
+            content_views, shape = views, like.shape
+            if self._stats_on_canvas():
+                views = DerivedViews(factory=lambda: self._compose_canvas(content_views.image, stage_name))
+                like = self._compose_canvas(like, stage_name)
+            # `like` tiene la misma forma y tipo que la salida no materializada
+            stats = LazyImageStatistics(self.stats_engine, like, stage_name, views)
+            self.processing_stats[stage_name] = stats
+            self._annotate_similarity(stats, lambda: content_views.image, shape)
+    
+    def _annotate_similarity(self, stats, source, shape):
+        """Añade a las estadísticas de una etapa su SSIM/PSNR frente a la etapa anterior y al original"""
+        # El original es la primera etapa con la geometría actual: la que cambia la
+        # geometría no tiene referencias y sus métricas quedan a None
+        if not self.enable_statistics or not isinstance(stats, (dict, LazyImageStatistics)):
+            return
+        current = ReducedView(source, shape, self.SIMILARITY_SIZE)
+        previous, original = self._similarity_views
+        if previous is None or previous.shape != current.shape:
+            previous = original = None
+            self._similarity_views = (current, current)
+        else:
+            self._similarity_views = (current, original)
+        
+        compute = lambda: stage_similarity(current, previous, original)
+        if isinstance(stats, LazyImageStatistics):
+            stats.annotate_deferred(compute, *SIMILARITY_METRICS)
+        else:
+            stats.update(compute())
+    
+    def _stage_cache_keys(self, image):
+        """Clave de caché de cada etapa del pipeline para la imagen de entrada `image`"""
+        # La primera encadena el contenido, la versión del código y la configuración que
+        # cambia el resultado; cada etapa añade su nombre, operación y parámetros
+        gating = None
+        if self.gating is not None:
+            gating = sorted((gate.op, gate.metric, gate.threshold) for gate in self.gating.gates.values())
+        config = {
+            'content': content_hash(image),
+            'code': code_version(),
+            'target_size': self.target_size,
+            'content_region': self.content_region,
+            'fuse_pointwise': self.fuse_pointwise,
+            'filter_mode': self.filter_mode,
+            'accelerated': self.accelerated,
+            'gating': gating,
+            'iso': self._source_iso,
+            'parameters': sorted((name, _freeze(value)) for name, value in self._frozen_parameters.items()),
+        }
+        if any(step.op.name == 'express' for step in self.pipeline.steps):
+            config['express'] = [
+                self._express_model(step.params.get('model')).fingerprint
+                for step in self.pipeline.steps if step.op.name == 'express'
+            ]
+        
+        keys = {}
+        key = chain_key('', config)
+        for step in self.pipeline.steps:
+            key = chain_key(key, [step.stage, step.op.name, step.op.resolve_params(step.params)])
+            keys[step.stage] = key
+        return keys
+    
+    def _cache_state(self):
+        """Estado que dejan las etapas y necesitan las siguientes al retomar desde la caché"""
+        return {
+            'parameters': dict(self.estimated_parameters),
+            'content_rect': self.content_rect,
+            'canvas': self._canvas,
+        }
+    
+    def _resume_from_cache(self, image):
+        """Registra el prefijo más largo de etapas guardadas y devuelve (índice siguiente, imagen)"""
+        # Las etapas fusionadas vuelven a registrarse diferidas; el prefijo termina
+        # siempre en una etapa con imagen guardada
+        steps = self.pipeline.steps
+        entries = []
+        for step in steps:
+            entry = self.stage_cache.get(self._stage_keys[step.stage])
+            if entry is None:
+                break
+            entries.append(entry)
+        while entries and entries[-1].deferred:
+            entries.pop()
+        if not entries:
+            return 0, image
+        
+        source = lambda image=image: image
+        for step, entry in zip(steps, entries):
+            if entry.deferred:
+                views = DerivedViews(factory=lambda step=step, source=source: self._recompute_step(step, source()))
+                self._record_deferred_stage(step.stage, views, image)
+                source = lambda views=views: views.image
+            else:
+                state = entry.state
+                self.estimated_parameters = dict(state.get('parameters', {}))
+                self.content_rect = state.get('content_rect')
+                self._canvas = state.get('canvas')
+                if step.op.name == 'resize':
+                    self._restore_resize_stats(entry.image, step.stage)
+                if entry.skipped:
+                    self.skipped_stages.append({'stage': step.stage, 'op': step.op.name, 'reason': entry.skipped})
+                self._stage_annotations = dict(entry.annotations)
+                image = self._record_stage(step.stage, self._pipeline_input if entry.source else entry.image)
+                source = lambda image=image: image
+            self.cached_stages.append(step.stage)
+        return len(entries), image
+    
+    def _recompute_step(self, step, image):
+        """Salida de un paso a partir de su entrada, fuera del recorrido del pipeline"""
+        if step.op.kind == 'linear':
+            return self.apply_linear_chain(image, step.op.name)
+        return self._apply_step(step, image)
+    
+    def _restore_resize_stats(self, image, stage_name):
+        """Estadísticas 'original' y 'resized' que registra el redimensionado, desde su salida guardada"""
+        self.calculate_image_statistics(self._source_image, 'original')
+        if self._processes_content_region() and self.stats_include_padding:
+            image = self._compose_canvas(image, stage_name)
+        self.calculate_image_statistics(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), 'resized')
     
     def process_upload_complete(self, uploaded_file):
         """Procesamiento completo de una imagen subida con análisis estadístico"""
@@ -473,13 +1033,31 @@ class ImagePreprocessor:
                 'Saturación Promedio': f"{stats['saturation_avg']:.1f}",
                 'Rojo Promedio': f"{stats['mean_rgb'][0]:.1f}" if stats['mean_rgb'] else "N/A",
                 'Verde Promedio': f"{stats['mean_rgb'][1]:.1f}" if stats['mean_rgb'] else "N/A",
-                'Azul Promedio': f"{stats['mean_rgb'][2]:.1f}" if stats['mean_rgb'] else "N/A"
+                'Azul Promedio': f"{stats['mean_rgb'][2]:.1f}" if stats['mean_rgb'] else "N/A",
+                # Cambio que introdujo la etapa (SSIM 1 / PSNR ∞: imagen sin cambios)
+                'SSIM vs Anterior': self._format_similarity(stats.get('ssim_vs_previous'), '.3f'),
+                'PSNR vs Anterior (dB)': self._format_similarity(stats.get('psnr_vs_previous'), '.1f'),
+                'SSIM vs Original': self._format_similarity(stats.get('ssim_vs_original'), '.3f'),
+                'PSNR vs Original (dB)': self._format_similarity(stats.get('psnr_vs_original'), '.1f'),
             }
             data.append(row)
         
         df = pd.DataFrame(data)
         return df
     
+    @staticmethod
+    def _format_similarity(value, spec):
+        if value is None:
+            return "N/A"
+        return "∞" if np.isinf(value) else format(value, spec)
+    
+    def get_stage_similarity(self):
+        """SSIM/PSNR de cada etapa del pipeline frente a la anterior y al original"""
+        return {
+            stage_name: {metric: stats[metric] for metric in SIMILARITY_METRICS}
+            for stage_name, stats in self.processing_stats.items() if SIMILARITY_METRICS[0] in stats
+        }
+    
     def generate_comparison_charts(self, save_path=None):
         """Genera gráficos comparativos de todas las etapas"""
         if not self.processing_stats:
@@ -551,10 +1129,10 @@ class ImagePreprocessor:
             axes[1, 2].legend()
             axes[1, 2].grid(True, alpha=0.3)
         
-        plt.tight_layout()
+        fig.tight_layout()
         
         if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
+            fig.savefig(save_path, dpi=300, bbox_inches='tight')
         
         return fig
     
@@ -598,10 +1176,10 @@ class ImagePreprocessor:
                                          label=f'Media: {mean_val:.1f}')
                         axes[i, j].legend()
         
-        plt.tight_layout()
+        fig.tight_layout()
         
         if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
+            fig.savefig(save_path, dpi=300, bbox_inches='tight')
         
         return fig
     
@@ -663,11 +1241,11 @@ class ImagePreprocessor:
         ax.set_yticklabels(['20%', '40%', '60%', '80%', '100%'])
         ax.grid(True)
         
-        plt.title('Comparación de Métricas de Calidad\nOriginal vs Procesada', size=16, fontweight='bold', pad=20)
-        plt.legend(loc='upper right', bbox_to_anchor=(0.1, 0.1))
+        ax.set_title('Comparación de Métricas de Calidad\nOriginal vs Procesada', size=16, fontweight='bold', pad=20)
+        ax.legend(loc='upper right', bbox_to_anchor=(0.1, 0.1))
         
         if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
+            fig.savefig(save_path, dpi=300, bbox_inches='tight')
         
         return fig
     
@@ -676,8 +1254,9 @@ class ImagePreprocessor:
         report_data = {
             'processing_timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
             'stages_processed': list(self.processing_stats.keys()),
-            'detailed_stats': self.processing_stats,
+            'detailed_stats': self.get_statistics(),
             'summary_table': self.generate_statistics_table().to_dict(),
+            'stage_similarity': self.get_stage_similarity(),
             'quality_improvements': self._calculate_quality_improvement(),
             'size_changes': self._calculate_size_change()
         }
@@ -735,86 +1314,194 @@ class ImagePreprocessor:
     
     def _normalize_colors(self, image):
         """Normalización de colores RGB"""
-        normalized = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
-        return normalized.astype(np.uint8)
-    
-    def _apply_adaptive_gamma(self, image):
-        """Corrección gamma adaptativa basada en brillo"""
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        mean_brightness = np.mean(gray)
-        
-        if mean_brightness < 85:
-            gamma = 1.3
-        elif mean_brightness > 170:
-            gamma = 0.8
+        # Equivale a cv2.normalize(..., NORM_MINMAX) con el rango de la imagen o el fijado
+        lo, hi = self._global_parameter('normalize', lambda: (int(image.min()), int(image.max())))
+        return cv2.LUT(image, minmax_lut(lo, hi))
+    
+    def _apply_adaptive_gamma(self, image, gamma=None):
+        """Corrección gamma adaptativa basada en brillo (`gamma` fija el valor en lugar de elegirlo)"""
+        gamma = self._stage_gamma(image, gamma)
+        return cv2.LUT(image, gamma_lut(gamma))
+    
+    def _stage_gamma(self, image, gamma=None):
+        """Gamma de la etapa: la indicada en sus parámetros o la elegida con el brillo medio de `image`"""
+        if gamma is not None:
+            self.estimated_parameters['gamma'] = gamma
+            return gamma
+        return self._global_parameter('gamma', lambda: self._select_gamma(np.mean(self._views(image).gray)))
+    
+    def _select_gamma(self, mean_brightness):
+        """Valor gamma según el brillo medio"""
+        if mean_brightness < self.GAMMA_DARK_THRESHOLD:
+            return 1.3
+        elif mean_brightness > self.GAMMA_BRIGHT_THRESHOLD:
+            return 0.8
+        return 1.0
+    
+    def _fused_normalize_gamma(self, image, gamma=None):
+        """Normalización y gamma en una sola LUT; devuelve (vistas diferidas de la normalizada, imagen con gamma)"""
+        # El resultado es idéntico al de las dos etapas por separado
+        frozen = self._frozen_parameters
+        histograms = None
+        if 'normalize' not in frozen or ('gamma' not in frozen and gamma is None):
+            histograms = self.stats_engine.channel_histograms(image)
+        norm_lut = minmax_lut(*self._global_parameter('normalize', lambda: histogram_range(histograms.sum(axis=0))))
+        materialized = []
+        
+        def estimate_gamma():
+            # Brillo de la imagen normalizada estimado desde los histogramas (error < 0.5)
+            mean_brightness = mapped_gray_mean(histograms, norm_lut)
+            thresholds = (self.GAMMA_DARK_THRESHOLD, self.GAMMA_BRIGHT_THRESHOLD)
+            if min(abs(mean_brightness - t) for t in thresholds) >= 1.0:
+                return self._select_gamma(mean_brightness)
+            
+            # Demasiado cerca de un umbral: se materializa la etapa para decidir con el valor exacto
+            normalized = cv2.LUT(image, norm_lut)
+            normalized.flags.writeable = False
+            materialized.append((normalized, self._views(normalized)))
+            return self._select_gamma(np.mean(materialized[0][1].gray))
+        
+        if gamma is not None:
+            self.estimated_parameters['gamma'] = gamma
         else:
-            gamma = 1.0
+            gamma = self._global_parameter('gamma', estimate_gamma)
+        if materialized:
+            normalized, views = materialized[0]
+            return views, cv2.LUT(normalized, gamma_lut(gamma))
         
-        lookup_table = np.array([((i / 255.0) ** gamma) * 255 for i in np.arange(0, 256)]).astype(np.uint8)
-        return cv2.LUT(image, lookup_table)
+        fused = cv2.LUT(image, compose_luts(norm_lut, gamma_lut(gamma)))
+        return DerivedViews(factory=lambda: cv2.LUT(image, norm_lut)), fused
     
-    def _apply_edge_preserving(self, image):
+    def _apply_edge_preserving(self, image, flags=1, sigma_s=50, sigma_r=0.4, scale=1, backend='opencv'):
         """Filtro que preserva bordes"""
-        return cv2.edgePreservingFilter(image, flags=1, sigma_s=50, sigma_r=0.4)
+        # Con scale > 1 se filtra la imagen reducida (con sigma_s escalado): la salida
+        # es suave y el coste baja con el cuadrado de la escala
+        if scale == 1:
+            return edge_preserving_filter(image, flags, sigma_s, sigma_r, backend, self.accelerated)
+        
+        h, w = image.shape[:2]
+        small = cv2.resize(image, (max(1, w // scale), max(1, h // scale)), interpolation=cv2.INTER_AREA)
+        filtered = edge_preserving_filter(small, flags, sigma_s / scale, sigma_r, backend, self.accelerated)
+        return cv2.resize(filtered, (w, h), interpolation=cv2.INTER_LINEAR)
+    
+    def _express_approximation(self, image, model=None):
+        """Aproximación aprendida de las etapas que siguen a CLAHE (ver express.ExpressModel)"""
+        # La tabla de color se elige con la gamma de adaptive_gamma (o la fijada)
+        gamma = self._frozen_parameters.get('gamma', self.estimated_parameters.get('gamma'))
+        return self._express_model(model).apply(image, gamma)
+    
+    def _express_model(self, model=None):
+        """Modelo exprés: el de la ruta `model`, el de express_model o el incluido en data/"""
+        # Un ExpressModel ya cargado (también el de express.py ejecutado con python -m,
+        # cuya clase no es la importada aquí)
+        if model is None and hasattr(self.express_model, 'apply'):
+            return self.express_model
+        return load_express_model(model or self.express_model)
     
     def _enhance_edges(self, image):
         """Mejora de bordes usando filtro Sobel"""
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
-        sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-        sobel = np.sqrt(sobelx**2 + sobely**2)
-        sobel = np.clip(sobel, 0, 255).astype(np.uint8)
+        views = self._views(image)
+        sobelx = views.sobel_x
+        sobely = views.sobel_y
+        
+        # Magnitud del gradiente en buffers reutilizables
+        magnitude = self.buffers.get('edges_magnitude', sobelx.shape, np.float64)
+        squared = self.buffers.get('edges_squared', sobelx.shape, np.float64)
+        np.multiply(sobelx, sobelx, out=magnitude)
+        np.multiply(sobely, sobely, out=squared)
+        np.add(magnitude, squared, out=magnitude)
+        np.sqrt(magnitude, out=magnitude)
+        np.clip(magnitude, 0, 255, out=magnitude)
+        sobel = self.buffers.get('edges_sobel', sobelx.shape, np.uint8)
+        np.copyto(sobel, magnitude, casting='unsafe')
         
         # Mezclar con imagen original
-        sobel_rgb = cv2.cvtColor(sobel, cv2.COLOR_GRAY2RGB)
+        sobel_rgb = self.buffers.get('edges_sobel_rgb', image.shape, np.uint8)
+        cv2.cvtColor(sobel, cv2.COLOR_GRAY2RGB, dst=sobel_rgb)
         enhanced = cv2.addWeighted(image, 0.9, sobel_rgb, 0.1, 0)
         return enhanced
     
-    def _enhance_saturation(self, image):
+    def _enhance_saturation(self, image, gain=1.15):
         """Mejora de saturación"""
-        hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV).astype(np.float32)
-        hsv[:, :, 1] = hsv[:, :, 1] * 1.15
-        hsv[:, :, 1] = np.clip(hsv[:, :, 1], 0, 255)
-        return cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2RGB)
-    
-    def _white_balance(self, image):
-        """Balance de blancos automático"""
-        result = cv2.cvtColor(image, cv2.COLOR_RGB2LAB).astype(np.float32)
-        avg_a = np.mean(result[:, :, 1])
-        avg_b = np.mean(result[:, :, 2])
-        result[:, :, 1] = result[:, :, 1] - ((avg_a - 128) * (result[:, :, 0] / 255.0) * 1.1)
-        result[:, :, 2] = result[:, :, 2] - ((avg_b - 128) * (result[:, :, 0] / 255.0) * 1.1)
-        result = np.clip(result, 0, 255)
-        return cv2.cvtColor(result.astype(np.uint8), cv2.COLOR_LAB2RGB)
+        hsv = self._views(image).hsv
+        adjusted = self.buffers.get('saturation_hsv', hsv.shape, np.uint8)
+        if self.accelerated:
+            accelerated_kernels.saturation_scale(hsv, gain, out=adjusted)
+            return cv2.cvtColor(adjusted, cv2.COLOR_HSV2RGB)
+        
+        # Solo el canal S pasa por float32; H y V se copian sin cambios
+        saturation = self.buffers.get('saturation_s', hsv.shape[:2], np.float32)
+        np.multiply(hsv[:, :, 1], np.float32(gain), out=saturation, dtype=np.float32)
+        np.clip(saturation, 0, 255, out=saturation)
+        
+        np.copyto(adjusted, hsv)
+        np.copyto(adjusted[:, :, 1], saturation, casting='unsafe')
+        return cv2.cvtColor(adjusted, cv2.COLOR_HSV2RGB)
+    
+    def _white_balance(self, image, averages=None):
+        """Balance de blancos automático; `averages` fija las medias (a, b) de LAB en lugar de medirlas"""
+        lab = self._views(image).lab
+        balanced = self.buffers.get('white_balance_lab_u8', lab.shape, np.uint8)
+        if self.accelerated:
+            if averages is None:
+                averages = self._global_parameter('white_balance', lambda: (
+                    accelerated_kernels.channel_mean(lab, 1), accelerated_kernels.channel_mean(lab, 2)))
+            accelerated_kernels.white_balance_lab(lab, out=balanced, averages=averages)
+            return cv2.cvtColor(balanced, cv2.COLOR_LAB2RGB)
+        
+        result = self.buffers.get('white_balance_lab', lab.shape, np.float32)
+        np.copyto(result, lab)
+        if averages is None:
+            averages = self._global_parameter('white_balance', lambda: (
+                np.mean(result[:, :, 1]), np.mean(result[:, :, 2])))
+        avg_a, avg_b = averages
+        
+        # Corrección ponderada por la luminosidad, con el mismo orden de
+        # operaciones (y por tanto el mismo redondeo) que la versión sin buffers
+        correction = self.buffers.get('white_balance_correction', lab.shape[:2], np.float32)
+        for channel, average in ((1, avg_a), (2, avg_b)):
+            np.divide(result[:, :, 0], 255.0, out=correction)
+            np.multiply(average - 128, correction, out=correction)
+            np.multiply(correction, 1.1, out=correction)
+            np.subtract(result[:, :, channel], correction, out=result[:, :, channel])
+        np.clip(result, 0, 255, out=result)
+        
+        np.copyto(balanced, result, casting='unsafe')
+        return cv2.cvtColor(balanced, cv2.COLOR_LAB2RGB)
     
     def _enhance_texture(self, image):
         """Mejora de textura para materiales"""
-        kernel = np.array([[-0.5, -1, -0.5],
-                          [-1, 7, -1],
-                          [-0.5, -1, -0.5]])
-        enhanced = cv2.filter2D(image, -1, kernel)
+        enhanced = self.buffers.get('texture_filtered', image.shape, image.dtype)
+        cv2.filter2D(image, -1, TEXTURE_KERNEL, dst=enhanced)
         return cv2.addWeighted(image, 0.75, enhanced, 0.25, 0)
     
-    def _final_contrast_adjustment(self, image):
+    def _sharpen_blend(self, image):
+        """Realce 3x3 mezclado con la imagen original (70-30)"""
+        sharpened = self.buffers.get('sharpen_blend_filtered', image.shape, image.dtype)
+        cv2.filter2D(image, -1, SHARPEN_KERNEL, dst=sharpened)
+        return cv2.addWeighted(image, 0.7, sharpened, 0.3, 0)
+    
+    def _final_contrast_adjustment(self, image, clip_limit=1.5, tile_grid_size=8):
         """Ajuste final de contraste usando ecualización"""
-        lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
-        clahe = cv2.createCLAHE(clipLimit=1.5, tileGridSize=(8, 8))
+        lab = self._views(image).lab.copy()
+        clahe = resources.clahe(clip_limit, tile_grid_size)
         lab[:,:,0] = clahe.apply(lab[:,:,0])
         return cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
     
     def _final_optimization(self, image):
         """Optimización final con ligero suavizado"""
-        optimized = cv2.GaussianBlur(image, (3, 3), 0.5)
+        optimized = self.buffers.get('final_blur', image.shape, image.dtype)
+        cv2.GaussianBlur(image, (3, 3), 0.5, dst=optimized)
         return cv2.addWeighted(image, 0.8, optimized, 0.2, 0)
     
-    def apply_clahe_enhancement(self, image):
+    def apply_clahe_enhancement(self, image, clip_limit=2.0, tile_grid_size=8):
         """Aplica CLAHE (Contrast Limited Adaptive Histogram Equalization)"""
         # Convertir a espacio LAB para mejor procesamiento
-        lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
+        lab = self._views(image).lab
         l, a, b = cv2.split(lab)
         
         # Aplicar CLAHE al canal L (luminosidad)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        clahe = resources.clahe(clip_limit, tile_grid_size)
         l_clahe = clahe.apply(l)
         
         # Recombinar canales
@@ -824,40 +1511,86 @@ class ImagePreprocessor:
         result = cv2.cvtColor(lab_clahe, cv2.COLOR_LAB2RGB)
         return result
     
-    def denoise_image(self, image):
+    def denoise_image(self, image, h=10, h_color=10, template_window_size=7, search_window_size=21):
         """Reduce el ruido de la imagen usando Non-local Means Denoising"""
         # Aplicar Non-local Means Denoising
         denoised = cv2.fastNlMeansDenoisingColored(
             image, 
             None, 
-            h=10,           # Fuerza del filtro para componentes de luminancia
-            hColor=10,      # Fuerza del filtro para componentes de color
-            templateWindowSize=7, 
-            searchWindowSize=21
+            h=h,                # Fuerza del filtro para componentes de luminancia
+            hColor=h_color,     # Fuerza del filtro para componentes de color
+            templateWindowSize=template_window_size, 
+            searchWindowSize=search_window_size
         )
         return denoised
     
+    def _adaptive_denoise(self, image, tier='auto', max_tier='nlm_full', h=10, h_color=10,
+                          template_window_size=7, search_window_size=21, regional=False, tile_size=32,
+                          executor=None):
+        """Reducción de ruido con el nivel que corresponde al ruido medido y al ISO de la foto"""
+        # El nivel se elige con la imagen completa (con `executor` solo se reparte el
+        # filtrado) y se anota en las estadísticas de la etapa
+        engine = DenoiseEngine(h, h_color, template_window_size, search_window_size)
+        noise_level = self._input_stats(image)['noise_level']
+        if tier == 'auto':
+            tier = engine.select_tier(noise_level, self._source_iso, max_tier)
+        
+        self._stage_annotations = {
+            'denoise_tier': tier,
+            'denoise_input_noise': noise_level,
+            'denoise_iso': self._source_iso,
+        }
+        if regional:
+            denoised, tiles = engine.apply_regional(image, tier, tile_size, executor=executor)
+            self._stage_annotations['denoise_tiles'] = tiles
+            return denoised
+        return engine.apply(image, tier, executor=executor)
+    
+    def _input_stats(self, image):
+        """Estadísticas de la imagen de entrada de una etapa, reutilizando las de la etapa anterior"""
+        recorded_image, stats = self._current_stats
+        if recorded_image is not image or not stats:
+            stats = LazyImageStatistics(self.stats_engine, image, 'input', self._views(image))
+        return stats
+    
+    @staticmethod
+    def _read_exif_iso(image):
+        """ISO (ISOSpeedRatings) de los metadatos EXIF, o None si no está"""
+        try:
+            exif = image.getexif()
+            # 0x8769: IFD Exif; 0x8827: ISOSpeedRatings (algunas cámaras lo dejan en el IFD principal)
+            iso = exif.get_ifd(0x8769).get(0x8827, exif.get(0x8827))
+        except Exception:
+            return None
+        if isinstance(iso, (tuple, list)):
+            iso = iso[0] if iso else None
+        try:
+            return int(iso) if iso else None
+        except (TypeError, ValueError):
+            return None
+    
+    def _bilateral_denoise(self, image, diameter=9, sigma_color=75, sigma_space=75):
+        """Reducción de ruido ligera con filtro bilateral"""
+        return cv2.bilateralFilter(image, diameter, sigma_color, sigma_space)
+    
     def sharpen_image(self, image):
         """Mejora la nitidez de la imagen usando Unsharp Masking"""
         # Crear versión suavizada
-        gaussian = cv2.GaussianBlur(image, (0, 0), 2.0)
-        
-        # Unsharp mask
-        sharpened = cv2.addWeighted(image, 1.5, gaussian, -0.5, 0)
-        
-        # Asegurar que los valores estén en rango válido
-        sharpened = np.clip(sharpened, 0, 255).astype(np.uint8)
+        gaussian = self.buffers.get('sharpen_blur', image.shape, image.dtype)
+        cv2.GaussianBlur(image, (0, 0), 2.0, dst=gaussian)
         
-        return sharpened
+        # Unsharp mask (addWeighted ya satura el resultado a uint8)
+        return cv2.addWeighted(image, 1.5, gaussian, -0.5, 0)
     
     def correct_colors(self, image):
         """Corrección de colores y mejora de contraste"""
         # Convertir a espacio LAB
-        lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
+        lab = self._views(image).lab
         l, a, b = cv2.split(lab)
         
-        # Normalizar el canal L (luminosidad)
-        l_normalized = cv2.normalize(l, None, 0, 255, cv2.NORM_MINMAX)
+        # Normalizar el canal L (luminosidad) con su rango o el fijado
+        lo, hi = self._global_parameter('color_correction', lambda: (int(l.min()), int(l.max())))
+        l_normalized = cv2.LUT(l, minmax_lut(lo, hi))
         
         # Recombinar
         lab_corrected = cv2.merge([l_normalized, a, b])
@@ -0,0 +1,208 @@
+"""
+Métricas de calidad (PSNR/SSIM) y comparación de backends frente a la salida actual
+"""
+import time
+
+import cv2
+import numpy as np
+from skimage.metrics import structural_similarity
+
+from .edge_preserving import EDGE_PRESERVING_BACKENDS
+
+
+def psnr(reference, image):
+    """Relación señal/ruido de pico en dB entre dos imágenes uint8 (inf si son idénticas)"""
+    mse = np.mean((reference.astype(np.float64) - image.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def ssim(reference, image):
+    """Índice de similitud estructural entre dos imágenes uint8 (1.0 si son idénticas)"""
+    channel_axis = 2 if reference.ndim == 3 else None
+    return float(structural_similarity(reference, image, channel_axis=channel_axis, data_range=255))
+
+
+def fast_ssim(reference, image, window=7):
+    """SSIM con medias locales de filtro de caja, como ssim() pero sin pasar por scikit-image
+
+    Mismas constantes, ventana uniforme de `window` píxeles, covarianza
+    muestral y recorte del borde que structural_similarity, promediado entre
+    canales; pensado para imágenes pequeñas (ver ReducedView).
+    """
+    window = min(window, *reference.shape[:2])
+    window -= 1 - window % 2
+    if window < 3:
+        return float(np.array_equal(reference, image))
+
+    x = reference.astype(np.float64)
+    y = image.astype(np.float64)
+    size = (window, window)
+
+    def local_mean(values):
+        return cv2.boxFilter(values, -1, size, borderType=cv2.BORDER_REFLECT)
+
+    mean_x, mean_y = local_mean(x), local_mean(y)
+    covariance_norm = window ** 2 / (window ** 2 - 1)
+    var_x = covariance_norm * (local_mean(x * x) - mean_x * mean_x)
+    var_y = covariance_norm * (local_mean(y * y) - mean_y * mean_y)
+    cov_xy = covariance_norm * (local_mean(x * y) - mean_x * mean_y)
+
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    ssim_map = ((2 * mean_x * mean_y + c1) * (2 * cov_xy + c2)
+                / ((mean_x ** 2 + mean_y ** 2 + c1) * (var_x + var_y + c2)))
+    pad = (window - 1) // 2
+    return float(ssim_map[pad:-pad, pad:-pad].mean())
+
+
+class ReducedView:
+    """Versión de una imagen con lado mayor `side` (INTER_AREA), calculada al pedirla por primera vez
+
+    `source` es el array, que se reduce ya para no retener la imagen
+    completa, o una función que lo devuelve (etapas diferidas), que se llama
+    y se suelta en la primera consulta. Dos vistas de imágenes con la misma
+    forma tienen el mismo tamaño reducido.
+    """
+
+    def __init__(self, source, shape, side=128):
+        self._source = source
+        self.shape = tuple(shape)
+        self.side = side
+        self._image = None
+        if not callable(source):
+            self._reduce()
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._reduce()
+        return self._image
+
+    def _reduce(self):
+        source = self._source() if callable(self._source) else self._source
+        height, width = self.shape[:2]
+        scale = self.side / max(height, width)
+        if scale < 1:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            source = cv2.resize(source, size, interpolation=cv2.INTER_AREA)
+        self._image = source
+        self._source = None
+
+
+# Métricas de parecido de una etapa con la anterior y con el original
+SIMILARITY_METRICS = ('ssim_vs_previous', 'psnr_vs_previous', 'ssim_vs_original', 'psnr_vs_original')
+
+
+def stage_similarity(current, previous=None, original=None):
+    """SSIM y PSNR de una etapa frente a la anterior y al original, sobre sus ReducedView
+
+    Las comparaciones sin referencia (None) quedan a None.
+    """
+    values = dict.fromkeys(SIMILARITY_METRICS)
+    for name, reference in (('previous', previous), ('original', original)):
+        if reference is not None:
+            values[f'ssim_vs_{name}'] = fast_ssim(reference.image, current.image)
+            values[f'psnr_vs_{name}'] = psnr(reference.image, current.image)
+    return values
+
+
+def sample_images(count=6, size=512, seed=0):
+    """Imágenes de prueba: fotos de ejemplo de scikit-image y, si faltan, imágenes sintéticas suavizadas"""
+    from skimage import data
+
+    images = []
+    for name in ('astronaut', 'coffee', 'chelsea'):
+        try:
+            photo = getattr(data, name)()
+        except Exception:
+            continue
+        images.append(cv2.resize(photo, (size, size), interpolation=cv2.INTER_AREA))
+
+    rng = np.random.default_rng(seed)
+    while len(images) < count:
+        image = rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8)
+        images.append(cv2.GaussianBlur(image, (0, 0), rng.uniform(2, 6)))
+    return images[:count]
+
+
+def compare_edge_preserving(images, params=None, backends=None, preprocessor=None):
+    """Compara los backends del filtro preservador de bordes con la salida actual
+
+    La referencia es edgePreservingFilter de OpenCV a resolución completa
+    con los mismos flags, sigma_s y sigma_r; cada backend se evalúa con
+    `params` (incluida la escala). Devuelve {backend: métricas} con:
+
+    - 'psnr': PSNR del error cuadrático medio de todas las imágenes (inf
+      solo si todas coinciden) y 'psnr_min', el de la peor imagen
+    - 'ssim_mean' y 'ssim_min'
+    - 'time_ms': tiempo medio por imagen, sin la primera llamada (que puede
+      incluir la compilación de los kernels), y 'speedup' frente a la referencia
+    """
+    from .preprocessing import ImagePreprocessor
+
+    preprocessor = preprocessor or ImagePreprocessor()
+    params = {key: value for key, value in (params or {}).items() if key != 'backend'}
+    reference_params = {**params, 'scale': 1, 'backend': 'opencv'}
+    backends = backends or list(EDGE_PRESERVING_BACKENDS)
+
+    preprocessor._apply_edge_preserving(images[0], **reference_params)
+    references = []
+    reference_time = 0.0
+    for image in images:
+        start = time.perf_counter()
+        references.append(preprocessor._apply_edge_preserving(image, **reference_params))
+        reference_time += time.perf_counter() - start
+    reference_time /= len(images)
+
+    report = {}
+    for backend in backends:
+        preprocessor._apply_edge_preserving(images[0], backend=backend, **params)
+        errors, psnrs, ssims, elapsed = [], [], [], 0.0
+        for image, reference in zip(images, references):
+            start = time.perf_counter()
+            output = preprocessor._apply_edge_preserving(image, backend=backend, **params)
+            elapsed += time.perf_counter() - start
+            errors.append(np.mean((reference.astype(np.float64) - output.astype(np.float64)) ** 2))
+            psnrs.append(psnr(reference, output))
+            ssims.append(ssim(reference, output))
+
+        elapsed /= len(images)
+        mse = float(np.mean(errors))
+        report[backend] = {
+            'psnr': float(10 * np.log10(255.0 ** 2 / mse)) if mse > 0 else float('inf'),
+            'psnr_min': float(np.min(psnrs)),
+            'ssim_mean': float(np.mean(ssims)),
+            'ssim_min': float(np.min(ssims)),
+            'time_ms': elapsed * 1000,
+            'speedup': reference_time / elapsed if elapsed > 0 else float('inf'),
+        }
+    return report
+
+
+def edge_preserving_preset_report(images=None, backends=None):
+    """Comparación de backends con los parámetros del filtro en cada preset
+
+    Devuelve {preset: {backend: métricas}}; la fila del backend que usa el
+    preset indica su diferencia actual con el pipeline original.
+    """
+    from .pipeline import PRESETS, get_pipeline
+    from .preprocessing import ImagePreprocessor
+
+    images = images if images is not None else sample_images()
+    preprocessor = ImagePreprocessor()
+    report = {}
+    for name in PRESETS:
+        for step in get_pipeline(name).steps:
+            if step.op.name == 'edge_preserving':
+                report[name] = compare_edge_preserving(images, step.params, backends, preprocessor)
+    return report
+
+
+if __name__ == "__main__":
+    for preset, backends in edge_preserving_preset_report().items():
+        print(f"Preset '{preset}'")
+        for backend, metrics in backends.items():
+            print(f"  {backend:18s} PSNR {metrics['psnr']:6.2f} dB (mín {metrics['psnr_min']:6.2f})  "
+                  f"SSIM {metrics['ssim_mean']:.4f} (mín {metrics['ssim_min']:.4f})  "
+                  f"{metrics['time_ms']:7.1f} ms  x{metrics['speedup']:.2f}")
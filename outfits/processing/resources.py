@@ -0,0 +1,43 @@
+"""
+Recursos de OpenCV reutilizados entre peticiones: clasificadores y objetos CLAHE por hilo
+"""
+import threading
+
+import cv2
+
+
+# Clasificador de rostros incluido con OpenCV (en cv2.data.haarcascades)
+FACE_CASCADE_FILE = 'haarcascade_frontalface_default.xml'
+
+_thread_state = threading.local()
+
+
+def clahe(clip_limit, tile_grid_size):
+    """Objeto CLAHE del hilo actual para esos parámetros
+
+    Los objetos de OpenCV guardan buffers internos y no pueden usarse desde
+    varios hilos a la vez; cada hilo (un worker) crea el suyo la primera vez
+    y lo reutiliza en las peticiones siguientes.
+    """
+    pool = getattr(_thread_state, 'clahe', None)
+    if pool is None:
+        pool = _thread_state.clahe = {}
+    key = (float(clip_limit), int(tile_grid_size))
+    instance = pool.get(key)
+    if instance is None:
+        instance = pool[key] = cv2.createCLAHE(clipLimit=key[0], tileGridSize=(key[1], key[1]))
+    return instance
+
+
+def face_cascade():
+    """Clasificador de rostros del hilo actual, o None si no se puede cargar
+
+    El XML se lee una sola vez por hilo en lugar de en cada petición.
+    """
+    if not hasattr(_thread_state, 'face_cascade'):
+        try:
+            cascade = cv2.CascadeClassifier(cv2.data.haarcascades + FACE_CASCADE_FILE)
+            _thread_state.face_cascade = None if cascade.empty() else cascade
+        except Exception:
+            _thread_state.face_cascade = None
+    return _thread_state.face_cascade
@@ -0,0 +1,64 @@
+"""
+Retinex y reducción de arrugas de AdvancedImagePreprocessor, con su versión NumPy de referencia
+"""
+import cv2
+import numpy as np
+
+from . import accelerated as accelerated_kernels
+from .tiling import default_executor
+
+
+def single_scale_retinex(image, sigma=15, accelerated=True):
+    """Single Scale Retinex normalizado a [0, 255]
+
+    Con `accelerated` (y Numba instalado) usa accelerated.retinex_normalized
+    en las imágenes de tres canales; si no, las operaciones NumPy.
+    """
+    if accelerated and accelerated_kernels.AVAILABLE and len(image.shape) == 3:
+        return accelerated_kernels.retinex_normalized(image, sigma)
+
+    if len(image.shape) == 3:
+        result = np.zeros_like(image, dtype=np.float32)
+        for i in range(3):
+            channel = image[:,:,i].astype(np.float32) + 1.0
+            blurred = cv2.GaussianBlur(channel, (0, 0), sigma)
+            result[:,:,i] = np.log(channel) - np.log(blurred)
+    else:
+        image_float = image.astype(np.float32) + 1.0
+        blurred = cv2.GaussianBlur(image_float, (0, 0), sigma)
+        result = np.log(image_float) - np.log(blurred)
+
+    # Normalizar a rango [0, 255]
+    result = (result - result.min()) / (result.max() - result.min()) * 255
+    return result.astype(np.uint8)
+
+
+def wrinkle_reduction(image, smoothing_strength=0.8, accelerated=True, tile_executor=None):
+    """Reducción de arrugas: suavizado bilateral solo en las zonas con mucha textura
+
+    La mezcla usa accelerated.masked_blend con `accelerated` (y Numba
+    instalado) y np.where canal a canal si no.
+    """
+    # Detectar regiones con alta variación (posibles arrugas)
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    laplacian = cv2.Laplacian(gray, cv2.CV_64F)
+
+    # Crear máscara de áreas con mucha textura
+    texture_mask = np.abs(laplacian) > np.percentile(np.abs(laplacian), 70)
+
+    # Aplicar suavizado solo en esas áreas
+    executor = tile_executor or default_executor()
+    smoothed = executor.map(lambda tile: cv2.bilateralFilter(tile, 9, 80, 80), image, 4)
+
+    # Mezclar usando la máscara
+    if accelerated and accelerated_kernels.AVAILABLE:
+        return accelerated_kernels.masked_blend(image, smoothed, texture_mask, smoothing_strength)
+
+    result = image.copy().astype(np.float32)
+    for i in range(3):
+        result[:,:,i] = np.where(texture_mask,
+                               result[:,:,i] * (1 - smoothing_strength) +
+                               smoothed[:,:,i] * smoothing_strength,
+                               result[:,:,i])
+
+    return np.clip(result, 0, 255).astype(np.uint8)
@@ -0,0 +1,252 @@
+"""
+Caché de las salidas de cada etapa entre procesamientos, con claves encadenadas por prefijo
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from .parameters import _freeze
+
+
+# Archivos cuyo contenido forma parte de la versión del código de las claves
+_PACKAGE_DIR = os.path.dirname(__file__)
+
+
+@lru_cache(maxsize=1)
+def code_version():
+    """Huella de los módulos de processing y de sus datos (modelos ajustados)
+
+    Cualquier cambio en el código de las etapas invalida las entradas
+    guardadas, también las del disco de una versión anterior.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    paths = sorted(glob.glob(os.path.join(_PACKAGE_DIR, '*.py')) + glob.glob(os.path.join(_PACKAGE_DIR, 'data', '*')))
+    for path in paths:
+        digest.update(os.path.relpath(path, _PACKAGE_DIR).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def content_hash(image):
+    """Huella del contenido de un array (forma, tipo y píxeles)"""
+    image = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((image.shape, image.dtype.str)).encode())
+    digest.update(memoryview(image).cast('B'))
+    return digest.hexdigest()
+
+
+def chain_key(previous, description):
+    """Clave de una etapa: la de la etapa anterior más su descripción (nombre, operación, parámetros)"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(previous.encode())
+    digest.update(json.dumps(description, sort_keys=True, default=repr).encode())
+    return digest.hexdigest()
+
+
+def _jsonable(value):
+    """Metadatos de una entrada como tipos JSON (el disco guarda las tuplas como listas)"""
+    if isinstance(value, dict):
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    value = _freeze(value)
+    if isinstance(value, tuple):
+        return [_jsonable(item) for item in value]
+    return value
+
+
+class CachedStage:
+    """Salida guardada de una etapa y el estado que dejó en el preprocesador
+
+    `image` es None en las etapas fusionadas que solo se registraron
+    diferidas, que se reconstruyen aplicando la etapa a la anterior, y en las
+    que devolvieron la propia imagen de entrada del pipeline (`source`), que
+    no se guarda otra vez. `state` guarda los parámetros globales usados
+    hasta esa etapa y el rectángulo de contenido; `skipped` el motivo si la
+    etapa se omitió y `annotations` los valores que la etapa añadió a sus
+    estadísticas.
+    """
+
+    def __init__(self, image, state=None, skipped=None, annotations=None, source=False):
+        self.image = image
+        self.state = state or {}
+        self.skipped = skipped
+        self.annotations = annotations or {}
+        self.source = source
+
+    @property
+    def deferred(self):
+        return self.image is None and not self.source
+
+    @property
+    def nbytes(self):
+        return 0 if self.image is None else self.image.nbytes
+
+    def metadata(self):
+        return {'state': self.state, 'skipped': self.skipped, 'annotations': self.annotations, 'source': self.source}
+
+
+class StageCache:
+    """Caché LRU de salidas de etapas acotada en bytes, con un nivel opcional en disco
+
+    Las claves las calcula ImagePreprocessor encadenando el contenido de la
+    imagen de entrada, la versión del código, la configuración y el nombre,
+    la operación y los parámetros de cada etapa, así que una etapa coincide
+    solo si coinciden también todas las anteriores. Las imágenes guardadas
+    son de solo lectura y se comparten con el StageStore de quien las lee.
+
+    En memoria se conservan como mucho `max_bytes`; si se indica `directory`,
+    cada entrada se escribe además en un .npz y al expulsarla de memoria
+    sigue disponible en disco (hasta `max_disk_bytes`, descartando primero
+    los archivos usados hace más tiempo). Es segura entre hilos.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, directory=None, max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def nbytes(self):
+        """Memoria ocupada por las imágenes retenidas"""
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.directory is not None and os.path.exists(self._path(key))
+
+    def get(self, key):
+        """Entrada de `key` (CachedStage) o None; las del disco vuelven a memoria"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._read(key) if self.directory else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._insert(key, entry)
+        return entry
+
+    def put(self, key, image, state=None, skipped=None, annotations=None, source=False):
+        """Guarda la salida de una etapa (ver CachedStage); no hace nada si ya está"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            if image is not None:
+                image.flags.writeable = False
+            entry = CachedStage(image, state, skipped, annotations, source)
+            self._insert(key, entry)
+        if self.directory:
+            self._write(key, entry)
+
+    def clear(self):
+        """Vacía la memoria y, si lo hay, el nivel en disco"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, '*.npz')):
+                os.remove(path)
+
+    def _insert(self, key, entry):
+        # Una entrada mayor que el límite no se retiene en memoria
+        if entry.nbytes > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += entry.nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def _write(self, key, entry):
+        """Escribe la entrada en disco (a un temporal y renombrando, por si hay lectores)"""
+        path = self._path(key)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        arrays = {'metadata': np.array(json.dumps(_jsonable(entry.metadata())))}
+        if entry.image is not None:
+            arrays['image'] = entry.image
+        with open(temporary, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temporary, path)
+        self._trim_disk()
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                metadata = json.loads(str(data['metadata']))
+                image = data['image'] if 'image' in data else None
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        if image is not None:
+            image.flags.writeable = False
+        state = metadata['state']
+        state = {
+            'parameters': {name: _freeze(value) for name, value in state.get('parameters', {}).items()},
+            'content_rect': _freeze(state.get('content_rect')),
+            'canvas': _freeze(state.get('canvas')),
+        }
+        return CachedStage(image, state, metadata['skipped'], metadata['annotations'], metadata['source'])
+
+    def _trim_disk(self):
+        """Borra los archivos usados hace más tiempo hasta quedar bajo max_disk_bytes"""
+        if self.max_disk_bytes is None:
+            return
+        files = []
+        for path in glob.glob(os.path.join(self.directory, '*.npz')):
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            files.append((status.st_mtime, status.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_stage_cache():
+    """Caché compartida por el proceso, solo en memoria"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = StageCache()
+        return _default_cache
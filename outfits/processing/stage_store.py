@@ -0,0 +1,115 @@
+"""
+Almacén de imágenes intermedias del pipeline de preprocesamiento
+"""
+from collections.abc import Mapping
+
+import cv2
+
+
+class _DeferredStage:
+    """Etapa cuya imagen se reconstruye solo si alguien la consulta"""
+
+    def __init__(self, factory):
+        self.factory = factory
+
+
+class StageStore(Mapping):
+    """Guarda referencias de solo lectura a la salida de cada etapa, sin copias
+
+    Cada etapa produce un array nuevo, así que basta con marcarlo como de solo
+    lectura para que ninguna etapa posterior pueda modificar una instantánea ya
+    guardada. La política de retención decide qué se conserva:
+
+    - 'all': todas las etapas a resolución completa
+    - 'final': solo la última etapa registrada
+    - 'thumbnails': la última etapa completa y miniaturas de las anteriores
+
+    Las etapas fusionadas registran su salida intermedia con `add_deferred`:
+    la imagen se calcula al accederla por primera vez.
+
+    `on_release(stage_name)` se llama cuando una etapa deja de conservarse
+    a resolución completa (se descarta o se reduce a miniatura), antes de
+    soltar su imagen.
+    """
+
+    RETENTION_POLICIES = ('all', 'final', 'thumbnails')
+
+    def __init__(self, retention='all', thumbnail_size=128, on_release=None):
+        if retention not in self.RETENTION_POLICIES:
+            raise ValueError(f"Política de retención no soportada: {retention}")
+
+        self.retention = retention
+        self.thumbnail_size = thumbnail_size
+        self.on_release = on_release
+        self._images = {}
+        self._last_stage = None
+
+    def add(self, stage_name, image):
+        """Registra la salida de una etapa y la devuelve marcada como de solo lectura"""
+        image.flags.writeable = False
+        self._release_last_stage()
+        self._images[stage_name] = image
+        self._last_stage = stage_name
+        return image
+
+    def add_deferred(self, stage_name, factory):
+        """Registra una etapa cuya imagen se obtiene llamando a `factory` cuando se necesite"""
+        self._release_last_stage()
+        self._images[stage_name] = _DeferredStage(factory)
+        self._last_stage = stage_name
+
+    def __getitem__(self, stage_name):
+        entry = self._images[stage_name]
+        if isinstance(entry, _DeferredStage):
+            image = entry.factory()
+            image.flags.writeable = False
+            if self.retention == 'thumbnails' and stage_name != self._last_stage:
+                image = self._thumbnail(image)
+            self._images[stage_name] = entry = image
+        return entry
+
+    def __iter__(self):
+        return iter(self._images)
+
+    def __len__(self):
+        return len(self._images)
+
+    @property
+    def nbytes(self):
+        """Memoria ocupada por las imágenes retenidas"""
+        return sum(
+            image.nbytes for image in self._images.values()
+            if not isinstance(image, _DeferredStage)
+        )
+
+    def clear(self):
+        """Libera todas las imágenes retenidas"""
+        self._images.clear()
+        self._last_stage = None
+
+    def _release_last_stage(self):
+        """La etapa que deja de ser la final se descarta ('final') o se reduce a miniatura ('thumbnails')"""
+        if self.retention == 'all' or self._last_stage is None:
+            return
+
+        if self.on_release is not None:
+            self.on_release(self._last_stage)
+        if self.retention == 'final':
+            self._images.clear()
+            return
+
+        previous = self._images[self._last_stage]
+        if not isinstance(previous, _DeferredStage):
+            self._images[self._last_stage] = self._thumbnail(previous)
+
+    def _thumbnail(self, image):
+        """Miniatura de solo lectura con el lado mayor igual a thumbnail_size"""
+        h, w = image.shape[:2]
+        scale = self.thumbnail_size / max(h, w)
+        if scale >= 1:
+            return image
+
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        thumbnail = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        thumbnail.flags.writeable = False
+        return thumbnail
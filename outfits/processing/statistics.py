@@ -0,0 +1,416 @@
+"""
+Motor de estadísticas fusionado para las etapas de preprocesamiento
+"""
+import time
+from collections.abc import Mapping
+
+import cv2
+import numpy as np
+
+from .derived_views import DerivedViews
+
+CHANNEL_NAMES = ['R', 'G', 'B']
+
+# Valores de intensidad posibles en una imagen uint8
+_LEVELS = np.arange(256, dtype=np.float64)
+_LEVELS_SQ = _LEVELS ** 2
+
+# calcHist acumula en float32: por encima de 2^24 píxeles los conteos pierden precisión
+_CALCHIST_MAX_PIXELS = 1 << 24
+
+# Grupo de cálculo que produce cada métrica costosa
+METRIC_GROUPS = {
+    'mean_rgb': 'channels',
+    'std_rgb': 'channels',
+    'min_rgb': 'channels',
+    'max_rgb': 'channels',
+    'median_rgb': 'channels',
+    'histograms': 'channels',
+    'brightness': 'channels',
+    'contrast': 'channels',
+    'blur_metric': 'blur_metric',
+    'noise_level': 'noise_level',
+    'saturation_avg': 'saturation_avg',
+}
+
+
+class StatisticsEngine:
+    """Calcula las estadísticas de una etapa a partir de un único histograma por canal"""
+
+    def compute(self, img_array, stage_name, views=None):
+        """Calcula el diccionario completo de estadísticas de una imagen
+
+        `views` permite reutilizar las conversiones (gris, HSV, Laplaciano) que
+        otras etapas ya calcularon sobre la misma imagen.
+        """
+        stats = self.base_stats(img_array, stage_name)
+
+        if self.is_color(img_array):
+            if views is None:
+                views = DerivedViews(img_array)
+            for group in dict.fromkeys(METRIC_GROUPS.values()):
+                stats.update(self.compute_group(group, views))
+
+        return stats
+
+    def compute_group(self, group, views):
+        """Calcula un grupo de métricas a partir de las vistas derivadas de la imagen"""
+        if group == 'channels':
+            return self.channel_statistics(views.image)
+        if group == 'blur_metric':
+            return {'blur_metric': self.blur_metric(laplacian=views.laplacian)}
+        if group == 'noise_level':
+            return {'noise_level': self.noise_level(views.gray)}
+        if group == 'saturation_avg':
+            return {'saturation_avg': self.saturation_avg(views.image, hsv=views.hsv)}
+
+        raise KeyError(group)
+
+    @staticmethod
+    def is_color(img_array):
+        """Indica si la imagen tiene canales de color (RGB o RGBA)"""
+        return len(img_array.shape) == 3 and img_array.shape[2] in (3, 4)
+
+    @staticmethod
+    def base_stats(img_array, stage_name):
+        """Estructura base de estadísticas con los valores que no requieren recorrer la imagen"""
+        return {
+            'timestamp': time.time(),
+            'stage': stage_name,
+            'dimensions': img_array.shape,
+            'size_mb': img_array.nbytes / (1024 * 1024),
+            'dtype': str(img_array.dtype),
+
+            # Estadísticas de canales de color
+            'mean_rgb': [],
+            'std_rgb': [],
+            'min_rgb': [],
+            'max_rgb': [],
+            'median_rgb': [],
+
+            # Estadísticas globales
+            'brightness': 0,
+            'contrast': 0,
+            'sharpness': 0,
+
+            # Histogramas
+            'histograms': {},
+
+            # Información de calidad
+            'blur_metric': 0,
+            'noise_level': 0,
+            'saturation_avg': 0,
+        }
+
+    @staticmethod
+    def channel_histograms(img_array):
+        """Histogramas de 256 niveles de cada canal, como matriz (canales, 256) de enteros"""
+        pixels = img_array.shape[0] * img_array.shape[1]
+        channels = img_array.shape[2]
+        if pixels < _CALCHIST_MAX_PIXELS:
+            return np.stack([
+                cv2.calcHist([img_array], [i], None, [256], [0, 256]).ravel()
+                for i in range(channels)
+            ]).astype(np.int64)
+
+        # Un solo bincount sobre los canales desplazados a rangos disjuntos
+        offsets = np.arange(channels, dtype=np.uint16) * 256
+        flat = (img_array.reshape(-1, channels) + offsets).ravel()
+        return np.bincount(flat, minlength=256 * channels).reshape(channels, 256)
+
+    @staticmethod
+    def histogram_moments(hist):
+        """Media, desviación, mínimo, máximo y mediana derivados de un histograma"""
+        n = int(hist.sum())
+        if n == 0:
+            return 0.0, 0.0, 0, 0, 0.0
+
+        mean = float(hist @ _LEVELS) / n
+        variance = max(float(hist @ _LEVELS_SQ) / n - mean ** 2, 0.0)
+
+        occupied = np.flatnonzero(hist)
+        cumulative = np.cumsum(hist)
+
+        # Mediana con la misma convención que np.median (promedio de los dos centrales)
+        lower = int(np.searchsorted(cumulative, (n - 1) // 2, side='right'))
+        upper = int(np.searchsorted(cumulative, n // 2, side='right'))
+
+        return mean, float(np.sqrt(variance)), int(occupied[0]), int(occupied[-1]), (lower + upper) / 2
+
+    def channel_statistics(self, img_array, histograms=None):
+        """Estadísticas por canal, histogramas, brillo y contraste a partir de los histogramas
+
+        En imágenes RGBA las estadísticas por canal son las de R, G y B y el
+        brillo y el contraste incluyen el canal alfa, como np.mean y np.std
+        sobre toda la imagen.
+        """
+        if histograms is None:
+            histograms = self.channel_histograms(img_array)
+
+        stats = {
+            'mean_rgb': [],
+            'std_rgb': [],
+            'min_rgb': [],
+            'max_rgb': [],
+            'median_rgb': [],
+            'histograms': {},
+        }
+
+        for channel, hist in zip(CHANNEL_NAMES, histograms):
+            mean, std, minimum, maximum, median = self.histogram_moments(hist)
+            stats['mean_rgb'].append(mean)
+            stats['std_rgb'].append(std)
+            stats['min_rgb'].append(minimum)
+            stats['max_rgb'].append(maximum)
+            stats['median_rgb'].append(median)
+            stats['histograms'][channel] = hist.tolist()
+
+        # El histograma conjunto da el brillo (media) y el contraste (std) globales
+        brightness, contrast, _, _, _ = self.histogram_moments(histograms.sum(axis=0))
+        stats['brightness'] = brightness
+        stats['contrast'] = contrast
+
+        return stats
+
+    @staticmethod
+    def blur_metric(gray=None, laplacian=None):
+        """Varianza del Laplaciano"""
+        if laplacian is None:
+            laplacian = cv2.Laplacian(gray, cv2.CV_64F)
+        _, std = cv2.meanStdDev(laplacian)
+        return float(std[0, 0] ** 2)
+
+    @staticmethod
+    def noise_level(gray):
+        """Desviación estándar del residuo respecto a un promedio local 3x3"""
+        gray_f = gray.astype(np.float32)
+        smoothed = cv2.blur(gray_f, (3, 3))
+        _, std = cv2.meanStdDev(cv2.subtract(gray_f, smoothed))
+        return float(std[0, 0])
+
+    @staticmethod
+    def saturation_avg(img_array, hsv=None):
+        """Saturación promedio del canal S en HSV"""
+        if hsv is None:
+            hsv = cv2.cvtColor(img_array, cv2.COLOR_RGB2HSV)
+        return float(cv2.mean(hsv)[1])
+
+
+class LazyImageStatistics(Mapping):
+    """Estadísticas de una etapa que se calculan (y memorizan) al consultarse por primera vez"""
+
+    def __init__(self, engine, img_array, stage_name, views=None):
+        self._engine = engine
+        self._values = engine.base_stats(img_array, stage_name)
+
+        if engine.is_color(img_array):
+            self._views = views if views is not None else DerivedViews(img_array)
+            self._pending = set(METRIC_GROUPS.values())
+        else:
+            self._views = None
+            self._pending = set()
+        self._deferred = {}
+
+    def __getitem__(self, key):
+        group = METRIC_GROUPS.get(key)
+        if group in self._pending:
+            self._compute(group)
+        elif key in self._deferred:
+            self._compute_deferred(self._deferred[key])
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        pending = sorted(self._pending | set(self._deferred))
+        return f"LazyImageStatistics({self._values['stage']!r}, pending={pending})"
+
+    def annotate(self, **values):
+        """Añade valores calculados fuera del motor (por ejemplo, decisiones de la etapa)"""
+        self._values.update(values)
+
+    def annotate_deferred(self, compute, *keys):
+        """Añade los valores `keys`, que `compute()` devuelve en un diccionario al consultar el primero"""
+        for key in keys:
+            self._values.setdefault(key, None)
+            self._deferred[key] = compute
+
+    def release_views(self):
+        """Descarta las vistas derivadas ya calculadas; las métricas pendientes las recalculan desde la imagen"""
+        views = self._views
+        if views is not None and views.cached_views():
+            self._views = DerivedViews(views.image)
+
+    @property
+    def is_materialized(self):
+        """Indica si ya se calcularon todas las métricas"""
+        return not self._pending and not self._deferred
+
+    def materialize(self):
+        """Calcula las métricas pendientes y devuelve un diccionario normal"""
+        for group in list(self._pending):
+            self._compute(group)
+        while self._deferred:
+            self._compute_deferred(next(iter(self._deferred.values())))
+        return dict(self._values)
+
+    def _compute(self, group):
+        self._values.update(self._engine.compute_group(group, self._views))
+        self._pending.discard(group)
+
+        # Sin métricas pendientes ya no hace falta retener la imagen ni sus vistas
+        if not self._pending:
+            self._views = None
+
+    def _compute_deferred(self, compute):
+        self._values.update(compute())
+        self._deferred = {key: other for key, other in self._deferred.items() if other is not compute}
+
+
+class SampledStatisticsEngine(StatisticsEngine):
+    """Estadísticas aproximadas a partir de una muestra de píxeles, con intervalos de confianza
+
+    Las métricas puntuales (canales, brillo, contraste, saturación) usan una rejilla
+    de píxeles con paso fijo. El desenfoque y el ruido dependen del vecindario, así
+    que se calculan a resolución completa sobre filas repartidas por toda la imagen
+    (reducir la resolución sesgaría la varianza del Laplaciano).
+    """
+
+    # Valor z del intervalo de confianza del 95 %
+    Z_95 = 1.959964
+
+    def __init__(self, sample_size=65536, min_rows=96, seed=0):
+        self.sample_size = sample_size
+        self.min_rows = min_rows
+        self.seed = seed
+
+    def compute(self, img_array, stage_name, views=None):
+        """Calcula las estadísticas aproximadas de una imagen"""
+        if not self.is_color(img_array):
+            return self.base_stats(img_array, stage_name)
+
+        h, w = img_array.shape[:2]
+        if h * w <= self.sample_size or h < 3:
+            # Imagen pequeña: el cálculo exacto ya es barato
+            stats = super().compute(img_array, stage_name, views)
+            stats['confidence_intervals'] = {
+                metric: [stats[metric], stats[metric]]
+                for metric in ('brightness', 'contrast', 'saturation_avg', 'noise_level', 'blur_metric')
+            }
+            stats['sampling'] = {'method': 'exact', 'pixels_sampled': h * w, 'confidence': 0.95}
+            return stats
+
+        stats = self.base_stats(img_array, stage_name)
+        intervals = {}
+
+        # Métricas puntuales sobre la rejilla de muestreo
+        step = int(np.ceil(np.sqrt(h * w / self.sample_size)))
+        sample = np.ascontiguousarray(img_array[::step, ::step])
+        n = sample.shape[0] * sample.shape[1]
+
+        histograms = self.channel_histograms(sample)
+        stats.update(self.channel_statistics(sample, histograms=histograms))
+
+        # Los histogramas se reescalan al número total de píxeles para las gráficas
+        scale = (h * w) / n
+        stats['histograms'] = {
+            channel: np.rint(hist * scale).astype(np.int64).tolist()
+            for channel, hist in zip(CHANNEL_NAMES, histograms)
+        }
+
+        intervals['brightness'] = self._mean_interval(stats['brightness'], stats['contrast'], n)
+        intervals['contrast'] = self._std_interval(
+            stats['contrast'], self._histogram_kurtosis(histograms.sum(axis=0)), n
+        )
+
+        saturation = cv2.cvtColor(sample, cv2.COLOR_RGB2HSV)[:, :, 1]
+        sat_mean, sat_std = cv2.meanStdDev(saturation)
+        stats['saturation_avg'] = float(sat_mean[0, 0])
+        intervals['saturation_avg'] = self._mean_interval(stats['saturation_avg'], float(sat_std[0, 0]), n)
+
+        # Métricas de vecindario sobre filas completas; cada fila es un conglomerado,
+        # así que el error estándar se estima con la dispersión entre filas
+        laplacian, residual = self._row_responses(img_array)
+
+        blur_var, blur_se = self._clustered_variance(laplacian)
+        stats['blur_metric'] = blur_var
+        intervals['blur_metric'] = self._interval(blur_var, blur_se)
+
+        noise_var, noise_se = self._clustered_variance(residual)
+        noise_std = float(np.sqrt(noise_var))
+        stats['noise_level'] = noise_std
+        intervals['noise_level'] = self._interval(noise_std, noise_se / (2 * noise_std) if noise_std > 0 else 0.0)
+
+        stats['confidence_intervals'] = intervals
+        stats['sampling'] = {
+            'method': 'strided+rows',
+            'pixels_sampled': n,
+            'stride': step,
+            'rows_sampled': laplacian.shape[0],
+            'confidence': 0.95,
+        }
+        return stats
+
+    def _row_responses(self, img_array):
+        """Laplaciano y residuo de ruido en filas equiespaciadas, a resolución completa"""
+        h, w = img_array.shape[:2]
+        n_rows = int(np.clip(self.sample_size // w, self.min_rows, h - 2))
+        spacing = (h - 2) / n_rows
+        offset = np.random.default_rng(self.seed).uniform(0, spacing)
+        rows = 1 + (offset + spacing * np.arange(n_rows)).astype(np.intp)
+
+        # Filas vecinas en gris con un píxel de reflejo horizontal (BORDER_REFLECT_101)
+        band = np.concatenate([img_array[rows - 1], img_array[rows], img_array[rows + 1]])
+        gray = cv2.cvtColor(band, cv2.COLOR_RGB2GRAY)
+        gray = cv2.copyMakeBorder(gray, 0, 0, 1, 1, cv2.BORDER_REFLECT_101).astype(np.float64)
+        up, center, down = gray[:n_rows], gray[n_rows:2 * n_rows], gray[2 * n_rows:]
+
+        laplacian = up[:, 1:-1] + down[:, 1:-1] + center[:, :-2] + center[:, 2:] - 4 * center[:, 1:-1]
+
+        column_sums = up + center + down
+        box = (column_sums[:, :-2] + column_sums[:, 1:-1] + column_sums[:, 2:]) / 9
+        residual = center[:, 1:-1] - box
+
+        return laplacian, residual
+
+    @staticmethod
+    def _clustered_variance(values):
+        """Varianza de los valores muestreados y su error estándar entre filas"""
+        row_mean = values.mean(axis=1)
+        row_mean_sq = (values ** 2).mean(axis=1)
+        mean = row_mean.mean()
+        variance = float(max(row_mean_sq.mean() - mean ** 2, 0.0))
+
+        # Contribución de cada fila a la varianza, linealizada alrededor de la media global
+        contributions = row_mean_sq - 2 * mean * row_mean
+        se = float(contributions.std(ddof=1) / np.sqrt(len(contributions)))
+        return variance, se
+
+    @staticmethod
+    def _histogram_kurtosis(hist):
+        n = hist.sum()
+        mean = float(hist @ _LEVELS) / n
+        centered = _LEVELS - mean
+        m2 = float(hist @ centered ** 2) / n
+        m4 = float(hist @ centered ** 4) / n
+        return m4 / m2 ** 2 if m2 > 0 else 3.0
+
+    def _interval(self, value, se):
+        half = self.Z_95 * se
+        return [max(value - half, 0.0), value + half]
+
+    def _mean_interval(self, mean, std, n):
+        """Intervalo de la media: error estándar std / sqrt(n)"""
+        half = self.Z_95 * std / np.sqrt(n)
+        return [mean - half, mean + half]
+
+    def _std_interval(self, std, kurtosis, n):
+        """Intervalo de la desviación estándar por el método delta"""
+        return self._interval(std, std * np.sqrt(max(kurtosis - 1, 0) / (4 * n)))
@@ -0,0 +1,670 @@
+"""
+Procesamiento por franjas en alta resolución con la memoria acotada
+"""
+import math
+import os
+import tempfile
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from . import resources
+from .buffers import BufferArena
+from .denoise import DenoiseEngine
+from .lut import gamma_lut, minmax_lut
+
+
+class StripeStage:
+    """Etapa del pipeline aplicada por franjas horizontales de ancho completo
+
+    `apply(stripe, top)` procesa las filas de la imagen que empiezan en `top`
+    y devuelve un array nuevo del mismo tamaño. `halo` es el número de filas
+    de contexto que la etapa lee por encima y por debajo de cada fila, y
+    `align` obliga a que `top` y el alto de la franja (salvo al final de la
+    imagen) sean múltiplos de ese valor.
+
+    Las etapas globales (`needs_input`) dependen de toda su entrada: antes de
+    aplicarlas, el pipeline les pasa cada franja de esa entrada con
+    `update(rows, top)` y después llama a `prepare()`. Lo que la etapa decida
+    se guarda en `annotations` y se añade a sus estadísticas. `release()`
+    libera lo que la etapa retenga una vez aplicada a todas las franjas.
+    `parameter` es el parámetro global (ver parameters.PARAMETERS) que fija
+    `prepare()`: si el preprocesador lo tiene fijado, la etapa no necesita
+    recorrer su entrada y se encadena con las demás.
+    """
+
+    needs_input = False
+    parameter = None
+
+    def __init__(self, preprocessor, step, halo=0, align=1):
+        self.preprocessor = preprocessor
+        self.step = step
+        self.halo = halo
+        self.align = align
+        self.annotations = {}
+
+    def update(self, rows, top):
+        pass
+
+    def prepare(self):
+        pass
+
+    def apply(self, stripe, top):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+
+class MethodStage(StripeStage):
+    """Etapas puntuales, locales y lineales: el método de la etapa sobre cada franja"""
+
+    def __init__(self, preprocessor, step, halo=None, align=1):
+        if halo is None:
+            halo = step.op.halo(step.params)
+        super().__init__(preprocessor, step, halo, align)
+
+    def apply(self, stripe, top):
+        if self.step.op.kind == 'linear':
+            return self.preprocessor.apply_linear_chain(stripe, self.step.op.name)
+        return getattr(self.preprocessor, self.step.op.method)(stripe, **self.step.params)
+
+
+class EdgePreservingStage(MethodStage):
+    """Filtro preservador de bordes con tres veces sigma_s de contexto
+
+    El filtro recursivo alcanza toda la columna, pero su peso cae
+    exponencialmente con la distancia: con 3·sigma_s filas de contexto la
+    salida coincide con la de la imagen completa salvo en píxeles aislados
+    junto a bordes fuertes (diferencia media < 0.01 niveles a 1024 px).
+    """
+
+    def __init__(self, preprocessor, step):
+        scale = step.params['scale']
+        super().__init__(preprocessor, step, halo=int(math.ceil(3 * step.params['sigma_s'])), align=scale)
+
+
+class NormalizeStage(StripeStage):
+    """Normalización min-max con el rango de toda la imagen"""
+
+    needs_input = True
+    parameter = 'normalize'
+
+    def __init__(self, preprocessor, step):
+        super().__init__(preprocessor, step)
+        self.lo, self.hi = 255, 0
+
+    def update(self, rows, top):
+        self.lo = min(self.lo, int(rows.min()))
+        self.hi = max(self.hi, int(rows.max()))
+
+    def prepare(self):
+        self.lut = minmax_lut(*self.preprocessor._global_parameter(self.parameter, lambda: (self.lo, self.hi)))
+
+    def apply(self, stripe, top):
+        return cv2.LUT(stripe, self.lut)
+
+
+class AdaptiveGammaStage(StripeStage):
+    """Corrección gamma elegida con el brillo medio de toda la imagen"""
+
+    needs_input = True
+    parameter = 'gamma'
+
+    def __init__(self, preprocessor, step):
+        super().__init__(preprocessor, step)
+        self.total, self.count = 0, 0
+        # Con la gamma fijada en los parámetros del paso no hace falta medir la entrada
+        self.needs_input = step.params['gamma'] is None
+
+    def update(self, rows, top):
+        gray = cv2.cvtColor(rows, cv2.COLOR_RGB2GRAY)
+        self.total += int(gray.sum(dtype=np.int64))
+        self.count += gray.size
+
+    def prepare(self):
+        preprocessor = self.preprocessor
+        gamma = self.step.params['gamma']
+        if gamma is not None:
+            preprocessor.estimated_parameters[self.parameter] = gamma
+        else:
+            gamma = preprocessor._global_parameter(
+                self.parameter, lambda: preprocessor._select_gamma(self.total / self.count))
+        self.lut = gamma_lut(gamma)
+
+    def apply(self, stripe, top):
+        return cv2.LUT(stripe, self.lut)
+
+
+class ClaheStage(StripeStage):
+    """CLAHE sobre el canal L de toda la imagen, aplicado después por franjas
+
+    CLAHE calcula una tabla por celda de la rejilla, así que necesita el canal
+    completo: se acumula en un plano uint8 (un tercio de la imagen), se
+    ecualiza de una vez sobre el propio plano y cada franja recupera sus
+    filas. El resultado es idéntico al de la etapa sobre la imagen completa.
+    """
+
+    needs_input = True
+
+    def __init__(self, preprocessor, step, allocate, clip_limit=None, tile_grid_size=None):
+        super().__init__(preprocessor, step)
+        self.clip_limit = step.params.get('clip_limit', clip_limit)
+        self.tile_grid_size = step.params.get('tile_grid_size', tile_grid_size)
+        self.allocate = allocate
+        self.plane = None
+
+    def update(self, rows, top):
+        if self.plane is None:
+            self.plane = self.allocate()
+        lightness = cv2.cvtColor(rows, cv2.COLOR_RGB2LAB)[:, :, 0]
+        self.plane[top:top + rows.shape[0]] = lightness
+
+    def prepare(self):
+        clahe = resources.clahe(self.clip_limit, self.tile_grid_size)
+        clahe.apply(self.plane, dst=self.plane)
+
+    def apply(self, stripe, top):
+        lab = cv2.cvtColor(stripe, cv2.COLOR_RGB2LAB)
+        lab[:, :, 0] = self.plane[top:top + stripe.shape[0]]
+        return cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+
+    def release(self):
+        self.plane = None
+
+
+class FinalContrastStage(ClaheStage):
+    """Ajuste final de contraste: CLAHE con los parámetros de _final_contrast_adjustment"""
+
+    def __init__(self, preprocessor, step, allocate):
+        super().__init__(preprocessor, step, allocate, clip_limit=1.5, tile_grid_size=8)
+
+
+class ColorCorrectionStage(StripeStage):
+    """Normalización del canal L con el rango de toda la imagen
+
+    Como _stage_color_correction, el resultado se reinterpreta como RGB.
+    """
+
+    needs_input = True
+    parameter = 'color_correction'
+
+    def __init__(self, preprocessor, step):
+        super().__init__(preprocessor, step)
+        self.lo, self.hi = 255, 0
+
+    def update(self, rows, top):
+        lightness = cv2.cvtColor(rows, cv2.COLOR_RGB2LAB)[:, :, 0]
+        self.lo = min(self.lo, int(lightness.min()))
+        self.hi = max(self.hi, int(lightness.max()))
+
+    def prepare(self):
+        self.lut = minmax_lut(*self.preprocessor._global_parameter(self.parameter, lambda: (self.lo, self.hi)))
+
+    def apply(self, stripe, top):
+        lab = cv2.cvtColor(stripe, cv2.COLOR_RGB2LAB)
+        lab[:, :, 0] = cv2.LUT(lab[:, :, 0], self.lut)
+        return cv2.cvtColor(cv2.cvtColor(lab, cv2.COLOR_LAB2RGB), cv2.COLOR_BGR2RGB)
+
+
+class WhiteBalanceStage(StripeStage):
+    """Balance de blancos con las medias de a y b de toda la imagen"""
+
+    needs_input = True
+    parameter = 'white_balance'
+
+    def __init__(self, preprocessor, step):
+        super().__init__(preprocessor, step)
+        self.sums = np.zeros(2, dtype=np.float64)
+        self.count = 0
+
+    def update(self, rows, top):
+        lab = cv2.cvtColor(rows, cv2.COLOR_RGB2LAB)
+        self.sums += lab[:, :, 1:].sum(axis=(0, 1), dtype=np.float64)
+        self.count += lab.shape[0] * lab.shape[1]
+
+    def prepare(self):
+        self.averages = self.preprocessor._global_parameter(
+            self.parameter, lambda: tuple(float(value) for value in self.sums / self.count))
+
+    def apply(self, stripe, top):
+        return self.preprocessor._white_balance(stripe, averages=self.averages)
+
+
+class AdaptiveDenoiseStage(StripeStage):
+    """Reducción de ruido con el nivel elegido por el noise_level de toda la imagen"""
+
+    needs_input = True
+
+    def __init__(self, preprocessor, step):
+        # 'nlm_luma_half' necesita franjas de alto par; con `regional` la
+        # rejilla de teselas de cada franja coincide con la de la imagen completa
+        align = 2 * step.params['tile_size'] // math.gcd(2, step.params['tile_size']) if step.params['regional'] else 2
+        super().__init__(preprocessor, step, halo=step.op.halo(step.params), align=align)
+        params = step.params
+        self.engine = DenoiseEngine(params['h'], params['h_color'], params['template_window_size'],
+                                    params['search_window_size'])
+        self.sum, self.squares, self.count = 0.0, 0.0, 0
+        self.tiles = {}
+
+    def update(self, rows, top):
+        # Misma definición que StatisticsEngine.noise_level, acumulada por franjas
+        gray = cv2.cvtColor(rows, cv2.COLOR_RGB2GRAY).astype(np.float32)
+        residual = cv2.subtract(gray, cv2.blur(gray, (3, 3)))
+        self.sum += float(residual.sum(dtype=np.float64))
+        self.squares += float(np.square(residual, dtype=np.float64).sum())
+        self.count += residual.size
+
+    def prepare(self):
+        mean = self.sum / self.count
+        noise_level = math.sqrt(max(self.squares / self.count - mean * mean, 0.0))
+        iso = self.preprocessor._source_iso
+        tier = self.step.params['tier']
+        if tier == 'auto':
+            tier = self.engine.select_tier(noise_level, iso, self.step.params['max_tier'])
+        self.tier = tier
+        self.annotations = {'denoise_tier': tier, 'denoise_input_noise': noise_level, 'denoise_iso': iso}
+
+    def apply(self, stripe, top):
+        if not self.step.params['regional']:
+            return self.engine.apply(stripe, self.tier)
+        denoised, counts = self.engine.apply_regional(stripe, self.tier, self.step.params['tile_size'])
+        for tier, count in counts.items():
+            self.tiles[tier] = self.tiles.get(tier, 0) + count
+        self.annotations['denoise_tiles'] = dict(self.tiles)
+        return denoised
+
+
+class ExpressStage(MethodStage):
+    """Aproximación exprés: el halo es el radio del filtro del modelo que se use"""
+
+    def __init__(self, preprocessor, step):
+        radius = preprocessor._express_model(step.params.get('model')).radius
+        super().__init__(preprocessor, step, halo=radius)
+
+
+# Operaciones cuyo resultado depende de toda la imagen y necesitan su propia clase
+STRIPE_STAGES = {
+    'normalize': NormalizeStage,
+    'adaptive_gamma': AdaptiveGammaStage,
+    'clahe': ClaheStage,
+    'final_contrast': FinalContrastStage,
+    'color_correction': ColorCorrectionStage,
+    'white_balance': WhiteBalanceStage,
+    'adaptive_denoise': AdaptiveDenoiseStage,
+    'edge_preserving': EdgePreservingStage,
+    'express': ExpressStage,
+}
+
+
+class _Thumbnail:
+    """Miniatura de una etapa construida a partir de sus franjas
+
+    Equivale a reducir la imagen completa con INTER_AREA: cada franja se
+    reduce en horizontal y sus filas se acumulan con el peso de su solape con
+    cada fila de la miniatura, así que el resultado no depende de dónde caen
+    los límites de las franjas.
+    """
+
+    def __init__(self, height, width, size):
+        scale = min(1.0, size / max(height, width))
+        self.shape = (max(1, round(height * scale)), max(1, round(width * scale)), 3)
+        self.row_scale = self.shape[0] / height
+        self.sums = np.zeros(self.shape, dtype=np.float32)
+        self.weights = np.zeros(self.shape[0], dtype=np.float32)
+
+    def add(self, rows, top):
+        reduced = cv2.resize(rows, (self.shape[1], rows.shape[0]), interpolation=cv2.INTER_AREA).astype(np.float32)
+        start = (top + np.arange(rows.shape[0])) * self.row_scale
+        end = start + self.row_scale
+        first = np.minimum(np.floor(start).astype(np.intp), self.shape[0] - 1)
+        last = np.minimum(np.ceil(end).astype(np.intp) - 1, self.shape[0] - 1)
+
+        # Con row_scale <= 1 cada fila cae en una o dos filas de la miniatura
+        first_weight = np.minimum(end, first + 1) - start
+        np.add.at(self.sums, first, reduced * first_weight[:, None, None])
+        np.add.at(self.weights, first, first_weight)
+        split = last > first
+        if split.any():
+            last_weight = (end - last)[split]
+            np.add.at(self.sums, last[split], reduced[split] * last_weight[:, None, None])
+            np.add.at(self.weights, last[split], last_weight)
+
+    @property
+    def image(self):
+        weights = np.maximum(self.weights, 1e-6)[:, None, None]
+        return np.clip(np.rint(self.sums / weights), 0, 255).astype(np.uint8)
+
+
+class _ArrayOutput:
+    """Imagen final en memoria"""
+
+    def __init__(self, height, width):
+        self.image = np.empty((height, width, 3), dtype=np.uint8)
+        self.row = 0
+
+    def write(self, rows):
+        self.image[self.row:self.row + rows.shape[0]] = rows
+        self.row += rows.shape[0]
+
+    def close(self):
+        image = Image.fromarray(self.image)
+        self.image = None
+        return image
+
+    def discard(self):
+        self.image = None
+
+
+class _PPMOutput:
+    """Imagen final escrita por franjas en un archivo PPM binario (P6), leído después bajo demanda"""
+
+    def __init__(self, path, height, width):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(f"P6\n{width} {height}\n255\n".encode('ascii'))
+
+    def write(self, rows):
+        self.file.write(np.ascontiguousarray(rows).tobytes())
+
+    def close(self):
+        self.file.close()
+        return Image.open(self.path)
+
+    def discard(self):
+        """Cierra y borra el archivo de una salida que no se ha completado"""
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _PaddedWriter:
+    """Escribe las franjas del contenido en la salida, con el relleno del lienzo alrededor"""
+
+    def __init__(self, output, content_rect, height, width, background):
+        self.output = output
+        self.content_rect = content_rect
+        self.height = height
+        self.padding = np.empty((1, width, 3), dtype=np.uint8)
+        self.padding[:] = background
+
+    def __call__(self, rows, top):
+        y0, _, x0, x1 = self.content_rect
+        if top == 0:
+            for _ in range(y0):
+                self.output.write(self.padding)
+        band = np.repeat(self.padding, rows.shape[0], axis=0)
+        band[:, x0:x1] = rows
+        self.output.write(band)
+
+    def finish(self):
+        for _ in range(self.height - self.content_rect[1]):
+            self.output.write(self.padding)
+        return self.output.close()
+
+
+class StripePipeline:
+    """Ejecuta el pipeline de un ImagePreprocessor por franjas, con la memoria acotada
+
+    La imagen redimensionada (solo el contenido, sin el relleno del lienzo)
+    pasa por las etapas en franjas horizontales con el contexto que pide cada
+    etapa. Las etapas locales, lineales y puntuales consecutivas se encadenan
+    sobre la misma franja; cada etapa global (ver STRIPE_STAGES) obliga a
+    materializar su entrada en un buffer, recorriéndola a la vez para fijar
+    sus parámetros (salvo si el preprocesador los tiene fijados, ver
+    GlobalParameters). Hay como mucho dos buffers de imagen (más el plano L de
+    CLAHE); si no caben en `memory_limit_mb` se guardan en archivos
+    temporales mapeados en memoria. De cada etapa solo se conserva una
+    miniatura, sobre la que se calculan sus estadísticas, y la imagen final
+    se compone con el relleno fila a fila, en memoria o en un archivo PPM.
+
+    El alto de franja se elige para que la memoria de trabajo quepa en el
+    límite. La imagen de entrada decodificada cuenta hasta el final de la
+    primera pasada (se cierra entonces); las fotos JPEG se decodifican ya
+    reducidas si basta para el tamaño objetivo. Con los buffers en disco, las
+    páginas de los archivos mapeados que el sistema puede descartar no cuentan
+    en el límite (a 4096 px, el preset 'full' con 256 MB usa unos 190 MB de
+    memoria anónima; sin límite, unos 1.5 GB).
+
+    Cada franja lleva por encima y por debajo el contexto de las etapas de su
+    pasada, y el del filtro preservador de bordes es grande (3·sigma_s = 150
+    filas): con el preset 'full' y 512 px de ancho, las franjas mínimas de
+    MIN_STRIPE_ROWS filas necesitan unos 35 MB además de la imagen de
+    entrada. Con un límite menor, la pasada que no cabe se aplica a todo el
+    alto de una vez, leyendo de su buffer (en disco, ya que tampoco caben en
+    memoria): su memoria de trabajo, la de la imagen redimensionada completa,
+    supera entonces el límite. `details['full_height_passes']` cuenta esas
+    pasadas.
+
+    Las diferencias con el pipeline sobre la imagen completa: el
+    redimensionado usa el Lanczos de Pillow (franjas exactas), el filtro
+    preservador de bordes tiene un contexto limitado (ver
+    EdgePreservingStage) y no se aplican las reglas de omisión de etapas.
+    """
+
+    # Memoria de trabajo por píxel de franja (contexto incluido) de la pasada
+    # más costosa: vistas derivadas, gradientes float64 y temporales de OpenCV.
+    # Medida en el preset 'full' a 4096 px (unos 150 bytes) con margen
+    STRIPE_BYTES_PER_PIXEL = 192
+    MIN_STRIPE_ROWS = 16
+    THUMBNAIL_SIZE = 256
+
+    def __init__(self, preprocessor, memory_limit_mb, temp_dir=None):
+        self.preprocessor = preprocessor
+        self.memory_limit = int(memory_limit_mb * 1024 * 1024)
+        self.temp_dir = temp_dir
+        self.in_memory = True
+
+    def run(self, source, output_path=None):
+        """Procesa la imagen PIL RGB `source` y devuelve (imagen final PIL, detalles)
+
+        Con `output_path` la imagen final se escribe por franjas en ese archivo
+        en formato PPM y se devuelve abierta desde él (se lee bajo demanda).
+        """
+        preprocessor = self.preprocessor
+        steps = preprocessor.pipeline.steps
+        names = [step.op.name for step in steps]
+        if 'resize' not in names:
+            raise ValueError("El procesamiento por franjas necesita una etapa 'resize'")
+        resize_index = names.index('resize')
+
+        width, height = source.size
+        target_w, target_h = preprocessor.target_size
+        ratio = min(target_w / width, target_h / height)
+        new_w, new_h = int(width * ratio), int(height * ratio)
+        y_offset, x_offset = (target_h - new_h) // 2, (target_w - new_w) // 2
+        preprocessor.content_rect = (y_offset, y_offset + new_h, x_offset, x_offset + new_w)
+        background = np.asarray(preprocessor._global_parameter('border_color', lambda: self._background(source)),
+                                dtype=np.uint8)
+        # Como en _compose_canvas: el relleno sigue al contenido si el pipeline invierte sus canales
+        if preprocessor.pipeline.swaps_channels():
+            background = background[::-1]
+
+        # Pasadas: las etapas encadenadas hasta cada etapa global, que recibe su
+        # salida; las globales con el parámetro fijado se preparan ya y se encadenan
+        passes, chain = [], []
+        for step in steps[resize_index + 1:]:
+            stage = self._stripe_stage(step, new_h, new_w)
+            frozen = stage.parameter is not None and stage.parameter in preprocessor._frozen_parameters
+            if stage.needs_input and not frozen:
+                passes.append((chain, stage))
+                chain = [stage]
+            else:
+                stage.prepare()
+                chain.append(stage)
+        passes.append((chain, None))
+        max_halo = max(sum(stage.halo for stage in chain) for chain, _ in passes)
+
+        # Dos buffers de la imagen y, si hay CLAHE, su plano L
+        planes = any(isinstance(stage, ClaheStage) for _, stage in passes)
+        image_bytes = target_w * target_h * 3
+        resident = 2 * image_bytes + planes * new_w * new_h
+        source_bytes = width * height * 3
+        minimum = self._stripe_bytes(new_w, self.MIN_STRIPE_ROWS + 2 * max_halo)
+        self.in_memory = source_bytes + resident + minimum <= self.memory_limit
+        self.resident = resident if self.in_memory else 0
+
+        arena = BufferArena(max_bytes=max(self.memory_limit - self.resident - source_bytes, 0) // 4)
+        previous_arena, preprocessor._buffer_arena = preprocessor._buffer_arena, arena
+        self.details = {
+            'target_size': [target_w, target_h],
+            'content_rect': list(preprocessor.content_rect),
+            'memory_limit_mb': self.memory_limit / (1024 * 1024),
+            'buffers': 'memory' if self.in_memory else 'disk',
+            'passes': 0,
+            'stripe_rows': [],
+            'full_height_passes': 0,
+        }
+        output = final = None
+        try:
+            for step in steps[:resize_index]:
+                self._record(step, self._source_thumbnail(source), {})
+
+            resize_step = steps[resize_index]
+            resize_thumbnail = _Thumbnail(new_h, new_w, self.THUMBNAIL_SIZE)
+
+            # Cada franja se remuestrea con la misma escala que la imagen completa
+            row_scale = height / new_h
+
+            def read_source(top, bottom):
+                rows = source.resize((new_w, bottom - top), Image.LANCZOS,
+                                     box=(0, top * row_scale, width, bottom * row_scale))
+                # Como resize_image_advanced, el resultado queda en orden BGR
+                return cv2.cvtColor(np.asarray(rows), cv2.COLOR_RGB2BGR)
+
+            current = None
+            for chain, stage in passes:
+                if current is None:
+                    read = read_source
+                    extra = source_bytes
+                else:
+                    read = lambda top, bottom, buffer=current: buffer[top:bottom]
+                    extra = 0
+
+                if stage is None:
+                    output = self._output(output_path, target_h, target_w)
+                    write = final_writer = _PaddedWriter(output, preprocessor.content_rect, target_h, target_w,
+                                                         background)
+                    buffer = None
+                else:
+                    buffer = self._allocate((new_h, new_w, 3))
+
+                    def write(rows, top, buffer=buffer, stage=stage):
+                        buffer[top:top + rows.shape[0]] = rows
+                        stage.update(rows, top)
+
+                thumbnails = self._stream(read, chain, write, new_h, new_w, extra,
+                                          resize_thumbnail if current is None else None)
+                # El alto de franja cambia entre pasadas: sus buffers no se reutilizarían
+                arena.clear()
+                if current is None:
+                    self._record(resize_step, resize_thumbnail.image, {})
+                    source.close()
+                for done, thumbnail in zip(chain, thumbnails):
+                    self._record(done.step, thumbnail.image, done.annotations)
+                    done.release()
+
+                if stage is not None:
+                    stage.prepare()
+                current = buffer
+
+            final = final_writer.finish()
+        finally:
+            preprocessor._buffer_arena = previous_arena
+            # Si una pasada falla no queda un PPM a medias en disco
+            if output is not None and final is None:
+                output.discard()
+
+        return final, self.details
+
+    def _stream(self, read, stages, write, height, width, extra, source_thumbnail=None):
+        """Una pasada: lee franjas, aplica `stages` encadenadas y escribe el núcleo de cada franja"""
+        halo = sum(stage.halo for stage in stages)
+        align = 1
+        for stage in stages:
+            align = align * stage.align // math.gcd(align, stage.align)
+
+        rows = self._stripe_rows(width, height, halo, extra)
+        self.details['passes'] += 1
+        self.details['stripe_rows'].append(rows)
+
+        thumbnails = [_Thumbnail(height, width, self.THUMBNAIL_SIZE) for _ in stages]
+        for y0 in range(0, height, rows):
+            y1 = min(y0 + rows, height)
+            top = max(y0 - halo, 0)
+            top -= top % align
+            bottom = min(y1 + halo + (-(y1 + halo)) % align, height)
+
+            stripe = read(top, bottom)
+            if source_thumbnail is not None:
+                source_thumbnail.add(stripe[y0 - top:y1 - top], y0)
+            for stage, thumbnail in zip(stages, thumbnails):
+                stripe = stage.apply(stripe, top)
+                thumbnail.add(stripe[y0 - top:y1 - top], y0)
+            write(stripe[y0 - top:y1 - top], y0)
+        return thumbnails
+
+    def _stripe_rows(self, width, height, halo, extra):
+        """Filas de núcleo por franja para que la memoria de trabajo quepa en el límite
+
+        Si el contexto no deja sitio para MIN_STRIPE_ROWS filas, la pasada se
+        aplica a todo el alto de una vez.
+        """
+        available = self.memory_limit - self.resident - extra
+        rows = available // self._stripe_bytes(width, 1) - 2 * halo
+        if rows < self.MIN_STRIPE_ROWS:
+            self.details['full_height_passes'] += 1
+            return height
+        return int(rows)
+
+    def _stripe_bytes(self, width, rows):
+        return width * rows * self.STRIPE_BYTES_PER_PIXEL
+
+    def _allocate(self, shape):
+        """Buffer uint8 en memoria o, si no cabe en el límite, en un archivo temporal mapeado"""
+        if self.in_memory:
+            return np.empty(shape, dtype=np.uint8)
+        return np.memmap(tempfile.TemporaryFile(dir=self.temp_dir), dtype=np.uint8, mode='w+', shape=shape)
+
+    def _stripe_stage(self, step, height, width):
+        stage_class = STRIPE_STAGES.get(step.op.name)
+        if stage_class in (ClaheStage, FinalContrastStage):
+            return stage_class(self.preprocessor, step, lambda: self._allocate((height, width)))
+        if stage_class is not None:
+            return stage_class(self.preprocessor, step)
+        if step.op.kind in ('pointwise', 'local', 'linear'):
+            return MethodStage(self.preprocessor, step)
+        raise ValueError(f"La operación '{step.op.name}' no admite procesamiento por franjas")
+
+    def _record(self, step, thumbnail, annotations):
+        """Registra la miniatura de una etapa y sus estadísticas"""
+        preprocessor = self.preprocessor
+        thumbnail = preprocessor.stage_images.add(step.stage, thumbnail)
+        stats = preprocessor.calculate_image_statistics(thumbnail, step.stage)
+        if annotations:
+            preprocessor._annotate_stats(stats, annotations)
+        preprocessor._annotate_similarity(stats, thumbnail, thumbnail.shape)
+
+    def _source_thumbnail(self, source):
+        scale = min(1.0, self.THUMBNAIL_SIZE / max(source.size))
+        size = (max(1, round(source.size[0] * scale)), max(1, round(source.size[1] * scale)))
+        return np.array(source.resize(size, Image.BOX))
+
+    @staticmethod
+    def _background(source):
+        """Color de relleno: media de los píxeles del borde, en orden BGR como en resize_image_advanced"""
+        width, height = source.size
+        border = np.vstack([
+            np.asarray(source.crop((0, 0, width, 1))).reshape(-1, 3),
+            np.asarray(source.crop((0, height - 1, width, height))).reshape(-1, 3),
+            np.asarray(source.crop((0, 0, 1, height))).reshape(-1, 3),
+            np.asarray(source.crop((width - 1, 0, width, height))).reshape(-1, 3),
+        ])
+        return np.mean(border, axis=0).astype(np.uint8)[::-1]
+
+    @staticmethod
+    def _output(output_path, height, width):
+        if output_path is None:
+            return _ArrayOutput(height, width)
+        return _PPMOutput(output_path, height, width)
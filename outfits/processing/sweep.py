@@ -0,0 +1,253 @@
+"""
+Barrido de parámetros de una o dos etapas sobre una imagen, con el prefijo común calculado una vez
+"""
+import itertools
+import math
+import numbers
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from . import resources
+from .derived_views import DerivedViews
+from .lut import gamma_lut
+from .pipeline import PipelineStep
+from .quality import psnr, ssim
+from .statistics import LazyImageStatistics
+
+
+# Número máximo de variantes de un barrido (incluida la de referencia)
+MAX_SWEEP_VARIANTS = 64
+
+# Métricas de cada variante, con los nombres de calculate_image_statistics
+SWEEP_METRICS = ('brightness', 'contrast', 'saturation_avg', 'blur_metric', 'noise_level')
+
+
+def _batch_gamma(preprocessor, image, variants):
+    """Todas las gammas con una LUT apilada: una sola indexación para las k variantes"""
+    gammas = [preprocessor._stage_gamma(image, params['gamma']) for params in variants]
+    stacked = np.stack([gamma_lut(gamma) for gamma in gammas])[:, image]
+    return [(output, {'gamma': gamma}) for output, gamma in zip(stacked, gammas)]
+
+
+def _batch_saturation(preprocessor, image, variants):
+    """Canal S de todas las variantes con una multiplicación vectorizada sobre el HSV compartido
+
+    Como _enhance_saturation: producto en float32, saturado a 255 y truncado a uint8.
+    """
+    hsv = preprocessor._views(image).hsv
+    gains = np.array([params['gain'] for params in variants], dtype=np.float32)[:, None, None]
+    saturation = np.clip(hsv[None, :, :, 1] * gains, 0, 255).astype(np.uint8)
+    outputs = []
+    for channel in saturation:
+        adjusted = hsv.copy()
+        adjusted[:, :, 1] = channel
+        outputs.append((cv2.cvtColor(adjusted, cv2.COLOR_HSV2RGB), {}))
+    return outputs
+
+
+def _batch_clahe(preprocessor, image, variants):
+    """CLAHE de cada variante sobre los canales LAB calculados una sola vez"""
+    lightness, a, b = cv2.split(preprocessor._views(image).lab)
+    outputs = []
+    for params in variants:
+        clahe = resources.clahe(params['clip_limit'], params['tile_grid_size'])
+        outputs.append((cv2.cvtColor(cv2.merge([clahe.apply(lightness), a, b]), cv2.COLOR_LAB2RGB), {}))
+    return outputs
+
+
+def _valid_value(default, value):
+    """Indica si `value` es válido para un parámetro cuyo valor por defecto es `default`"""
+    # Los parámetros lógicos y de texto admiten valores del mismo tipo; el
+    # resto, números finitos (enteros si el valor por defecto lo es) y None
+    # si es su valor por defecto
+    if isinstance(default, (bool, str)):
+        return type(value) is type(default)
+    if value is None:
+        return default is None
+    if isinstance(value, bool) or not isinstance(value, numbers.Real) or not math.isfinite(value):
+        return False
+    return not isinstance(default, numbers.Integral) or float(value).is_integer()
+
+
+# Operaciones con una evaluación conjunta de varias variantes; el resto se
+# ejecuta una vez por variante. Cada función devuelve, por variante, la
+# salida y los parámetros globales que fija (como los que registra la etapa)
+SWEEP_BATCH = {
+    'adaptive_gamma': _batch_gamma,
+    'saturation': _batch_saturation,
+    'clahe': _batch_clahe,
+}
+
+
+class ParameterSweep:
+    """Variantes de los parámetros de una o dos etapas del pipeline de un preprocesador
+
+    `grid` es {etapa u operación: {parámetro: [valores]}}; las variantes son
+    el producto cartesiano de todos los valores. Las etapas anteriores a la
+    primera barrida se ejecutan una vez, las que quedan entre las dos una vez
+    por valor de la primera, y cada etapa barrida evalúa sus variantes de una
+    vez si la operación está en SWEEP_BATCH. Además de las variantes se
+    calcula la de referencia (los parámetros de la especificación) para
+    comparar con ella.
+
+    Las reglas de omisión no se aplican: el barrido muestra el efecto de los
+    parámetros aunque sea pequeño.
+    """
+
+    def __init__(self, preprocessor, grid):
+        if not grid or len(grid) > 2:
+            raise ValueError("El barrido admite parámetros de una o dos etapas")
+
+        self.preprocessor = preprocessor
+        steps = preprocessor.pipeline.steps
+        self.axes = []
+        for name, params in grid.items():
+            index = next((i for i, step in enumerate(steps) if name in (step.stage, step.op.name)), None)
+            if index is None:
+                raise ValueError(f"Etapa no presente en el pipeline {preprocessor.pipeline.name}: {name}")
+            step = steps[index]
+            unknown = set(params) - set(step.op.defaults)
+            if not params or unknown:
+                raise ValueError(f"Parámetros no soportados para '{step.op.name}': {sorted(unknown) or params}")
+            if any(not isinstance(values, (list, tuple)) or not values for values in params.values()):
+                raise ValueError(f"Cada parámetro de '{name}' necesita una lista de valores")
+            for param, values in params.items():
+                invalid = [value for value in values if not _valid_value(step.op.defaults[param], value)]
+                if invalid:
+                    raise ValueError(f"Valores no válidos para '{param}' de '{step.op.name}': {invalid}")
+            names = sorted(params)
+            combos = [dict(zip(names, values)) for values in itertools.product(*(params[n] for n in names))]
+            self.axes.append((index, step, combos))
+        self.axes.sort(key=lambda axis: axis[0])
+        if self.axes[0][0] < 2:
+            raise ValueError("No se pueden barrer las etapas de entrada y redimensionado")
+
+        self.variants = [
+            {step.stage: combo for (_, step, _), combo in zip(self.axes, combos)}
+            for combos in itertools.product(*(axis[2] for axis in self.axes))
+        ]
+        self.reference = {step.stage: {name: step.params[name] for name in combos[0]} for _, step, combos in self.axes}
+        if len(self.variants) + 1 > MAX_SWEEP_VARIANTS:
+            raise ValueError(f"Demasiadas variantes: {len(self.variants)} (máximo {MAX_SWEEP_VARIANTS - 1})")
+
+    def run(self, image, thumbnail_size=192):
+        """Evalúa las variantes sobre la imagen PIL `image` y devuelve (hoja de contactos, resumen)"""
+        preprocessor = self.preprocessor
+        start = time.time()
+        steps = preprocessor.pipeline.steps
+
+        preprocessor.estimated_parameters = {}
+        preprocessor.content_rect = None
+        preprocessor._source_image = image
+        try:
+            current = np.array(image)
+            for step in steps[:self.axes[0][0]]:
+                current = preprocessor._recompute_step(step, current)
+        finally:
+            preprocessor._source_image = None
+        prefix_time = time.time() - start
+
+        targets = self.variants if self.reference in self.variants else self.variants + [self.reference]
+        outputs = {}
+        self._branch(current, self.axes[0][0], {}, targets, outputs)
+
+        reference = outputs[self._variant_key(self.reference)]
+        results = []
+        for variant in self.variants:
+            output = outputs[self._variant_key(variant)]
+            results.append({
+                'params': variant,
+                'reference': variant == self.reference,
+                'metrics': self._metrics(output, reference),
+                'image': Image.fromarray(output),
+            })
+
+        summary = {
+            'pipeline': preprocessor.pipeline.name,
+            'swept_stages': [step.stage for _, step, _ in self.axes],
+            'shared_stages': [step.stage for step in steps[:self.axes[0][0]]],
+            'batched_stages': [step.stage for _, step, _ in self.axes if step.op.name in SWEEP_BATCH],
+            'reference': {'params': self.reference, 'metrics': self._metrics(reference, reference)},
+            'variants': results,
+            'prefix_time': prefix_time,
+            'processing_time': time.time() - start,
+        }
+        return self.contact_sheet(results, thumbnail_size), summary
+
+    def _branch(self, image, index, chosen, targets, outputs):
+        """Ejecuta los pasos desde `index`, abriendo una rama por cada variante de cada etapa barrida"""
+        preprocessor = self.preprocessor
+        steps = preprocessor.pipeline.steps
+        axis = next(((i, step) for i, step, _ in self.axes if i >= index), None)
+        stop = axis[0] if axis else len(steps)
+        for step in steps[index:stop]:
+            image = preprocessor._recompute_step(step, image)
+
+        if axis is None:
+            if preprocessor._processes_content_region():
+                image = preprocessor._compose_canvas(image)
+            outputs[self._variant_key(chosen)] = image
+            return
+
+        i, step = axis
+        combos = []
+        for target in targets:
+            if all(target[stage] == params for stage, params in chosen.items()) and target[step.stage] not in combos:
+                combos.append(target[step.stage])
+
+        state = dict(preprocessor.estimated_parameters)
+        batch = SWEEP_BATCH.get(step.op.name)
+        if batch is not None:
+            results = batch(preprocessor, image, [{**step.params, **combo} for combo in combos])
+        else:
+            results = []
+            for combo in combos:
+                variant_step = PipelineStep(step.op.name, step.stage, {**step.params, **combo}, step.tiled)
+                results.append((preprocessor._recompute_step(variant_step, image), {}))
+
+        for combo, (output, parameters) in zip(combos, results):
+            preprocessor.estimated_parameters = {**state, **parameters}
+            self._branch(output, i + 1, {**chosen, step.stage: combo}, targets, outputs)
+        preprocessor.estimated_parameters = state
+
+    @staticmethod
+    def _variant_key(variant):
+        return tuple(sorted((stage, tuple(sorted(params.items()))) for stage, params in variant.items()))
+
+    def _metrics(self, image, reference):
+        """Métricas de la imagen final de una variante y su parecido con la de referencia"""
+        stats = LazyImageStatistics(self.preprocessor.stats_engine, image, 'sweep', DerivedViews(image))
+        metrics = {name: float(stats[name]) for name in SWEEP_METRICS}
+        metrics['psnr'] = psnr(reference, image)
+        metrics['ssim'] = ssim(reference, image)
+        return metrics
+
+    def contact_sheet(self, results, thumbnail_size=192):
+        """Miniaturas de las variantes en una rejilla, cada una con sus valores debajo
+
+        Con dos etapas, cada fila es un valor de la primera y cada columna uno
+        de la segunda; con una sola, las variantes se reparten en filas.
+        """
+        columns = len(self.axes[-1][2]) if len(self.axes) == 2 else int(np.ceil(np.sqrt(len(results))))
+        rows = int(np.ceil(len(results) / columns))
+        label_height = 14 * sum(len(params) for params in results[0]['params'].values()) + 6
+        first = results[0]['image']
+        scale = thumbnail_size / max(first.size)
+        tile_w, tile_h = max(1, round(first.width * scale)), max(1, round(first.height * scale))
+
+        sheet = np.full((rows * (tile_h + label_height), columns * tile_w, 3), 255, dtype=np.uint8)
+        for k, result in enumerate(results):
+            y, x = (k // columns) * (tile_h + label_height), (k % columns) * tile_w
+            thumbnail = cv2.resize(np.asarray(result['image']), (tile_w, tile_h), interpolation=cv2.INTER_AREA)
+            sheet[y:y + tile_h, x:x + tile_w] = thumbnail
+            lines = [
+                f"{name}={'auto' if value is None else value}"
+                for params in result['params'].values() for name, value in params.items()
+            ]
+            for line_index, line in enumerate(lines):
+                cv2.putText(sheet, line, (x + 4, y + tile_h + 14 * (line_index + 1)), cv2.FONT_HERSHEY_SIMPLEX,
+                            0.4, (0, 0, 0) if not result['reference'] else (200, 0, 0), 1, cv2.LINE_AA)
+        return Image.fromarray(sheet)
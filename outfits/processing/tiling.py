@@ -0,0 +1,98 @@
+"""
+Ejecución por teselas con halo, en paralelo, de filtros de vecindario
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class TileExecutor:
+    """Divide una imagen en teselas solapadas y aplica un filtro a cada una en un pool de hilos
+
+    Cada tesela se amplía con `halo` píxeles por lado (sin salir de la
+    imagen) y del resultado solo se conserva la parte central. Si el filtro
+    lee como mucho `halo` píxeles alrededor de cada píxel, la imagen unida es
+    idéntica a la de filtrar la imagen completa: en el interior cada tesela ve
+    los mismos vecinos y en los bordes de la imagen el filtro aplica su propio
+    tratamiento de borde. No sirve para filtros globales o recursivos
+    (edgePreservingFilter) ni para CLAHE, cuya rejilla depende del tamaño de
+    la imagen.
+
+    OpenCV libera el GIL durante el filtrado, así que los hilos trabajan en
+    paralelo. Con un solo worker, o con imágenes de menos de `min_pixels`,
+    el filtro se aplica de una vez sobre la imagen completa.
+    """
+
+    def __init__(self, workers=None, tile_size=256, min_pixels=512 * 512):
+        self.workers = workers or os.cpu_count() or 1
+        self.tile_size = tile_size
+        self.min_pixels = min_pixels
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def tiles(self, shape, halo, align=1):
+        """Teselas de una imagen: pares (núcleo, ampliada) de rectángulos (y0, y1, x0, x1)
+
+        `align` obliga a que el origen de cada tesela ampliada sea múltiplo
+        de ese valor (por ejemplo 2 para filtros que reducen a media resolución).
+        """
+        height, width = shape[:2]
+        tiles = []
+        for y0 in range(0, height, self.tile_size):
+            y1 = min(y0 + self.tile_size, height)
+            for x0 in range(0, width, self.tile_size):
+                x1 = min(x0 + self.tile_size, width)
+                top, left = max(y0 - halo, 0), max(x0 - halo, 0)
+                top, left = top - top % align, left - left % align
+                padded = (top, min(y1 + halo, height), left, min(x1 + halo, width))
+                tiles.append(((y0, y1, x0, x1), padded))
+        return tiles
+
+    def map(self, function, image, halo, align=1):
+        """Aplica `function` (imagen -> imagen del mismo tamaño) por teselas y une el resultado"""
+        height, width = image.shape[:2]
+        if self.workers == 1 or height * width < self.min_pixels:
+            return function(image)
+
+        tiles = self.tiles(image.shape, halo, align)
+        if len(tiles) == 1:
+            return function(image)
+
+        def run(tile):
+            (y0, y1, x0, x1), (top, bottom, left, right) = tile
+            result = function(image[top:bottom, left:right])
+            return result[y0 - top:y1 - top, x0 - left:x1 - left]
+
+        results = list(self._executor().map(run, tiles))
+        output = np.empty((height, width) + results[0].shape[2:], dtype=results[0].dtype)
+        for ((y0, y1, x0, x1), _), result in zip(tiles, results):
+            output[y0:y1, x0:x1] = result
+        return output
+
+    def shutdown(self):
+        """Detiene el pool de hilos (se vuelve a crear si se usa de nuevo)"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tile')
+            return self._pool
+
+
+_default_executor = None
+_default_lock = threading.Lock()
+
+
+def default_executor():
+    """Ejecutor compartido por el proceso, con un worker por núcleo"""
+    global _default_executor
+    with _default_lock:
+        if _default_executor is None:
+            _default_executor = TileExecutor()
+        return _default_executor
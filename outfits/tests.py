@@ -1,3 +1,511 @@
-from django.test import TestCase
+import copy
+import gc
+import io
+import json
+import os
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from PIL import Image, ImageDraw, ImageFilter
+
+from outfits.processing import accelerated
+from outfits.processing import engine
+from outfits.processing import quality
+from outfits.processing import retouch
+from outfits.processing import statistics
+from outfits.processing import streaming
+from outfits.processing.buffers import BufferArena
+from outfits.processing.edge_preserving import edge_preserving_filter
+from outfits.processing.pipeline import PRESETS
+from outfits.processing.preprocessing import ImagePreprocessor
+from outfits.processing.stage_cache import StageCache
+
+
+def sample_image(width=320, height=240, noise=15, seed=0):
+    """Degradado con dos figuras y ruido gaussiano de desviación `noise`"""
+    rng = np.random.default_rng(seed)
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    for y in range(height):
+        draw.line([(0, y), (width, y)], fill=(100, 150, int(255 * (1 - y / height))))
+    draw.ellipse([width // 16, height // 12, width // 4, height // 3], fill=(255, 100, 100), outline=(0, 0, 0), width=2)
+    draw.rectangle([width * 3 // 8, height // 6, width * 5 // 8, height // 2], fill=(100, 255, 100), outline=(0, 0, 0), width=2)
+    values = np.array(image).astype(np.int16) + rng.normal(0, noise, (height, width, 3)).astype(np.int16)
+    return Image.fromarray(np.clip(values, 0, 255).astype(np.uint8))
+
+
+def upload(image):
+    """Imagen en un archivo PNG en memoria, como un archivo subido"""
+    data = io.BytesIO()
+    image.save(data, format='PNG')
+    data.seek(0)
+    return data
+
+
+def process(image, **options):
+    """Procesa `image` con un preprocesador nuevo y devuelve (preprocesador, imagen final, resumen)"""
+    preprocessor = ImagePreprocessor(**options)
+    final, summary = preprocessor.process_upload_complete(upload(image))
+    return preprocessor, np.array(final), summary
+
+
+def stage_statistics(preprocessor):
+    """Estadísticas de cada etapa sin la marca de tiempo, con los valores como repr para compararlas"""
+    return {
+        stage: {key: repr(value) for key, value in stats.items() if key != 'timestamp'}
+        for stage, stats in preprocessor.get_statistics().items()
+    }
+
+
+class FreshArena(BufferArena):
+    """Arena que no reutiliza nada: cada buffer es un array nuevo a cero"""
+
+    def get(self, name, shape, dtype=np.float32):
+        return np.zeros(shape, dtype=dtype)
+
+
+class PoisonedArena(BufferArena):
+    """Arena que reutiliza sus buffers y los llena de basura antes de devolverlos"""
+
+    def get(self, name, shape, dtype=np.float32):
+        buffer = super().get(name, shape, dtype)
+        buffer.fill(np.nan if np.issubdtype(buffer.dtype, np.floating) else 0xA5)
+        return buffer
+
+
+def reference_statistics(img_array, stage_name):
+    """Estadísticas de una imagen calculadas con NumPy, como antes de StatisticsEngine"""
+    stats = {
+        'stage': stage_name,
+        'dimensions': img_array.shape,
+        'size_mb': img_array.nbytes / (1024 * 1024),
+        'dtype': str(img_array.dtype),
+        'mean_rgb': [], 'std_rgb': [], 'min_rgb': [], 'max_rgb': [], 'median_rgb': [],
+        'brightness': 0, 'contrast': 0, 'sharpness': 0,
+        'histograms': {},
+        'blur_metric': 0, 'noise_level': 0, 'saturation_avg': 0,
+    }
+    if len(img_array.shape) == 3:
+        for i, channel in enumerate(['R', 'G', 'B']):
+            channel_data = img_array[:, :, i]
+            stats['mean_rgb'].append(float(np.mean(channel_data)))
+            stats['std_rgb'].append(float(np.std(channel_data)))
+            stats['min_rgb'].append(int(np.min(channel_data)))
+            stats['max_rgb'].append(int(np.max(channel_data)))
+            stats['median_rgb'].append(float(np.median(channel_data)))
+            hist, _ = np.histogram(channel_data.flatten(), bins=256, range=(0, 256))
+            stats['histograms'][channel] = hist.tolist()
+
+        stats['brightness'] = float(np.mean(img_array))
+        stats['contrast'] = float(np.std(img_array))
+        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        stats['blur_metric'] = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+        smoothed = cv2.filter2D(gray.astype(np.float32), -1, np.ones((3, 3)) / 9)
+        stats['noise_level'] = float(np.std(gray.astype(np.float32) - smoothed))
+        hsv = cv2.cvtColor(img_array, cv2.COLOR_RGB2HSV)
+        stats['saturation_avg'] = float(np.mean(hsv[:, :, 1]))
+    return stats
+
+
+def reference_pipeline(image, **options):
+    """Salida de un preset aplicando sus pasos uno tras otro, sin omisiones, fusiones ni caché"""
+    preprocessor = ImagePreprocessor(**options)
+    preprocessor._source_image = image
+    current = np.array(image)
+    for step in preprocessor.pipeline.steps:
+        if step.op.kind == 'linear':
+            current = preprocessor.apply_linear_chain(current, step.op.name)
+        else:
+            current = preprocessor._apply_step(step, current)
+    return current
+
+
+class AcceleratedKernelTests(SimpleTestCase):
+    """Kernels Numba frente a su versión NumPy"""
+
+    @skipUnless(accelerated.AVAILABLE, "Numba no está instalado")
+    def test_kernels_match_numpy(self):
+        differences = accelerated.check_parity(samples=4)
+        domain_transform = differences.pop('domain_transform')
+        self.assertEqual(differences, dict.fromkeys(differences, 0))
+        # El filtro recursivo se compara con OpenCV, que redondea distinto
+        self.assertLessEqual(domain_transform, 1)
+
+    def test_falls_back_without_numba(self):
+        image = np.array(sample_image())
+        expected = process(sample_image(), accelerated=False)[1]
+        with mock.patch.object(accelerated, 'AVAILABLE', False):
+            preprocessor, final, _ = process(sample_image(), accelerated=True)
+            self.assertFalse(preprocessor.accelerated)
+            np.testing.assert_array_equal(final, expected)
+            np.testing.assert_array_equal(retouch.single_scale_retinex(image, accelerated=True),
+                                          retouch.single_scale_retinex(image, accelerated=False))
+            np.testing.assert_array_equal(retouch.wrinkle_reduction(image, accelerated=True),
+                                          retouch.wrinkle_reduction(image, accelerated=False))
+
+
+class GatingTests(SimpleTestCase):
+    """Omisión de etapas con las reglas por defecto"""
+
+    def setUp(self):
+        # Imagen sin ruido y desenfocada: noise_level y blur_metric quedan por
+        # debajo de los umbrales de nlm_denoise y unsharp_mask
+        self.smooth = sample_image(noise=0).filter(ImageFilter.GaussianBlur(3))
+
+    def test_low_noise_image_skips_denoise_and_sharpening(self):
+        preprocessor, _, summary = process(self.smooth, pipeline='full', gating=True)
+        skipped = summary['skipped_stages']
+        self.assertEqual([(entry['stage'], entry['op']) for entry in skipped],
+                         [('step06_denoised', 'nlm_denoise'), ('step09_sharpened', 'unsharp_mask')])
+        for entry in skipped:
+            self.assertEqual(set(entry), {'stage', 'op', 'reason'})
+            self.assertTrue(entry['reason'])
+
+        # Las etapas omitidas registran su entrada sin cambios
+        stages = preprocessor.stage_images
+        np.testing.assert_array_equal(stages['step06_denoised'], stages['step05_clahe_enhanced'])
+        np.testing.assert_array_equal(stages['step09_sharpened'], stages['step08_edges_enhanced'])
+
+    def test_noisy_image_skips_nothing(self):
+        _, _, summary = process(sample_image(noise=15), pipeline='full', gating=True)
+        self.assertEqual(summary['skipped_stages'], [])
+
+    def test_full_without_gating_is_unchanged(self):
+        _, final, summary = process(self.smooth, pipeline='full')
+        self.assertEqual(summary['skipped_stages'], [])
+        np.testing.assert_array_equal(final, reference_pipeline(self.smooth, pipeline='full'))
+
+
+class EdgePreservingBackendTests(SimpleTestCase):
+    """Backends del filtro preservador de bordes frente a edgePreservingFilter de OpenCV"""
+
+    def setUp(self):
+        self.images = quality.sample_images(count=4, size=256)
+
+    def test_domain_transform_within_one_level_of_opencv(self):
+        for image in self.images:
+            expected = cv2.edgePreservingFilter(image, flags=cv2.RECURS_FILTER, sigma_s=50, sigma_r=0.4)
+            actual = edge_preserving_filter(image, 1, 50, 0.4, backend='domain_transform')
+            self.assertLessEqual(np.abs(expected.astype(np.int16) - actual).max(), 1)
+
+    def test_guided_quality_floor(self):
+        # Medido con estas imágenes: PSNR mínimo 29.1 dB y SSIM mínimo 0.887
+        metrics = quality.compare_edge_preserving(self.images, backends=['guided'])['guided']
+        self.assertGreaterEqual(metrics['psnr_min'], 28.0)
+        self.assertGreaterEqual(metrics['ssim_min'], 0.85)
+
+    def test_auto_uses_guided_without_numba(self):
+        image = self.images[0]
+        with mock.patch.object(accelerated, 'AVAILABLE', False):
+            np.testing.assert_array_equal(edge_preserving_filter(image, backend='auto'),
+                                          edge_preserving_filter(image, backend='guided'))
+
+    def test_full_keeps_opencv_filter(self):
+        preprocessor, _, _ = process(sample_image(), pipeline='full')
+        stages = preprocessor.stage_images
+        expected = cv2.edgePreservingFilter(np.asarray(stages['step06_denoised']), flags=cv2.RECURS_FILTER,
+                                            sigma_s=50, sigma_r=0.4)
+        np.testing.assert_array_equal(stages['step07_edge_preserved'], expected)
+
+
+def framed_image(color, width=320, height=160):
+    """sample_image con un marco de 4 píxeles de color `color`: la media del borde es `color`"""
+    image = sample_image(width, height)
+    ImageDraw.Draw(image).rectangle([0, 0, width - 1, height - 1], outline=color, width=4)
+    return image
+
+
+class ContentRegionTests(SimpleTestCase):
+    """Procesamiento del rectángulo con contenido y relleno del lienzo"""
+
+    def test_padding_keeps_border_color(self):
+        # El relleno es la media del borde en el orden de canales de la imagen
+        # final, aunque la corrección de color invierta los del contenido
+        blue = (20, 40, 220)
+        image = framed_image(blue)
+        for options in ({'pipeline': 'balanced'}, {'pipeline': 'fast'},
+                        {'pipeline': 'balanced', 'stats_include_padding': True},
+                        {'pipeline': 'express', 'content_region': True}):
+            with self.subTest(**options):
+                preprocessor, final, _ = process(image, **options)
+                y0 = preprocessor.content_rect[0]
+                self.assertGreater(y0, 0)
+                np.testing.assert_array_equal(final[:y0].reshape(-1, 3), np.tile(blue, (y0 * final.shape[1], 1)))
+
+
+class StripePipelineTests(SimpleTestCase):
+    """Procesamiento por franjas con la memoria acotada"""
+
+    def test_halo_larger_than_stripe_budget_runs_full_height(self):
+        # Con 32 MB no caben franjas con las 150 filas de contexto del filtro
+        # preservador de bordes por cada lado: esa pasada usa todo el alto
+        image = sample_image(800, 600)
+        _, final, summary = process(image, memory_limit_mb=32)
+        streaming = summary['streaming']
+        self.assertEqual(streaming['buffers'], 'disk')
+        self.assertGreaterEqual(streaming['full_height_passes'], 1)
+
+        _, expected, summary = process(image, memory_limit_mb=1024)
+        self.assertEqual(summary['streaming']['full_height_passes'], 0)
+        np.testing.assert_array_equal(final, expected)
+
+    def test_padding_keeps_border_color(self):
+        blue = (20, 40, 220)
+        for pipeline in ('full', 'balanced', 'fast'):
+            with self.subTest(pipeline=pipeline):
+                preprocessor, final, _ = process(framed_image(blue), pipeline=pipeline, memory_limit_mb=256)
+                y0 = preprocessor.content_rect[0]
+                np.testing.assert_array_equal(final[:y0].reshape(-1, 3), np.tile(blue, (y0 * final.shape[1], 1)))
+
+    def test_failed_pass_removes_partial_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'final.ppm')
+            preprocessor = ImagePreprocessor(pipeline='fast', memory_limit_mb=256)
+            with mock.patch.object(streaming._PaddedWriter, '__call__', side_effect=RuntimeError('fallo')):
+                with self.assertRaises(ValueError):
+                    preprocessor.process_upload_complete_extended(upload(sample_image()), output_path=path)
+            self.assertFalse(os.path.exists(path))
+
+
+class StageCacheTests(SimpleTestCase):
+    """Contrato de las claves de la caché de etapas"""
+
+    def setUp(self):
+        self.image = sample_image()
+
+    def assertSameResult(self, first, second):
+        np.testing.assert_array_equal(first[1], second[1])
+        self.assertEqual(stage_statistics(first[0]), stage_statistics(second[0]))
+
+    def test_cold_warm_and_uncached_runs_match(self):
+        for pipeline in ('full', 'balanced'):
+            with self.subTest(pipeline=pipeline):
+                cache = StageCache()
+                uncached = process(self.image, pipeline=pipeline)
+                cold = process(self.image, pipeline=pipeline, stage_cache=cache)
+                warm = process(self.image, pipeline=pipeline, stage_cache=cache)
+                self.assertEqual(cold[2]['cached_stages'], [])
+                self.assertEqual(len(warm[2]['cached_stages']), len(warm[0].pipeline))
+                self.assertSameResult(cold, uncached)
+                self.assertSameResult(warm, uncached)
+
+    def test_changed_parameter_invalidates_only_later_stages(self):
+        cache = StageCache()
+        process(self.image, pipeline='full', stage_cache=cache)
+
+        spec = copy.deepcopy(PRESETS['full'])
+        stages = [step['stage'] for step in spec['steps']]
+        index = stages.index('step14_final_contrast')
+        spec['steps'][index]['params'] = {'clip_limit': 2.5}
+        changed = process(self.image, pipeline=spec, stage_cache=cache)
+        self.assertEqual(changed[2]['cached_stages'], stages[:index])
+        self.assertSameResult(changed, process(self.image, pipeline=spec))
+
+    def test_disk_tier_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Ninguna imagen cabe en memoria: todo se lee del disco, con otra
+            # instancia como en otro proceso
+            cold = process(self.image, pipeline='full', stage_cache=StageCache(max_bytes=1024, directory=directory))
+            cache = StageCache(max_bytes=1024, directory=directory)
+            warm = process(self.image, pipeline='full', stage_cache=cache)
+            self.assertEqual(len(warm[2]['cached_stages']), len(warm[0].pipeline))
+            self.assertEqual(cache.misses, 0)
+            self.assertSameResult(warm, cold)
+
+
+class ProcessingEngineTests(SimpleTestCase):
+    """Motor compartido entre peticiones concurrentes"""
+
+    def test_default_engine_stage_cache_is_off_by_default(self):
+        with mock.patch.object(engine, '_default_engine', None):
+            self.assertIsNone(engine.default_engine().preprocessor().stage_cache)
+
+    @override_settings(PREPROCESSING_STAGE_CACHE=True, PREPROCESSING_STAGE_CACHE_MAX_BYTES=8 * 1024 * 1024)
+    def test_default_engine_stage_cache_from_settings(self):
+        with mock.patch.object(engine, '_default_engine', None):
+            cache = engine.default_engine().preprocessor().stage_cache
+            self.assertIsInstance(cache, StageCache)
+            self.assertEqual(cache.max_bytes, 8 * 1024 * 1024)
+
+    def test_concurrent_requests_match_sequential_runs(self):
+        images = [sample_image(seed=seed, noise=noise) for seed, noise in ((0, 15), (1, 0), (2, 5))]
+        jobs = [(image, preset) for image in images for preset in ('full', 'balanced', 'fast', 'express')]
+
+        for options in ({}, {'stage_cache': StageCache()}):
+            shared = engine.ProcessingEngine(stats_mode='lazy', **options)
+
+            def run(job):
+                context = shared.process(upload(job[0]), pipeline=job[1])
+                return (np.array(context.image), context.preprocessor.generate_statistics_table(),
+                        stage_statistics(context.preprocessor))
+
+            with self.subTest(stage_cache='stage_cache' in options):
+                sequential = [run(job) for job in jobs]
+                with ThreadPoolExecutor(max_workers=6) as pool:
+                    concurrent = list(pool.map(run, jobs * 2))
+                for expected, actual in zip(sequential * 2, concurrent):
+                    np.testing.assert_array_equal(actual[0], expected[0])
+                    self.assertTrue(actual[1].equals(expected[1]))
+                    self.assertEqual(actual[2], expected[2])
+
+
+def post_image(client, view, **data):
+    """Petición POST a la vista `view` de outfits con una imagen pequeña"""
+    image = upload(sample_image(64, 48))
+    image.name = 'image.png'
+    return client.post(reverse(f'outfits:{view}'), {'image': image, **data})
+
+
+class ProgressiveViewTests(SimpleTestCase):
+    """Validación de las peticiones de procesamiento progresivo"""
+
+    def test_invalid_levels_are_rejected(self):
+        for levels in ('0,512', '-5,512', '512,192', '192,192', '192,5000', 'a,512'):
+            with self.subTest(levels=levels):
+                response = post_image(self.client, 'process_image_progressive', levels=levels, preset='fast')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    def test_valid_levels_stream_every_level(self):
+        response = post_image(self.client, 'process_image_progressive', levels='32,64', preset='fast')
+        self.assertEqual(response.status_code, 200)
+        levels = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([level['level']['size'] for level in levels], [32, 64])
+        self.assertTrue(all(level['success'] for level in levels))
+
+
+class SweepViewTests(SimpleTestCase):
+    """Validación de las peticiones de barrido de parámetros"""
+
+    def post(self, grid):
+        return post_image(self.client, 'process_image_sweep', grid=json.dumps(grid))
+
+    def test_invalid_grid_values_are_rejected(self):
+        for grid in ({'adaptive_gamma': {'gamma': ['a']}}, {'clahe': {'tile_grid_size': [[8, 8]]}},
+                     {'clahe': {'tile_grid_size': [2.5]}}, {'clahe': {'clip_limit': [None]}},
+                     {'saturation': {'gain': [True]}}, {'saturation': {'gain': 1.2}}):
+            with self.subTest(grid=grid):
+                response = self.post(grid)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    def test_gamma_accepts_none(self):
+        response = self.post({'adaptive_gamma': {'gamma': [None, 1.2]}})
+        self.assertEqual(response.status_code, 200)
+
+
+class StatisticsEngineTests(SimpleTestCase):
+    """calculate_image_statistics frente al cálculo NumPy anterior a StatisticsEngine"""
+
+    def assertMatchesReference(self, img_array, **options):
+        preprocessor = ImagePreprocessor(**options)
+        stats = dict(preprocessor.calculate_image_statistics(img_array, 'stage'))
+        expected = reference_statistics(img_array, 'stage')
+        self.assertEqual(set(stats) - {'timestamp'}, set(expected))
+        for key, value in expected.items():
+            with self.subTest(key=key):
+                if isinstance(value, float):
+                    self.assertAlmostEqual(stats[key], value, delta=1e-6 * max(abs(value), 1))
+                elif key in ('mean_rgb', 'std_rgb', 'median_rgb'):
+                    np.testing.assert_allclose(stats[key], value, rtol=1e-9)
+                else:
+                    self.assertEqual(stats[key], value)
+
+    def test_rgb_matches_numpy(self):
+        for image in (np.array(sample_image()), np.array(sample_image(161, 97, noise=40, seed=3))):
+            for stats_mode in ('eager', 'lazy'):
+                self.assertMatchesReference(image, stats_mode=stats_mode)
+
+    def test_large_image_histograms_match_numpy(self):
+        # Por encima de _CALCHIST_MAX_PIXELS los histogramas se calculan con bincount
+        with mock.patch.object(statistics, '_CALCHIST_MAX_PIXELS', 0):
+            self.assertMatchesReference(np.array(sample_image(seed=5)))
+            self.assertMatchesReference(np.array(sample_image(seed=5).convert('RGBA')))
+
+    def test_rgba_matches_numpy(self):
+        rgba = np.array(sample_image().convert('RGBA'))
+        rgba[::3, :, 3] = 128
+        self.assertMatchesReference(rgba)
+        self.assertMatchesReference(rgba, stats_mode='lazy')
+
+    def test_grayscale_has_only_base_statistics(self):
+        self.assertMatchesReference(np.array(sample_image().convert('L')))
+
+
+class LazyStatisticsTests(SimpleTestCase):
+    """Estadísticas perezosas: mismos valores que las inmediatas sin retener las vistas de cada etapa"""
+
+    def test_earlier_stages_release_derived_views(self):
+        preprocessor, _, _ = process(sample_image(), stats_mode='lazy')
+        stages = list(preprocessor.processing_stats.values())
+        for stats in stages[:-1]:
+            views = stats._views
+            self.assertTrue(views is None or not views.cached_views(), stats)
+
+        # Las métricas se recalculan desde la imagen con los mismos valores
+        eager, _, _ = process(sample_image(), stats_mode='eager')
+        self.assertEqual(stage_statistics(preprocessor), stage_statistics(eager))
+
+    def test_dropped_stages_do_not_retain_images(self):
+        data = upload(sample_image(1600, 1200)).getvalue()
+
+        def retained(**options):
+            gc.collect()
+            tracemalloc.start()
+            try:
+                preprocessor = ImagePreprocessor(stats_mode='lazy', **options)
+                preprocessor.process_upload_complete(io.BytesIO(data))
+                gc.collect()
+                return preprocessor, tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+
+        _, all_bytes = retained(stage_retention='all')
+        for retention in ('final', 'thumbnails'):
+            with self.subTest(retention=retention):
+                preprocessor, retention_bytes = retained(stage_retention=retention)
+                # Las estadísticas de las etapas descartadas se calcularon al descartarlas
+                stages = list(preprocessor.processing_stats.items())
+                self.assertTrue(all(stats.is_materialized for _, stats in stages[:-1]))
+                self.assertLess(retention_bytes, all_bytes / 2)
+
+                eager = ImagePreprocessor(stats_mode='eager', stage_retention=retention)
+                eager.process_upload_complete(io.BytesIO(data))
+                self.assertEqual(stage_statistics(preprocessor), stage_statistics(eager))
+
+
+class BufferArenaTests(SimpleTestCase):
+    """Los buffers reutilizados no cambian el resultado de ninguna etapa"""
+
+    def assertSameStages(self, actual, expected):
+        self.assertEqual(list(actual.stage_images), list(expected.stage_images))
+        for stage in expected.stage_images:
+            np.testing.assert_array_equal(actual.stage_images[stage], expected.stage_images[stage], err_msg=stage)
+
+    def test_stages_do_not_depend_on_arena_contents(self):
+        images = [sample_image(seed=1), sample_image(401, 263, noise=5, seed=2)]
+        for pipeline in ('full', 'balanced'):
+            for image in images:
+                for accelerated_kernels in (False, True):
+                    with self.subTest(pipeline=pipeline, size=image.size, accelerated=accelerated_kernels):
+                        expected, _, _ = process(image, pipeline=pipeline, accelerated=accelerated_kernels,
+                                                 buffer_arena=FreshArena())
+                        # Dos pasadas: la segunda recibe los buffers ya usados por la primera
+                        arena = PoisonedArena()
+                        for _ in range(2):
+                            actual, _, _ = process(image, pipeline=pipeline, accelerated=accelerated_kernels,
+                                                   buffer_arena=arena)
+                            self.assertSameStages(actual, expected)
+                        self.assertGreater(arena.hits, 0)
+
+    def test_full_is_identical_with_and_without_kernels(self):
+        image = sample_image(401, 263, seed=2)
+        expected, _, _ = process(image, accelerated=False, buffer_arena=FreshArena())
+        actual, _, _ = process(image, accelerated=True)
+        self.assertSameStages(actual, expected)
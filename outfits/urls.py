@@ -6,6 +6,8 @@ app_name = 'outfits'
 urlpatterns = [
     path('', views.home, name='home'),
     path('process/', views.process_image, name='process_image'),
+    path('process/progressive/', views.process_image_progressive, name='process_image_progressive'),
+    path('process/sweep/', views.process_image_sweep, name='process_image_sweep'),
     path('statistics/', views.get_processing_statistics, name='statistics'),
     path('download-report/', views.download_statistics_report, name='download_report'),
     path('3d-visualization/', views.get_3d_visualization, name='3d_visualization'),
@@ -1,5 +1,5 @@
 from django.shortcuts import render
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
@@ -8,6 +8,7 @@ import os
 import json
 import base64
 import io
+from collections.abc import Mapping
 import numpy as np
 from PIL import Image
 import matplotlib
@@ -16,9 +17,9 @@ import matplotlib.pyplot as plt
 import pandas as pd
 
 from .processing.preprocessing import ImagePreprocessor
-from .processing.analysis import FacialAnalyzer, ColorAnalyzer  
-from .processing.recommendation import OutfitRecommender
-from .processing.render import RenderEngine
+from .processing.stage_store import StageStore
+from .processing.pipeline import PRESETS
+from .processing.engine import default_engine
 from .processing.mannequin3d import Mannequin3D
 
 
@@ -30,7 +31,8 @@ def convert_numpy_types(obj):
         return float(obj)
     elif isinstance(obj, np.ndarray):
         return obj.tolist()
-    elif isinstance(obj, dict):
+    elif isinstance(obj, (dict, Mapping)):
+        # Incluye las estadísticas perezosas, que se calculan al recorrerlas
         return {key: convert_numpy_types(value) for key, value in obj.items()}
     elif isinstance(obj, list):
         return [convert_numpy_types(item) for item in obj]
@@ -54,47 +56,58 @@ def process_image(request):
     if 'image' not in request.FILES:
         return JsonResponse({'error': 'No se encontró imagen'}, status=400)
     
+    # Los clientes que solo necesitan la imagen final y las recomendaciones
+    # pueden pedir include_stats=false y evitar el cálculo de estadísticas
+    include_stats = request.POST.get('include_stats', 'true').lower() not in ('0', 'false', 'no')
+    
+    # Imágenes intermedias a devolver: 'all', 'final' o 'thumbnails'
+    stage_retention = request.POST.get('stage_images', 'all')
+    if stage_retention not in StageStore.RETENTION_POLICIES:
+        return JsonResponse({'error': f'Valor de stage_images no válido: {stage_retention}'}, status=400)
+    
+    # Preset del pipeline: 'full' (15 etapas originales), 'balanced', 'fast' o 'express'
+    preset = request.POST.get('preset', 'full')
+    if preset not in PRESETS:
+        return JsonResponse({'error': f'Valor de preset no válido: {preset}'}, status=400)
+    
     try:
-        # Inicializar procesadores
-        preprocessor = ImagePreprocessor()
-        facial_analyzer = FacialAnalyzer()
-        color_analyzer = ColorAnalyzer()
-        recommender = OutfitRecommender()
-        render_engine = RenderEngine()
+        # Motor compartido por las peticiones (las estadísticas se calculan solo si se consultan;
+        # con PREPROCESSING_STAGE_CACHE en settings se reutilizan las etapas ya calculadas para la
+        # misma foto y los mismos parámetros)
+        engine = default_engine()
+        render_engine = engine.render_engine
         
-        # Procesar imagen
-        uploaded_file = request.FILES['image']
+        # 1. PREPROCESAMIENTO COMPLETO (resultados en el contexto de esta petición)
+        context = engine.process(request.FILES['image'], stage_retention=stage_retention, pipeline=preset)
+        preprocessor = context.preprocessor
+        processed_image, processing_summary = context.image, context.summary
         
-        # 1. PREPROCESAMIENTO COMPLETO
-        processed_image, processing_summary = preprocessor.process_upload_complete(uploaded_file)
-        
-        # 2. ANÁLISIS FACIAL
-        face_coords = facial_analyzer.detect_face(processed_image)
-        skin_tone = facial_analyzer.extract_skin_tone(processed_image, face_coords)
-        color_palette = facial_analyzer.analyze_color_palette(skin_tone)
-        
-        # 3. ANÁLISIS DE COLOR
-        dominant_colors = color_analyzer.extract_dominant_colors(processed_image)
-        
-        # 4. GENERACIÓN DE RECOMENDACIONES
-        outfit_recommendations = recommender.generate_recommendations(color_palette)
-        style_tips = recommender.get_style_tips(color_palette)
+        # 2-4. ANÁLISIS FACIAL, DE COLOR Y RECOMENDACIONES
+        analysis = _analyze_processed_image(processed_image, engine)
+        color_palette = analysis['color_palette']
         
         # 5. RENDERIZADO Y VISUALIZACIONES
         palette_overlay = render_engine.create_color_palette_overlay(processed_image, color_palette)
         
         # 6. GENERAR ESTADÍSTICAS Y GRÁFICOS
-        stats_table = preprocessor.generate_statistics_table()
-        
-        # Generar gráficos y guardarlos
-        charts_fig = preprocessor.generate_comparison_charts()
-        histograms_fig = preprocessor.generate_histograms_comparison()  
-        radar_fig = preprocessor.generate_quality_metrics_radar()
-        
-        # Convertir gráficos a base64
-        charts_base64 = _fig_to_base64(charts_fig)
-        histograms_base64 = _fig_to_base64(histograms_fig)
-        radar_base64 = _fig_to_base64(radar_fig)
+        preprocessing_stats = None
+        if include_stats:
+            stats_table = preprocessor.generate_statistics_table()
+            
+            # Generar gráficos y guardarlos
+            charts_fig = preprocessor.generate_comparison_charts()
+            histograms_fig = preprocessor.generate_histograms_comparison()  
+            radar_fig = preprocessor.generate_quality_metrics_radar()
+            
+            preprocessing_stats = {
+                'summary_text': preprocessor.get_processing_summary(),
+                'statistics_table': stats_table.to_html(classes='table table-striped', table_id='stats-table'),
+                'charts': {
+                    'comparison_charts': _fig_to_base64(charts_fig),
+                    'histograms': _fig_to_base64(histograms_fig),
+                    'quality_radar': _fig_to_base64(radar_fig)
+                }
+            }
         
         # Convertir imágenes a base64
         processed_image_base64 = render_engine.image_to_base64(processed_image)
@@ -119,36 +132,25 @@ def process_image(request):
             'final_optimization': '✅ Optimización Final'
         }
         
+        skipped_stages = {entry['stage'] for entry in processing_summary.get('skipped_stages', [])}
         stage_images_base64 = {}
         for stage_name, stage_image in preprocessor.stage_images.items():
             stage_img_pil = Image.fromarray(stage_image)
             stage_images_base64[stage_name] = {
                 'image': render_engine.image_to_base64(stage_img_pil),
                 'description': stage_descriptions.get(stage_name, stage_name),
-                'stats': convert_numpy_types(preprocessor.processing_stats.get(stage_name, {}))
+                'skipped': stage_name in skipped_stages,
+                'stats': _finite(convert_numpy_types(preprocessor.processing_stats.get(stage_name, {}))) if include_stats else None
             }
         
         # Preparar respuesta
         response_data = {
             'success': True,
             'processing_summary': convert_numpy_types(processing_summary),
-            'preprocessing_stats': {
-                'summary_text': preprocessor.get_processing_summary(),
-                'statistics_table': stats_table.to_html(classes='table table-striped', table_id='stats-table'),
-                'charts': {
-                    'comparison_charts': charts_base64,
-                    'histograms': histograms_base64,
-                    'quality_radar': radar_base64
-                }
-            },
-            'analysis_results': {
-                'face_detected': face_coords is not None,
-                'skin_tone': convert_numpy_types(skin_tone),
-                'color_palette': convert_numpy_types(color_palette),
-                'dominant_colors': convert_numpy_types(dominant_colors)
-            },
-            'outfit_recommendations': convert_numpy_types(outfit_recommendations),
-            'style_tips': convert_numpy_types(style_tips),
+            'preprocessing_stats': preprocessing_stats,
+            'analysis_results': analysis['analysis_results'],
+            'outfit_recommendations': analysis['outfit_recommendations'],
+            'style_tips': analysis['style_tips'],
             'images': {
                 'processed': processed_image_base64,
                 'palette_overlay': palette_overlay_base64
@@ -169,6 +171,152 @@ def process_image(request):
         }, status=500)
 
 
+@csrf_exempt
+def process_image_progressive(request):
+    """Procesamiento progresivo: una línea JSON (NDJSON) por nivel de resolución
+
+    La primera línea llega con el resultado completo de una vista previa de
+    baja resolución (imagen, análisis, recomendaciones y, si se piden,
+    estadísticas por etapa); las siguientes refinan hasta el tamaño objetivo
+    o hasta los lados indicados en `levels` (por ejemplo "192,512,1024").
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Método no permitido'}, status=405)
+    
+    if 'image' not in request.FILES:
+        return JsonResponse({'error': 'No se encontró imagen'}, status=400)
+    
+    include_stats = request.POST.get('include_stats', 'false').lower() not in ('0', 'false', 'no')
+    
+    preset = request.POST.get('preset', 'full')
+    if preset not in PRESETS:
+        return JsonResponse({'error': f'Valor de preset no válido: {preset}'}, status=400)
+    
+    # Solo se devuelve la imagen final de cada nivel
+    engine = default_engine()
+    preprocessor = engine.preprocessor(stage_retention='final', pipeline=preset)
+    
+    # Los niveles se validan antes de empezar la respuesta, que ya no puede cambiar de estado
+    levels = None
+    if request.POST.get('levels'):
+        try:
+            levels = preprocessor.progressive_levels(request.POST['levels'].split(','))
+        except ValueError:
+            return JsonResponse({'error': f"Valor de levels no válido: {request.POST['levels']}"}, status=400)
+    uploaded_file = request.FILES['image']
+    
+    def stream():
+        render_engine = engine.render_engine
+        
+        try:
+            for processed_image, processing_summary in preprocessor.process_progressive(uploaded_file, levels):
+                analysis = _analyze_processed_image(processed_image, engine)
+                del analysis['color_palette']
+                level = {
+                    'success': True,
+                    'level': processing_summary['level'],
+                    'processing_summary': convert_numpy_types(processing_summary),
+                    'images': {'processed': render_engine.image_to_base64(processed_image)},
+                    **analysis,
+                }
+                if include_stats:
+                    level['statistics'] = _finite(convert_numpy_types(preprocessor.get_statistics()))
+                yield json.dumps(level) + '\n'
+        except Exception as e:
+            yield json.dumps({'success': False, 'error': f'Error procesando imagen: {str(e)}'}) + '\n'
+    
+    return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+
+@csrf_exempt
+def process_image_sweep(request):
+    """Barrido de parámetros: variantes de una o dos etapas sobre una imagen
+
+    `grid` es un JSON {etapa u operación: {parámetro: [valores]}}, por ejemplo
+    {"adaptive_gamma": {"gamma": [0.8, 1.0, 1.3]}}. Devuelve la hoja de
+    contactos y las métricas de cada variante (y sus imágenes si se pide
+    include_images).
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Método no permitido'}, status=405)
+    
+    if 'image' not in request.FILES:
+        return JsonResponse({'error': 'No se encontró imagen'}, status=400)
+    
+    preset = request.POST.get('preset', 'full')
+    if preset not in PRESETS:
+        return JsonResponse({'error': f'Valor de preset no válido: {preset}'}, status=400)
+    
+    try:
+        grid = json.loads(request.POST.get('grid', ''))
+    except ValueError:
+        return JsonResponse({'error': 'Valor de grid no válido: se esperaba JSON'}, status=400)
+    if not isinstance(grid, dict) or not all(isinstance(params, dict) for params in grid.values()):
+        return JsonResponse({'error': 'Valor de grid no válido: {etapa: {parámetro: [valores]}}'}, status=400)
+    
+    include_images = request.POST.get('include_images', 'false').lower() not in ('0', 'false', 'no')
+    
+    engine = default_engine()
+    preprocessor = engine.preprocessor(stage_retention='final', pipeline=preset, stage_cache=None)
+    render_engine = engine.render_engine
+    try:
+        contact_sheet, summary = preprocessor.sweep(request.FILES['image'], grid)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f'Error procesando imagen: {str(e)}'}, status=500)
+    
+    variants = []
+    for variant in summary.pop('variants'):
+        image = variant.pop('image')
+        if include_images:
+            variant['image'] = render_engine.image_to_base64(image)
+        variants.append(variant)
+    
+    return JsonResponse({
+        'success': True,
+        'sweep_summary': _finite(convert_numpy_types(summary)),
+        'variants': _finite(convert_numpy_types(variants)),
+        'images': {'contact_sheet': render_engine.image_to_base64(contact_sheet)},
+    })
+
+
+def _finite(obj):
+    """Sustituye los valores infinitos (PSNR de imágenes idénticas) por None, que JSON admite"""
+    if isinstance(obj, float) and not np.isfinite(obj):
+        return None
+    if isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(item) for item in obj]
+    return obj
+
+
+def _analyze_processed_image(processed_image, engine):
+    """Análisis facial y de color de la imagen procesada y recomendaciones derivadas
+
+    Usa los analizadores compartidos del motor. 'color_palette' es la paleta
+    sin convertir, para el renderizado.
+    """
+    facial_analyzer, color_analyzer, recommender = engine.facial_analyzer, engine.color_analyzer, engine.recommender
+    face_coords = facial_analyzer.detect_face(processed_image)
+    skin_tone = facial_analyzer.extract_skin_tone(processed_image, face_coords)
+    color_palette = facial_analyzer.analyze_color_palette(skin_tone)
+    dominant_colors = color_analyzer.extract_dominant_colors(processed_image)
+    
+    return {
+        'color_palette': color_palette,
+        'analysis_results': {
+            'face_detected': face_coords is not None,
+            'skin_tone': convert_numpy_types(skin_tone),
+            'color_palette': convert_numpy_types(color_palette),
+            'dominant_colors': convert_numpy_types(dominant_colors)
+        },
+        'outfit_recommendations': convert_numpy_types(recommender.generate_recommendations(color_palette)),
+        'style_tips': convert_numpy_types(recommender.get_style_tips(color_palette)),
+    }
+
+
 def _fig_to_base64(fig):
     """Convierte figura matplotlib a base64"""
     if fig is None: